@@ -0,0 +1,276 @@
+import base64
+import json
+import os
+import time
+from pathlib import Path
+from tqdm import tqdm
+from google.genai import types
+from generate_ui_captions import (
+    BASE_DIRECTORY, OUTPUT_FILE, MODEL_NAME, LIMIT, SYSTEM_INSTRUCTION, PAYLOAD_FORMAT, PAYLOAD_QUALITY,
+    PAYLOAD_MAX_EDGE, PAYLOAD_CROP, generation_config, get_client, gather_all_images, load_existing_progress,
+    clean_caption,
+)
+from caption_sink import CaptionSink
+from utils import image_from_filepath, encode_image_payload
+
+# Offline alternative to generate_ui_captions.main: instead of one online call per image, all pending
+# images are written to batch-prediction request files, submitted as a single job, and the response
+# file is ingested into OUTPUT_FILE. Failed rows are reconciled into a retry batch.
+
+# --- Configuration ---
+BATCH_WORK_DIR = Path("./caption_batches")
+BATCH_GCS_PREFIX = "gs://YOUR_BUCKET/delineo/caption_batches" # Vertex batch jobs read from/write to GCS
+REQUESTS_PER_FILE = 5000
+POLL_INTERVAL_SECONDS = 60
+MAX_BATCH_ROUNDS = 3 # First submission + retry batches
+
+COMPLETED_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"}
+FAILED_STATES = {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+# --- REQUEST FILES ---
+
+def build_request(relative_path, image):
+    """One batch-prediction row: the GenerateContent body plus a key to map the response back."""
+    image_format = PAYLOAD_FORMAT or "PNG"
+    data = encode_image_payload(image, max_edge=PAYLOAD_MAX_EDGE, image_format=image_format, quality=PAYLOAD_QUALITY, crop_box=PAYLOAD_CROP)
+    return {
+        "key": relative_path,
+        "request": {
+            "contents": [{
+                "role": "user",
+                "parts": [{"inlineData": {"mimeType": f"image/{image_format.lower()}", "data": base64.b64encode(data).decode("ascii")}}],
+            }],
+            "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+            "generationConfig": {
+                "temperature": generation_config.temperature,
+                "maxOutputTokens": generation_config.max_output_tokens,
+            },
+            "safetySettings": [
+                {"category": setting.category.value, "threshold": setting.threshold.value}
+                for setting in generation_config.safety_settings
+            ],
+        },
+    }
+
+
+def write_request_files(file_paths, round_dir):
+    """
+    Writes batch request rows for file_paths, split into shards of REQUESTS_PER_FILE.
+    Returns the shard paths, the written keys and the keys of images that could not be loaded.
+    """
+    round_dir.mkdir(parents=True, exist_ok=True)
+    shard_paths = []
+    written_keys = set()
+    skipped_keys = []
+    shard = None
+    for full_path in tqdm(file_paths, desc="Writing batch requests"):
+        image = image_from_filepath(full_path)
+        if not image:
+            print(f'fail crop {os.path.relpath(full_path, BASE_DIRECTORY)}')
+            skipped_keys.append(os.path.relpath(full_path, BASE_DIRECTORY))
+            continue
+        if len(written_keys) % REQUESTS_PER_FILE == 0:
+            if shard:
+                shard.close()
+            shard_path = round_dir / f"requests-{len(shard_paths):05d}.jsonl"
+            shard_paths.append(shard_path)
+            shard = open(shard_path, 'w', encoding='utf-8')
+        relative_path = os.path.relpath(full_path, BASE_DIRECTORY)
+        shard.write(json.dumps(build_request(relative_path, image), ensure_ascii=False) + '\n')
+        written_keys.add(relative_path)
+    if shard:
+        shard.close()
+    return shard_paths, written_keys, skipped_keys
+
+
+# --- BATCH SERVICES ---
+
+class VertexBatchService:
+    """Submits request files as Vertex AI batch-prediction jobs through GCS."""
+
+    def __init__(self, gcs_prefix=BATCH_GCS_PREFIX, model=MODEL_NAME):
+        try:
+            from google.cloud import storage
+        except ImportError:
+            raise ImportError(
+                "Vertex batch prediction reads its input from GCS, please install `pip install google-cloud-storage`."
+            )
+        self.storage = storage.Client()
+        self.gcs_prefix = gcs_prefix.rstrip("/")
+        self.model = model
+
+    def _blob(self, uri):
+        bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+        return self.storage.bucket(bucket_name).blob(blob_name)
+
+    def submit(self, request_path, job_name):
+        src_uri = f"{self.gcs_prefix}/{job_name}/{request_path.name}"
+        self._blob(src_uri).upload_from_filename(str(request_path))
+        job = get_client().batches.create(
+            model=self.model,
+            src=src_uri,
+            config=types.CreateBatchJobConfig(dest=f"{self.gcs_prefix}/{job_name}/output", display_name=job_name),
+        )
+        return job.name
+
+    def state(self, job_id):
+        return get_client().batches.get(name=job_id).state.name
+
+    def download_results(self, job_id, local_dir):
+        job = get_client().batches.get(name=job_id)
+        output_prefix = job.dest.gcs_uri.rstrip("/")
+        bucket_name, _, blob_prefix = output_prefix[len("gs://"):].partition("/")
+        local_dir.mkdir(parents=True, exist_ok=True)
+        result_paths = []
+        for blob in self.storage.list_blobs(bucket_name, prefix=blob_prefix):
+            if blob.name.endswith(".jsonl"):
+                local_path = local_dir / f"{len(result_paths):05d}-{Path(blob.name).name}"
+                blob.download_to_filename(str(local_path))
+                result_paths.append(local_path)
+        return result_paths
+
+
+class LocalBatchService:
+    """
+    Filesystem stand-in for the batch service, used to exercise submit/ingest/reconcile end-to-end.
+    responder(request_body) returns the caption text, or raises to mark the row as failed.
+    """
+
+    def __init__(self, root_dir, responder):
+        self.root_dir = Path(root_dir)
+        self.responder = responder
+
+    def submit(self, request_path, job_name):
+        job_dir = self.root_dir / job_name
+        job_dir.mkdir(parents=True, exist_ok=True)
+        with open(request_path, 'r', encoding='utf-8') as src, open(job_dir / "predictions.jsonl", 'w', encoding='utf-8') as dst:
+            for line in src:
+                row = json.loads(line)
+                try:
+                    text = self.responder(row["request"])
+                    row["response"] = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+                    row["status"] = ""
+                except Exception as e:
+                    row["status"] = str(e)
+                dst.write(json.dumps(row, ensure_ascii=False) + '\n')
+        return str(job_dir)
+
+    def state(self, job_id):
+        return "JOB_STATE_SUCCEEDED"
+
+    def download_results(self, job_id, local_dir):
+        return [Path(job_id) / "predictions.jsonl"]
+
+
+# --- INGEST & RECONCILE ---
+
+def extract_caption(row):
+    """Returns the caption text of a response row, or None if the row failed or was blocked."""
+    if row.get("status"):
+        return None
+    try:
+        parts = row["response"]["candidates"][0]["content"]["parts"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    text = "".join(part.get("text", "") for part in parts)
+    return clean_caption(text) if text.strip() else None
+
+
+def ingest_results(result_paths, requested_keys, output_file=OUTPUT_FILE):
+    """
+    Appends successful captions to output_file and returns the keys that still need a caption.
+    Keys missing from the response files are treated as failures.
+    """
+    captioned = set()
+    with CaptionSink(output_file) as sink:
+        for result_path in result_paths:
+            with open(result_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    key = row.get("key")
+                    caption = extract_caption(row)
+                    if key in requested_keys and key not in captioned and caption is not None:
+                        captioned.add(key)
+                        sink.write({"filename": key, "caption": caption})
+    return sorted(requested_keys - captioned)
+
+
+def wait_for_jobs(service, job_ids):
+    """Polls all job_ids together and yields (job_id, succeeded) as each one finishes."""
+    running = list(job_ids)
+    while running:
+        for job_id in list(running):
+            state = service.state(job_id)
+            if state in COMPLETED_STATES:
+                running.remove(job_id)
+                yield job_id, True
+            elif state in FAILED_STATES:
+                print(f"❌ Batch job {job_id} ended with {state}")
+                running.remove(job_id)
+                yield job_id, False
+        if running:
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def run_batch_captioning(file_paths, service, work_dir=BATCH_WORK_DIR, output_file=OUTPUT_FILE, max_rounds=MAX_BATCH_ROUNDS):
+    """
+    Submits file_paths as batch jobs, ingests the responses and resubmits failures. Returns the keys left uncaptioned,
+    including the images that could not be loaded.
+    """
+    pending = list(file_paths)
+    unloadable = []
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    for batch_round in range(max_rounds):
+        if not pending:
+            break
+        round_dir = Path(work_dir) / run_id / f"round-{batch_round}"
+        shard_paths, requested_keys, skipped_keys = write_request_files(pending, round_dir)
+        # An image that fails to load will fail again, so it is reported instead of retried
+        unloadable += skipped_keys
+
+        # All shards of the round run side by side, each is downloaded as soon as its job is done
+        job_ids = []
+        for shard_index, shard_path in enumerate(shard_paths):
+            job_id = service.submit(shard_path, f"{run_id}-r{batch_round}-s{shard_index}")
+            print(f"Submitted {shard_path.name} as {job_id}")
+            job_ids.append(job_id)
+
+        result_paths = []
+        for job_index, (job_id, succeeded) in enumerate(wait_for_jobs(service, job_ids)):
+            if succeeded:
+                result_paths += service.download_results(job_id, round_dir / "results" / f"{job_index:05d}")
+
+        failed_keys = ingest_results(result_paths, requested_keys, output_file)
+        print(f"Round {batch_round + 1}: {len(requested_keys) - len(failed_keys)} captioned, {len(failed_keys)} to retry")
+        pending = [os.path.join(BASE_DIRECTORY, key) for key in failed_keys]
+
+    return [os.path.relpath(p, BASE_DIRECTORY) for p in pending] + unloadable
+
+
+def main():
+    all_file_paths = gather_all_images(BASE_DIRECTORY)
+    processed_files = load_existing_progress(OUTPUT_FILE)
+    files_to_process = [p for p in all_file_paths if os.path.relpath(p, BASE_DIRECTORY) not in processed_files]
+
+    if LIMIT and LIMIT > 0 and len(files_to_process) > LIMIT:
+        print(f"\n⚠️ LIMIT ACTIVE: Restricting run to first {LIMIT} images only.")
+        files_to_process = files_to_process[:LIMIT]
+
+    print(f"Total images found: {len(all_file_paths)}")
+    print(f"Already done: {len(processed_files)}")
+    print(f"To be processed: {len(files_to_process)}")
+
+    if not files_to_process:
+        print("✅ No new files to process!")
+        return
+
+    remaining = run_batch_captioning(files_to_process, VertexBatchService())
+    print(f"\n✅ Finished! {len(files_to_process) - len(remaining)} new captions in {OUTPUT_FILE}, {len(remaining)} still missing")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import io
+import os
+import random
+import statistics
+import time
+from difflib import SequenceMatcher
+from generate_ui_captions import BASE_DIRECTORY, gather_all_images, prepare_payload, request_caption
+from utils import image_from_filepath, encode_image_payload
+
+# --- CONFIGURATION ---
+SAMPLE_SIZE = 50
+SEED = 42
+
+# (label, format, quality, max_edge, crop_box). The full-resolution reference is always captioned first.
+PAYLOAD_SETTINGS = [
+    ("jpeg-q85-1024", "JPEG", 85, 1024, None),
+    ("jpeg-q75-768", "JPEG", 75, 768, None),
+    ("webp-q80-1024", "WEBP", 80, 1024, None),
+    ("webp-q70-768", "WEBP", 70, 768, None),
+]
+
+
+def payload_size(image, image_format, quality, max_edge, crop_box):
+    if image_format is None:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return len(buffer.getvalue())
+    return len(encode_image_payload(image, max_edge=max_edge, image_format=image_format, quality=quality, crop_box=crop_box))
+
+
+def caption_agreement(reference, candidate):
+    """Word-level similarity ratio in [0, 1] between two captions."""
+    return SequenceMatcher(None, reference.lower().split(), candidate.lower().split()).ratio()
+
+
+def timed_caption(image, relative_path, image_format, quality, max_edge, crop_box):
+    start = time.perf_counter()
+    payload = prepare_payload(image, image_format=image_format, quality=quality, max_edge=max_edge, crop_box=crop_box)
+    caption = request_caption(payload, relative_path)
+    return caption, time.perf_counter() - start
+
+
+def summarize(label, sizes, latencies, agreements):
+    if not latencies:
+        print(f"{label:<16} no successful requests")
+        return
+    agreement = f"{statistics.mean(agreements):.3f}" if agreements else "-"
+    print(
+        f"{label:<16} {statistics.mean(sizes) / 1024:>10.1f} KB "
+        f"{statistics.median(latencies):>8.2f} s {max(latencies):>8.2f} s {agreement:>10}"
+    )
+
+
+def main():
+    all_paths = gather_all_images(BASE_DIRECTORY)
+    random.seed(SEED)
+    sample_paths = random.sample(all_paths, min(SAMPLE_SIZE, len(all_paths)))
+    print(f"Benchmarking {len(sample_paths)} images against {len(PAYLOAD_SETTINGS)} payload settings...\n")
+
+    settings = [("full-res-png", None, None, None, None)] + PAYLOAD_SETTINGS
+    results = {label: {"sizes": [], "latencies": [], "agreements": []} for label, *_ in settings}
+
+    for full_path in sample_paths:
+        image = image_from_filepath(full_path)
+        if not image:
+            continue
+        relative_path = os.path.relpath(full_path, BASE_DIRECTORY)
+
+        reference = None
+        for label, image_format, quality, max_edge, crop_box in settings:
+            caption, latency = timed_caption(image, relative_path, image_format, quality, max_edge, crop_box)
+            if caption is None:
+                continue
+            stats = results[label]
+            stats["sizes"].append(payload_size(image, image_format, quality, max_edge, crop_box))
+            stats["latencies"].append(latency)
+            if image_format is None:
+                reference = caption
+            elif reference is not None:
+                stats["agreements"].append(caption_agreement(reference, caption))
+
+    print(f"{'setting':<16} {'bytes/req':>13} {'p50':>10} {'max':>10} {'agreement':>10}")
+    for label, *_ in settings:
+        summarize(label, **results[label])
+
+
+if __name__ == "__main__":
+    main()
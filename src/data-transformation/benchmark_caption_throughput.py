@@ -0,0 +1,181 @@
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+import psutil
+from PIL import Image, ImageDraw
+from google import genai
+from google.genai import types
+import generate_ui_captions
+from fake_gemini_server import FakeGeminiServer
+
+# Runs generate_ui_captions.main against the local fake endpoint for each concurrency setting and
+# reports throughput, latency percentiles, retries, dropped items and peak memory.
+
+# --- Configuration ---
+SAMPLE_DIRECTORY = None # Folder with '_output.png' files, None generates synthetic screens
+NUM_SYNTHETIC_IMAGES = 200
+SEED = 42
+
+# (N_JOBS, BATCH_SIZE) pairs to compare
+CONCURRENCY_SETTINGS = [
+    (8, 240),
+    (16, 240),
+    (32, 240),
+    (64, 240),
+    (32, 60),
+]
+
+SERVER_CONFIG = {
+    "distribution": "lognormal",
+    "median": 1.5,
+    "sigma": 0.4,
+    "bytes_per_second": 5 * 1024 * 1024,
+    "rate_limit_probability": 0.05,
+    "server_error_probability": 0.01,
+}
+
+
+def create_synthetic_screens(target_dir, count):
+    """Writes simple 720x1280 portrait screens with a few blocks so payload sizes are realistic."""
+    screens_dir = Path(target_dir) / "synthetic"
+    screens_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        img = Image.new("RGB", (720, 1280), (245, 245, 245))
+        draw = ImageDraw.Draw(img)
+        for block in range(6):
+            top = 80 + block * 190
+            shade = (i * 37 + block * 53) % 200
+            draw.rectangle([40, top, 680, top + 150], fill=(shade, 120, 255 - shade), outline=(0, 0, 0), width=3)
+            draw.text((60, top + 20), f"Item {i}-{block}", fill=(0, 0, 0))
+        img.save(screens_dir / f"{i}_output.png")
+
+
+class PeakRssSampler:
+    """Samples the process RSS on a background thread, so every setting gets its own peak instead of the lifetime high-water mark."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            if self.stop_event.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop_event.set()
+        self.thread.join()
+        # One last sample covers settings shorter than the interval
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_setting(server, base_dir, n_jobs, batch_size):
+    latencies = []
+    latencies_lock = threading.Lock()
+    process_single_image = generate_ui_captions.process_single_image
+
+    def timed_process_single_image(full_path):
+        start = time.perf_counter()
+        result = process_single_image(full_path)
+        with latencies_lock:
+            latencies.append(time.perf_counter() - start)
+        return result
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_file = os.path.join(output_dir, "captions.jsonl")
+        generate_ui_captions.BASE_DIRECTORY = base_dir
+        generate_ui_captions.OUTPUT_FILE = output_file
+        generate_ui_captions.N_JOBS = n_jobs
+        generate_ui_captions.BATCH_SIZE = batch_size
+        generate_ui_captions.LIMIT = None
+        generate_ui_captions.process_single_image = timed_process_single_image
+
+        server.reset_stats()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            with PeakRssSampler() as rss_sampler:
+                generate_ui_captions.main()
+        finally:
+            elapsed = time.perf_counter() - start
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            generate_ui_captions.process_single_image = process_single_image
+
+        with open(output_file, "r", encoding="utf-8") as f:
+            captioned = sum(1 for _ in f)
+
+    attempted = len(latencies)
+    return {
+        "n_jobs": n_jobs,
+        "batch_size": batch_size,
+        "images_per_second": captioned / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "retries": server.stats["requests"] - attempted,
+        "rate_limited": server.stats["rate_limited"],
+        "server_errors": server.stats["server_errors"],
+        "dropped": attempted - captioned,
+        "peak_memory_mb": peak_memory / (1024 * 1024),
+        # Sampled during this setting only, includes image buffers tracemalloc does not see
+        "peak_rss_mb": rss_sampler.peak / (1024 * 1024),
+    }
+
+
+def print_report(results):
+    header = f"{'N_JOBS':>7} {'BATCH':>6} {'img/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'retries':>8} {'429':>5} {'5xx':>5} {'dropped':>8} {'heap MB':>8} {'RSS MB':>8}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['n_jobs']:>7} {r['batch_size']:>6} {r['images_per_second']:>8.2f} {r['p50']:>7.2f} {r['p95']:>7.2f} "
+            f"{r['p99']:>7.2f} {r['retries']:>8} {r['rate_limited']:>5} {r['server_errors']:>5} {r['dropped']:>8} "
+            f"{r['peak_memory_mb']:>8.1f} {r['peak_rss_mb']:>8.1f}"
+        )
+    best = max(results, key=lambda r: r["images_per_second"])
+    print(f"\nBest throughput: N_JOBS={best['n_jobs']}, BATCH_SIZE={best['batch_size']} ({best['images_per_second']:.2f} img/s, {best['dropped']} dropped)")
+
+
+def main():
+    server = FakeGeminiServer(port=0, seed=SEED, **SERVER_CONFIG).start()
+    # Route the captioning client to the fake endpoint instead of Vertex AI
+    generate_ui_captions.client = genai.Client(api_key="fake-key", http_options=types.HttpOptions(base_url=server.url))
+    print(f"Fake Gemini endpoint running on {server.url}")
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        base_dir = SAMPLE_DIRECTORY
+        if base_dir is None:
+            create_synthetic_screens(synthetic_dir, NUM_SYNTHETIC_IMAGES)
+            base_dir = synthetic_dir + os.sep
+
+        results = []
+        for n_jobs, batch_size in CONCURRENCY_SETTINGS:
+            print(f"\n=== N_JOBS={n_jobs}, BATCH_SIZE={batch_size} ===")
+            results.append(run_setting(server, base_dir, n_jobs, batch_size))
+
+    server.stop()
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+
+# Crash-safe JSONL sink for captions.
+# Every caption is appended as soon as it completes and flushed in groups (FLUSH_EVERY entries or
+# FLUSH_INTERVAL_SECONDS, whichever comes first), so a crash loses at most one group of paid calls.
+# Next to the JSONL a sidecar index keeps the finished filenames (one per line, append-only) and the
+# JSONL byte offset it covers, so resuming reads the small index plus only the JSONL tail written after it.
+
+FLUSH_EVERY = 32
+FLUSH_INTERVAL_SECONDS = 5.0
+
+
+def index_paths(filepath):
+    return f"{filepath}.idx", f"{filepath}.idx.offset"
+
+
+def repair_torn_tail(filepath):
+    """Truncates a partially written last line left behind by a crash. Returns the number of bytes dropped."""
+    if not os.path.exists(filepath):
+        return 0
+    with open(filepath, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return 0
+        # Walk back in chunks until the last complete line
+        position = size
+        while position > 0:
+            chunk_start = max(0, position - 65536)
+            f.seek(chunk_start)
+            chunk = f.read(position - chunk_start)
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                keep = chunk_start + newline + 1
+                break
+            position = chunk_start
+        else:
+            keep = 0
+        f.truncate(keep)
+        return size - keep
+
+
+def read_index_offset(filepath):
+    _, offset_path = index_paths(filepath)
+    try:
+        with open(offset_path, 'r') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def write_index_offset(filepath, offset):
+    _, offset_path = index_paths(filepath)
+    tmp_path = f"{offset_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, offset_path)
+
+
+def scan_jsonl_keys(filepath, start_offset=0):
+    """Yields the filename of every complete entry after start_offset, skipping malformed lines."""
+    with open(filepath, 'rb') as f:
+        f.seek(start_offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                yield json.loads(line)['filename']
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+
+
+def load_progress_index(filepath):
+    """
+    Returns the set of filenames already captioned in filepath.
+    Reads the sidecar index and only parses the JSONL written after the indexed offset, then
+    brings the index up to date so the next resume starts from the end of the file.
+    """
+    processed = set()
+    if not os.path.exists(filepath):
+        return processed
+
+    repair_torn_tail(filepath)
+    index_path, _ = index_paths(filepath)
+    size = os.path.getsize(filepath)
+    offset = read_index_offset(filepath)
+
+    if offset > size or not os.path.exists(index_path):
+        # Index missing or stale (JSONL rewritten), rebuild it from scratch
+        offset = 0
+        open(index_path, 'w').close()
+
+    repair_torn_tail(index_path)
+    with open(index_path, 'r', encoding='utf-8') as f:
+        processed.update(line.rstrip('\n') for line in f if line.strip())
+
+    if offset < size:
+        tail_keys = [key for key in scan_jsonl_keys(filepath, offset) if key not in processed]
+        with open(index_path, 'a', encoding='utf-8') as f:
+            for key in tail_keys:
+                f.write(key + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        processed.update(tail_keys)
+        write_index_offset(filepath, size)
+
+    return processed
+
+
+class CaptionSink:
+    """
+    Thread-safe appender used by the caption workers. Call write() per finished caption and close() at the end.
+    """
+
+    def __init__(self, filepath, flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL_SECONDS):
+        self.filepath = filepath
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.index_path, _ = index_paths(filepath)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.total_written = 0
+
+        # Bring the index in sync with the JSONL before appending anything to either file
+        load_progress_index(filepath)
+        self.data_file = open(filepath, 'ab')
+        self.index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def write(self, entry):
+        with self.lock:
+            self.pending.append(entry)
+            if len(self.pending) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        # Group commit: one write + fsync for the whole group, index only after the data is durable
+        payload = b''.join((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8') for entry in self.pending)
+        self.data_file.write(payload)
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+
+        self.index_file.write(''.join(entry['filename'] + '\n' for entry in self.pending))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        write_index_offset(self.filepath, self.data_file.tell())
+
+        self.total_written += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.data_file.close()
+            self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
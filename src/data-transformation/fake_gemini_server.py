@@ -0,0 +1,121 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Gemini generateContent endpoint, used to benchmark the captioning path
+# without spending quota. Point a genai.Client at it with http_options=types.HttpOptions(base_url=server.url).
+
+# --- Configuration ---
+HOST = "127.0.0.1"
+PORT = 8089
+LATENCY_DISTRIBUTION = "lognormal" # "constant", "exponential" or "lognormal"
+LATENCY_MEDIAN_SECONDS = 1.5
+LATENCY_SIGMA = 0.4 # Spread of the lognormal distribution
+UPLOAD_BYTES_PER_SECOND = 5 * 1024 * 1024 # Payload-size-dependent delay
+RATE_LIMIT_PROBABILITY = 0.05 # Share of requests answered with 429
+SERVER_ERROR_PROBABILITY = 0.01 # Share of requests answered with 503
+
+FAKE_CAPTION = (
+    "High-fidelity single screen mobile app UI design, no border, edge-to-edge view of a sign-in page. "
+    "The background is a solid matte black with a clean white input field and an electric lime button."
+)
+
+
+def sample_latency(distribution, median, sigma, rng):
+    if distribution == "constant":
+        return median
+    if distribution == "exponential":
+        # Exponential with the requested median
+        return rng.expovariate(0.6931471805599453 / median)
+    if distribution == "lognormal":
+        return rng.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution '{distribution}'")
+
+
+class FakeGeminiServer:
+    """Threaded HTTP server answering every `:generateContent` POST after a simulated delay."""
+
+    def __init__(self, host=HOST, port=PORT, distribution=LATENCY_DISTRIBUTION, median=LATENCY_MEDIAN_SECONDS,
+                 sigma=LATENCY_SIGMA, bytes_per_second=UPLOAD_BYTES_PER_SECOND, rate_limit_probability=RATE_LIMIT_PROBABILITY,
+                 server_error_probability=SERVER_ERROR_PROBABILITY, seed=None):
+        self.distribution = distribution
+        self.median = median
+        self.sigma = sigma
+        self.bytes_per_second = bytes_per_second
+        self.rate_limit_probability = rate_limit_probability
+        self.server_error_probability = server_error_probability
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, payload = server.handle(self.path, body)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                return
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"requests": 0, "rate_limited": 0, "server_errors": 0, "bytes_received": 0}
+
+    def handle(self, path, body):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_received"] += len(body)
+            latency = sample_latency(self.distribution, self.median, self.sigma, self.rng)
+            roll = self.rng.random()
+
+        if not path.endswith(":generateContent"):
+            return 404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}}
+
+        time.sleep(latency + len(body) / self.bytes_per_second)
+
+        if roll < self.rate_limit_probability:
+            with self.lock:
+                self.stats["rate_limited"] += 1
+            return 429, {"error": {"code": 429, "message": "Resource exhausted.", "status": "RESOURCE_EXHAUSTED"}}
+        if roll < self.rate_limit_probability + self.server_error_probability:
+            with self.lock:
+                self.stats["server_errors"] += 1
+            return 503, {"error": {"code": 503, "message": "Service unavailable.", "status": "UNAVAILABLE"}}
+
+        return 200, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": FAKE_CAPTION}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": 258, "candidatesTokenCount": 40, "totalTokenCount": 298},
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    fake_server = FakeGeminiServer()
+    print(f"Fake Gemini endpoint listening on {fake_server.url}")
+    fake_server.httpd.serve_forever()
@@ -1,23 +1,31 @@
 import os
-import json
 import time
 from tqdm import tqdm
 from joblib import Parallel, delayed
 from google import genai
 from google.genai import types
-from utils import image_from_filepath
+from utils import image_from_filepath, encode_image_payload
+from caption_sink import CaptionSink, load_progress_index
 
 # Using oauth2 config see https://ai.google.dev/palm_docs/oauth_quickstart
 # Read default config from /home/your-user/.config/gcloud/application_default_credentials.json
 # set env variable GOOGLE_APPLICATION_CREDENTIALS if necessary
-client = genai.Client(
-    vertexai=True
-) 
+# The client is created on first use so helpers can be imported without credentials
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        client = genai.Client(
+            vertexai=True
+        )
+    return client
 
 
 # --- Configuration ---
 BASE_DIRECTORY = "/scratch/delineo_data/train/"
 OUTPUT_FILE = "./ui_captions_dataset.jsonl"
+MODEL_NAME = "gemini-2.0-flash"
 
 N_JOBS = -1
 BATCH_SIZE = 240
@@ -26,6 +34,13 @@ BATCH_SIZE = 240
 # Set to None (or 0) to run the full dataset.
 LIMIT = -1
 
+# Upload payload: images are re-encoded before being sent to Gemini.
+# Set PAYLOAD_FORMAT to None to upload the full-resolution image as-is (lossless PNG).
+PAYLOAD_FORMAT = "JPEG" # "JPEG" or "WEBP"
+PAYLOAD_QUALITY = 85
+PAYLOAD_MAX_EDGE = 1024 # Longest edge in pixels, None keeps the original size
+PAYLOAD_CROP = None # Optional (left, upper, right, lower) box applied before resizing
+
 SYSTEM_INSTRUCTION = """
 You are an expert UI/UX designer and prompt engineer creating training captions for a mobile UI generation model. 
 Your task is to analyze the provided mobile screenshot and write a dense, visually descriptive caption that would allow a designer to recreate the interface exactly.
@@ -88,24 +103,31 @@ def gather_all_images(base_dir):
 
 
 
-def process_single_image(full_path):
-    relative_path = os.path.relpath(full_path, BASE_DIRECTORY)
-    cropped_image = image_from_filepath(full_path)
-    if not cropped_image:
-        print(f'fail crop {relative_path}')
-        return None
+def prepare_payload(image, image_format=PAYLOAD_FORMAT, quality=PAYLOAD_QUALITY, max_edge=PAYLOAD_MAX_EDGE, crop_box=PAYLOAD_CROP):
+    """
+    Builds the image part sent to Gemini. With image_format=None the PIL image is passed through untouched.
+    """
+    if image_format is None:
+        return image
+    data = encode_image_payload(image, max_edge=max_edge, image_format=image_format, quality=quality, crop_box=crop_box)
+    return types.Part.from_bytes(data=data, mime_type=f"image/{image_format.lower()}")
+
+
+def clean_caption(text):
+    return text.strip().replace("```", "").replace("\n", " ")
 
+
+def request_caption(payload, relative_path):
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                contents=[cropped_image], 
+            response = get_client().models.generate_content(
+                model=MODEL_NAME,
+                contents=[payload], 
                 config=generation_config
             )
             
-            caption = response.text.strip().replace("```", "").replace("\n", " ")
-            return {"filename": relative_path, "caption": caption}
+            return clean_caption(response.text)
             
         except Exception as e:
             # Simple error handling for rate limits or server errors
@@ -117,23 +139,22 @@ def process_single_image(full_path):
                 break
     return None
 
-def append_to_jsonl(data_list, filepath):
-    with open(filepath, 'a', encoding='utf-8') as f:
-        for entry in data_list:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+def process_single_image(full_path):
+    relative_path = os.path.relpath(full_path, BASE_DIRECTORY)
+    cropped_image = image_from_filepath(full_path)
+    if not cropped_image:
+        print(f'fail crop {relative_path}')
+        return None
+
+    caption = request_caption(prepare_payload(cropped_image), relative_path)
+    if caption is None:
+        return None
+    return {"filename": relative_path, "caption": caption}
 
 def load_existing_progress(filepath):
-    processed = set()
-    if not os.path.exists(filepath):
-        return processed
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                entry = json.loads(line)
-                processed.add(entry['filename'])
-            except json.JSONDecodeError:
-                continue
-    return processed
+    # Reads the sidecar progress index instead of re-parsing every caption, see caption_sink.py
+    return load_progress_index(filepath)
 
 def main():
     all_file_paths = gather_all_images(BASE_DIRECTORY)
@@ -159,20 +180,25 @@ def main():
         return
 
     total_newly_processed = 0
-    
-    for i in range(0, len(files_to_process), BATCH_SIZE):
-        batch_paths = files_to_process[i : i + BATCH_SIZE]
-        
-        batch_results = Parallel(n_jobs=N_JOBS, prefer="threads")(
-            delayed(process_single_image)(p) for p in tqdm(batch_paths, desc=f"Batch {i//BATCH_SIZE + 1}", leave=False)
-        )
-        
-        valid_results = [res for res in batch_results if res is not None]
-        
-        if valid_results:
-            append_to_jsonl(valid_results, OUTPUT_FILE)
-            total_newly_processed += len(valid_results)
-            print(f"   Saved {len(valid_results)} new captions. (Total this run: {total_newly_processed})")
+
+    # Captions are appended to the sink as each request completes, not when the whole batch ends
+    with CaptionSink(OUTPUT_FILE) as sink:
+        for i in range(0, len(files_to_process), BATCH_SIZE):
+            batch_paths = files_to_process[i : i + BATCH_SIZE]
+            
+            batch_results = Parallel(n_jobs=N_JOBS, prefer="threads", return_as="generator_unordered")(
+                delayed(process_single_image)(p) for p in batch_paths
+            )
+            
+            saved_in_batch = 0
+            for res in tqdm(batch_results, total=len(batch_paths), desc=f"Batch {i//BATCH_SIZE + 1}", leave=False):
+                if res is not None:
+                    sink.write(res)
+                    saved_in_batch += 1
+
+            if saved_in_batch:
+                total_newly_processed += saved_in_batch
+                print(f"   Saved {saved_in_batch} new captions. (Total this run: {total_newly_processed})")
 
     print(f"\n✅ Finished! Added {total_newly_processed} new captions to {OUTPUT_FILE}")
 
@@ -29,8 +29,9 @@ VALIDATION_SAMPLES = (
 )
 
 # --- DRAWING UTILS ---
-BG_COLOR = (0, 0, 0)
-CONTRAST_COLOR = (255, 255, 255)
+# Sketches are single-channel: white strokes on a black background
+BG_COLOR = 0
+CONTRAST_COLOR = 255
 AVG_CHAR_WIDTH_PIXELS = 13
 MIN_SEMANTIC_ELEMENTS = 3
 MAX_SEMANTIC_ELEMENTS = 15 # Many elements were noticed to create noisy sketches
@@ -404,7 +405,7 @@ def process_single_item(item):
         width = int(mud_data.get('width', ui_width))
         height = int(mud_data.get('height', ui_height))
         
-        output_canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        output_canvas = np.zeros((height, width), dtype=np.uint8)
         if not mud_data['views']: return False
         
         traverse_and_draw(0, mud_data['views'], output_canvas)
@@ -436,16 +437,15 @@ def process_single_item(item):
         # 6. Export
         export_base_path = OUTPUT_VALIDATION_DIR if sample_id in VALIDATION_SAMPLES else OUTPUT_TRAIN_DIR
         
-        # Save X (Input)
+        # Save X (Input) as a grayscale PNG
         output_path_x = os.path.join(export_base_path, f"{sample_id}_input.png")
-        canvas_bgr = cv2.cvtColor(canvas_with_noise, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(output_path_x, canvas_bgr)
+        cv2.imwrite(output_path_x, canvas_with_noise)
 
         # Save Y (Target)
         output_path_y = os.path.join(export_base_path, f"{sample_id}_output.png")
         cv2.imwrite(output_path_y, ui_final)
         
-        return True
+        return (output_path_x, output_path_y)
 
     except Exception as e:
         print(f"Error processing {sample_id}: {e}")
@@ -466,7 +466,7 @@ def main():
         delayed(process_single_item)(item) for item in tqdm(input_batch, desc="Processing Items")
     )
 
-    processed_count = sum(results)
+    processed_count = sum(1 for r in results if r)
     skipped_count = len(input_batch) - processed_count
 
     print("\n--- DATA BATCH PROCESSING CONCLUDED ---")
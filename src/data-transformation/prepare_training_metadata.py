@@ -21,12 +21,30 @@ def get_file_id(input_name, ds_name):
     return input_name.replace("_input.png", "")
 
 
+def make_metadata_entry(input_filename, output_filename, caption):
+    if not caption or caption == INVALID_UI:
+        return None
+    return {
+        "input_file_name": input_filename,  # INPUT (Swire human sketch)
+        "output_file_name": output_filename,     # TARGET (Rico UI)
+        "text": caption
+    }
+
+
+def remove_invalid_sample(input_filename, output_filename):
+    """Deletes the files of a pair captioned as INVALID_UI, names are relative to DATA_ROOT."""
+    for filename in (input_filename, output_filename):
+        try:
+            os.remove(DATA_ROOT / filename)
+        except FileNotFoundError:
+            continue
+
+
 def process_dataset(dir, valid_pairs, dataset_name):
     if not dir.exists():
         print(f"Warning: '{dataset_name}' directory not found at {dir}")
         return
     
-    invalid_samples = set()
     input_files = list(dir.glob("*_input.png"))
     print(f"Scanning '{dataset_name}': Found {len(input_files)} input candidates.")
 
@@ -40,22 +58,15 @@ def process_dataset(dir, valid_pairs, dataset_name):
         output_path = dir / output_name
         output_filename = f"{dataset_name}/{output_name}"
         caption = captions_map.get(output_filename)
-        if not caption or caption == INVALID_UI:
-            invalid_samples.update([input_filename, output_filename])
+        if caption == INVALID_UI:
+            remove_invalid_sample(input_filename, output_filename)
             continue
+        entry = make_metadata_entry(input_filename, output_filename, caption)
+        if entry is None:
+            continue # Not captioned yet, kept for the next captioning pass
         
         if output_path.exists():
-            valid_pairs.append({
-                "input_file_name": input_filename,  # INPUT (Swire human sketch)
-                "output_file_name": output_filename,     # TARGET (Rico UI)
-                "text": caption
-            })
-    
-    for invalid_swire in invalid_samples:
-        try:
-            os.remove(dir / invalid_swire)
-        except:
-            continue
+            valid_pairs.append(entry)
 
 
 def main():
@@ -0,0 +1,244 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from joblib import Parallel, delayed
+from tqdm import tqdm
+import generate_ui_captions
+from caption_sink import CaptionSink
+from prepare_training_metadata import DATA_ROOT, INVALID_UI, make_metadata_entry, remove_invalid_sample
+from utils import load_ui_captions_map
+
+# Streaming runner for the whole data pipeline.
+# The MUD/Swire/VINS workers publish every finished (input, output) pair to a queue while they render.
+# The captioner consumes that queue concurrently, so network-bound captioning overlaps CPU-bound
+# rendering, and metadata rows are appended as soon as both the pair and its caption exist.
+# Wall time approaches max(render, caption) instead of their sum.
+# Pairs captioned as invalid are deleted, as prepare_training_metadata.py does. Pairs whose caption request failed
+# are kept on disk, retried once at the end and otherwise left for the next run. Rows go to a temporary
+# file, merged at the end with the still valid rows of the previous metadata.jsonl and renamed into place,
+# so an interrupted run leaves the previous metadata untouched.
+
+# --- Configuration ---
+DATASETS = ("mud", "swire", "vins")
+CAPTION_WORKERS = 32
+METADATA_FILE = DATA_ROOT / "metadata.jsonl"
+
+_DONE = object()
+
+
+# --- PRODUCERS ---
+
+def mud_jobs():
+    import mud_preprocessing
+    filtered_data = mud_preprocessing.get_valid_input_data()
+    input_batch = random.sample(filtered_data, min(mud_preprocessing.SAMPLE_SIZE, len(filtered_data)))
+    return mud_preprocessing.NUM_CPUS, [delayed(mud_preprocessing.process_single_item)(item) for item in input_batch]
+
+
+def vins_jobs():
+    import vins_preprocessing
+    if not vins_preprocessing.VINS_ROOT.exists():
+        print(f"❌ VINS_ROOT not found at: {vins_preprocessing.VINS_ROOT}")
+        return vins_preprocessing.NUM_CPUS, []
+    filtered_data = vins_preprocessing.get_valid_input_data()
+    return vins_preprocessing.NUM_CPUS, [delayed(vins_preprocessing.process_single_item)(item) for item in filtered_data]
+
+
+def swire_jobs():
+    import swire_preprocessing
+    swire_dir, rico_dir, out_train_dir, out_validation_dir = swire_preprocessing.setup_paths()
+    if not swire_dir.exists() or not rico_dir.exists():
+        print(f"❌ Error: Swire or Rico directory not found at {swire_dir}, {rico_dir}")
+        return swire_preprocessing.N_JOBS, []
+    out_train_dir.mkdir(parents=True, exist_ok=True)
+    out_validation_dir.mkdir(parents=True, exist_ok=True)
+    return swire_preprocessing.N_JOBS, [
+        delayed(swire_preprocessing.process_single_pair)(p, rico_dir, out_train_dir, out_validation_dir)
+        for p in swire_dir.glob("*.jpg")
+    ]
+
+
+JOB_BUILDERS = {
+    "mud": mud_jobs,
+    "swire": swire_jobs,
+    "vins": vins_jobs,
+}
+
+
+def produce_pairs(pair_queue, datasets=DATASETS):
+    """Runs the preprocessing workers dataset by dataset and publishes each finished pair as it completes."""
+    try:
+        for dataset_name in datasets:
+            n_jobs, jobs = JOB_BUILDERS[dataset_name]()
+            print(f"--- RENDERING {len(jobs)} {dataset_name.upper()} ITEMS ---")
+            results = Parallel(n_jobs=n_jobs, backend="loky", return_as="generator_unordered")(jobs)
+            for result in results:
+                # Workers return (input_path, output_path) on success, False or a SKIP/ERROR message otherwise
+                if isinstance(result, tuple):
+                    pair_queue.put((dataset_name, *result))
+    finally:
+        pair_queue.put(_DONE)
+
+
+# --- CONSUMER ---
+
+class StreamingCaptioner:
+    """
+    Captions every published target once (Swire sketches from several designers share one target) and
+    appends a metadata row for each pair whose caption is available.
+    """
+
+    def __init__(self, sink, metadata_file, known_captions, max_workers=CAPTION_WORKERS):
+        self.sink = sink
+        self.metadata_file = metadata_file
+        self.captions = dict(known_captions)
+        self.waiting_inputs = {}
+        self.in_flight = set()
+        # Target -> inputs of the pairs whose caption request failed
+        self.uncaptioned = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.written_inputs = set()
+        self.rows_written = 0
+        self.captioned = 0
+
+    def submit(self, dataset_name, input_path, output_path):
+        output_path = Path(output_path)
+        train_root = Path(generate_ui_captions.BASE_DIRECTORY)
+        if train_root not in output_path.parents:
+            return # Validation samples are not captioned nor added to the training metadata
+
+        input_filename = f"{dataset_name}/{Path(input_path).name}"
+        output_filename = os.path.relpath(output_path, train_root)
+        with self.lock:
+            if output_filename in self.captions:
+                self._write_row(input_filename, output_filename, self.captions[output_filename])
+                return
+            self.waiting_inputs.setdefault(output_filename, []).append(input_filename)
+            if output_filename in self.in_flight:
+                return
+            self.in_flight.add(output_filename)
+            self.futures.append(self.executor.submit(self._caption, str(output_path), output_filename))
+
+    def _caption(self, full_path, output_filename):
+        result = generate_ui_captions.process_single_image(full_path)
+        caption = result["caption"] if result else None
+        if result:
+            self.sink.write(result)
+        with self.lock:
+            self.in_flight.discard(output_filename)
+            waiting = self.waiting_inputs.pop(output_filename, [])
+            if caption is None:
+                # A failed request (timeout, rate limit, server error), the files stay for a retry
+                self.uncaptioned.setdefault(output_filename, []).extend(waiting)
+                return
+            self.captions[output_filename] = caption
+            self.captioned += 1
+            for input_filename in waiting + self.uncaptioned.pop(output_filename, []):
+                self._write_row(input_filename, output_filename, caption)
+
+    def _write_row(self, input_filename, output_filename, caption):
+        if caption == INVALID_UI:
+            remove_invalid_sample(input_filename, output_filename)
+            return
+        entry = make_metadata_entry(input_filename, output_filename, caption)
+        if entry is None:
+            return # An empty caption, kept out of the metadata without deleting the pair
+        self.metadata_file.write(json.dumps(entry) + '\n')
+        self.metadata_file.flush()
+        self.written_inputs.add(input_filename)
+        self.rows_written += 1
+
+    def _wait(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            # Re-raises the exceptions of the caption workers
+            future.result()
+
+    def retry_uncaptioned(self):
+        """Captions once more the targets whose request failed, once every other request is done."""
+        self._wait()
+        train_root = Path(generate_ui_captions.BASE_DIRECTORY)
+        with self.lock:
+            failed, self.uncaptioned = self.uncaptioned, {}
+            for output_filename, input_filenames in failed.items():
+                self.waiting_inputs[output_filename] = input_filenames
+                self.in_flight.add(output_filename)
+                self.futures.append(
+                    self.executor.submit(self._caption, str(train_root / output_filename), output_filename)
+                )
+        self._wait()
+
+    def num_uncaptioned(self):
+        return sum(len(input_filenames) for input_filenames in self.uncaptioned.values())
+
+    def close(self):
+        try:
+            self._wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+def merge_previous_metadata(metadata_file, previous_path, written_inputs):
+    """Appends the rows of previous_path that were not rewritten by this run and whose files still exist."""
+    if not previous_path.exists():
+        return 0
+    kept = 0
+    with open(previous_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry["input_file_name"] in written_inputs:
+                continue
+            if not (DATA_ROOT / entry["input_file_name"]).exists() or not (DATA_ROOT / entry["output_file_name"]).exists():
+                continue
+            metadata_file.write(json.dumps(entry) + '\n')
+            kept += 1
+    return kept
+
+
+def main():
+    start = time.perf_counter()
+    known_captions = load_ui_captions_map(generate_ui_captions.OUTPUT_FILE)
+    pair_queue = queue.Queue()
+
+    producer = threading.Thread(target=produce_pairs, args=(pair_queue, DATASETS), daemon=True)
+    producer.start()
+
+    tmp_metadata_path = METADATA_FILE.with_name(f"{METADATA_FILE.name}.tmp")
+    with CaptionSink(generate_ui_captions.OUTPUT_FILE) as sink, open(tmp_metadata_path, 'w') as metadata_file:
+        captioner = StreamingCaptioner(sink, metadata_file, known_captions)
+        progress = tqdm(desc="Pairs received", unit="pair")
+        while True:
+            item = pair_queue.get()
+            if item is _DONE:
+                break
+            captioner.submit(*item)
+            progress.update(1)
+        progress.close()
+        captioner.retry_uncaptioned()
+        captioner.close()
+        kept_rows = merge_previous_metadata(metadata_file, METADATA_FILE, captioner.written_inputs)
+        metadata_file.flush()
+        os.fsync(metadata_file.fileno())
+    os.replace(tmp_metadata_path, METADATA_FILE)
+
+    producer.join()
+    print(f"\n✅ Pipeline finished in {time.perf_counter() - start:.1f}s")
+    print(f"New captions: {captioner.captioned}")
+    print(f"Metadata rows written to {METADATA_FILE}: {captioner.rows_written} new, {kept_rows} kept from the previous run")
+    if captioner.num_uncaptioned():
+        print(f"⚠️ {captioner.num_uncaptioned()} pairs still have no caption after a retry, rerun to caption them")
+
+
+if __name__ == "__main__":
+    main()
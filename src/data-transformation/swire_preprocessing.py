@@ -1,4 +1,5 @@
 import cv2
+import os
 from pathlib import Path
 from joblib import Parallel, delayed
 from tqdm import tqdm
@@ -57,6 +58,7 @@ def setup_paths():
 def process_single_pair(swire_path, rico_dir, out_train_dir, out_validation_dir):
     """
     Worker function to process a single image pair.
+    Returns the exported (input, output) paths, or a SKIP/ERROR message.
     """
     try:
         filename = swire_path.name
@@ -75,7 +77,7 @@ def process_single_pair(swire_path, rico_dir, out_train_dir, out_validation_dir)
             return f"SKIP: No match for ID {rico_id}"
 
         # 3. Load Images
-        img_swire = cv2.imread(str(swire_path))
+        img_swire = cv2.imread(str(swire_path), cv2.IMREAD_GRAYSCALE)
         img_rico = cv2.imread(str(rico_path))
 
         if img_swire is None or img_rico is None:
@@ -91,10 +93,16 @@ def process_single_pair(swire_path, rico_dir, out_train_dir, out_validation_dir)
         # Save
         export_dir = out_validation_dir if rico_id in SWIRE_VALIDATION_SAMPLES else out_train_dir
         compression_params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
-        cv2.imwrite(str(export_dir / f"{swire_path.stem}_input.png"), swire_resized, compression_params)
-        cv2.imwrite(str(export_dir / f"{rico_id}_output.png"), rico_resized, compression_params)
+        input_path = export_dir / f"{swire_path.stem}_input.png"
+        output_path = export_dir / f"{rico_id}_output.png"
+        cv2.imwrite(str(input_path), swire_resized, compression_params)
+        # Sketches of several designers share this target and rewrite it while run_pipeline.py may be captioning it,
+        # so it is replaced in one step and readers never see a partial file
+        tmp_output_path = export_dir / f"{rico_id}_output.{os.getpid()}.tmp.png"
+        cv2.imwrite(str(tmp_output_path), rico_resized, compression_params)
+        os.replace(tmp_output_path, output_path)
 
-        return None
+        return (str(input_path), str(output_path))
 
     except Exception as e:
         return f"EXCEPTION: {filename} - {str(e)}"
@@ -137,8 +145,8 @@ def main():
     )
 
     # 4. Reporting
-    skipped = [r for r in results if r and r.startswith("SKIP")]
-    errors = [r for r in results if r and (r.startswith("ERROR") or r.startswith("EXCEPTION"))]
+    skipped = [r for r in results if isinstance(r, str) and r.startswith("SKIP")]
+    errors = [r for r in results if isinstance(r, str) and (r.startswith("ERROR") or r.startswith("EXCEPTION"))]
     success_count = len(results) - len(skipped) - len(errors)
 
     print(f"\n--- Processing Complete ---")
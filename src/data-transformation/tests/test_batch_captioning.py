@@ -0,0 +1,157 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("google.genai")
+import batch_captioning
+from batch_captioning import LocalBatchService, run_batch_captioning
+from generate_ui_captions import SYSTEM_INSTRUCTION, load_existing_progress
+
+
+def make_screens(base_dir, count):
+    paths = []
+    for i in range(count):
+        screen_dir = base_dir / f"screen-{i}"
+        screen_dir.mkdir(parents=True)
+        path = screen_dir / f"{i}_output.png"
+        # Portrait and at least 720 pixels wide, as image_from_filepath requires
+        Image.new('RGB', (720, 1280), (i, i, i)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def read_captions(output_file):
+    with open(output_file, 'r', encoding='utf-8') as f:
+        return {row['filename']: row['caption'] for row in map(json.loads, f)}
+
+
+@pytest.fixture
+def base_dir(tmp_path, monkeypatch):
+    base_dir = tmp_path / "train"
+    monkeypatch.setattr(batch_captioning, "BASE_DIRECTORY", str(base_dir))
+    return base_dir
+
+
+def test_submit_ingest_and_retry_failures(tmp_path, base_dir):
+    paths = make_screens(base_dir, 3)
+    failing_key = os.path.relpath(paths[1], base_dir)
+    attempts = []
+
+    def responder(request):
+        # Every request carries the system instruction and the generation config
+        assert request["systemInstruction"]["parts"][0]["text"] == SYSTEM_INSTRUCTION
+        assert request["generationConfig"]["maxOutputTokens"] > 0
+        attempts.append(request)
+        if len(attempts) == 2:
+            raise RuntimeError("RESOURCE_EXHAUSTED")
+        return f"High-fidelity caption {len(attempts)}\n"
+
+    output_file = tmp_path / "captions.jsonl"
+    service = LocalBatchService(tmp_path / "service", responder)
+    remaining = run_batch_captioning(paths, service, work_dir=tmp_path / "work", output_file=str(output_file))
+
+    assert remaining == []
+    # The failed row went into a retry batch of its own
+    assert len(attempts) == 4
+    captions = read_captions(output_file)
+    assert set(captions) == {os.path.relpath(path, base_dir) for path in paths}
+    assert captions[failing_key] == "High-fidelity caption 4"
+    assert load_existing_progress(str(output_file)) == set(captions)
+
+
+def test_rows_failing_every_round_are_returned(tmp_path, base_dir):
+    paths = make_screens(base_dir, 2)
+
+    def responder(request):
+        raise RuntimeError("INTERNAL")
+
+    output_file = tmp_path / "captions.jsonl"
+    remaining = run_batch_captioning(
+        paths,
+        LocalBatchService(tmp_path / "service", responder),
+        work_dir=tmp_path / "work",
+        output_file=str(output_file),
+        max_rounds=2,
+    )
+
+    assert sorted(remaining) == sorted(os.path.relpath(path, base_dir) for path in paths)
+    assert load_existing_progress(str(output_file)) == set()
+
+
+def test_resume_skips_captioned_screens(tmp_path, base_dir):
+    paths = make_screens(base_dir, 3)
+    output_file = tmp_path / "captions.jsonl"
+    service = LocalBatchService(tmp_path / "service", lambda request: "caption")
+    run_batch_captioning(paths[:2], service, work_dir=tmp_path / "work", output_file=str(output_file))
+
+    # What main() submits on the next run
+    processed = load_existing_progress(str(output_file))
+    pending = [path for path in paths if os.path.relpath(path, base_dir) not in processed]
+    assert pending == paths[2:]
+
+    run_batch_captioning(pending, service, work_dir=tmp_path / "work", output_file=str(output_file))
+    assert set(read_captions(output_file)) == {os.path.relpath(path, base_dir) for path in paths}
+
+
+class RecordingBatchService(LocalBatchService):
+    """Records the service calls and keeps the first job running for one extra poll."""
+
+    def __init__(self, root_dir, responder):
+        super().__init__(root_dir, responder)
+        self.calls = []
+        self.polls = {}
+
+    def submit(self, request_path, job_name):
+        job_id = super().submit(request_path, job_name)
+        self.calls.append(("submit", job_id))
+        return job_id
+
+    def state(self, job_id):
+        self.polls[job_id] = self.polls.get(job_id, 0) + 1
+        first_job = next(job for call, job in self.calls if call == "submit")
+        if job_id == first_job and self.polls[job_id] == 1:
+            return "JOB_STATE_RUNNING"
+        return super().state(job_id)
+
+    def download_results(self, job_id, local_dir):
+        self.calls.append(("download", job_id))
+        return super().download_results(job_id, local_dir)
+
+
+def test_shards_are_submitted_before_waiting(tmp_path, base_dir, monkeypatch):
+    monkeypatch.setattr(batch_captioning, "REQUESTS_PER_FILE", 1)
+    monkeypatch.setattr(batch_captioning, "POLL_INTERVAL_SECONDS", 0)
+    paths = make_screens(base_dir, 3)
+    output_file = tmp_path / "captions.jsonl"
+    service = RecordingBatchService(tmp_path / "service", lambda request: "caption")
+    remaining = run_batch_captioning(paths, service, work_dir=tmp_path / "work", output_file=str(output_file))
+
+    assert remaining == []
+    assert set(read_captions(output_file)) == {os.path.relpath(path, base_dir) for path in paths}
+    kinds = [call for call, _ in service.calls]
+    assert kinds == ["submit"] * 3 + ["download"] * 3
+    # The job still running is downloaded after the ones that finished first
+    first_job = service.calls[0][1]
+    assert service.calls[-1] == ("download", first_job)
+
+
+def test_unloadable_images_are_counted_as_missing(tmp_path, base_dir):
+    paths = make_screens(base_dir, 2)
+    # Landscape screens are rejected by image_from_filepath
+    Image.new('RGB', (1280, 720)).save(paths[0])
+    attempts = []
+
+    def responder(request):
+        attempts.append(request)
+        return "caption"
+
+    output_file = tmp_path / "captions.jsonl"
+    remaining = run_batch_captioning(
+        paths, LocalBatchService(tmp_path / "service", responder), work_dir=tmp_path / "work", output_file=str(output_file)
+    )
+
+    assert remaining == [os.path.relpath(paths[0], base_dir)]
+    assert len(attempts) == 1
+    assert set(read_captions(output_file)) == {os.path.relpath(paths[1], base_dir)}
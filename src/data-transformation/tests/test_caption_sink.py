@@ -0,0 +1,57 @@
+import json
+import os
+
+from caption_sink import CaptionSink, index_paths, load_progress_index, read_index_offset
+
+
+def write_captions(filepath, names, **kwargs):
+    with CaptionSink(str(filepath), **kwargs) as sink:
+        for name in names:
+            sink.write({"filename": name, "caption": f"caption of {name}"})
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    filepath = tmp_path / "captions.jsonl"
+    write_captions(filepath, ["a.png", "b.png"])
+    # A crash in the middle of a write
+    with open(filepath, 'ab') as f:
+        f.write(b'{"filename": "c.png", "capt')
+
+    assert load_progress_index(str(filepath)) == {"a.png", "b.png"}
+    write_captions(filepath, ["c.png"])
+    with open(filepath, 'r', encoding='utf-8') as f:
+        assert [json.loads(line)["filename"] for line in f] == ["a.png", "b.png", "c.png"]
+
+
+def test_resume_reads_only_the_unindexed_tail(tmp_path):
+    filepath = tmp_path / "captions.jsonl"
+    write_captions(filepath, ["a.png"])
+    # Appended by a process that died before updating the index
+    with open(filepath, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"filename": "b.png", "caption": "x"}) + '\n')
+
+    assert read_index_offset(str(filepath)) < filepath.stat().st_size
+    assert load_progress_index(str(filepath)) == {"a.png", "b.png"}
+    assert read_index_offset(str(filepath)) == filepath.stat().st_size
+    index_path, _ = index_paths(str(filepath))
+    with open(index_path, 'r', encoding='utf-8') as f:
+        assert f.read().split() == ["a.png", "b.png"]
+
+
+def test_index_rebuilt_when_missing(tmp_path):
+    filepath = tmp_path / "captions.jsonl"
+    write_captions(filepath, ["a.png", "b.png"])
+    for path in index_paths(str(filepath)):
+        os.remove(path)
+
+    assert load_progress_index(str(filepath)) == {"a.png", "b.png"}
+
+
+def test_group_commit_flushes_on_count(tmp_path):
+    filepath = tmp_path / "captions.jsonl"
+    sink = CaptionSink(str(filepath), flush_every=2, flush_interval=3600)
+    sink.write({"filename": "a.png", "caption": "x"})
+    assert filepath.stat().st_size == 0
+    sink.write({"filename": "b.png", "caption": "y"})
+    assert load_progress_index(str(filepath)) == {"a.png", "b.png"}
+    sink.close()
@@ -0,0 +1,99 @@
+import io
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("google.genai")
+import generate_ui_captions
+import prepare_training_metadata
+from prepare_training_metadata import INVALID_UI
+from run_pipeline import StreamingCaptioner
+
+
+@pytest.fixture
+def data_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_ui_captions, "BASE_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(prepare_training_metadata, "DATA_ROOT", tmp_path)
+    (tmp_path / "swire").mkdir()
+    return tmp_path
+
+
+def make_pair(data_root, input_name, output_name):
+    for name in (input_name, output_name):
+        (data_root / "swire" / name).write_bytes(b"png")
+    return "swire", str(data_root / "swire" / input_name), str(data_root / "swire" / output_name)
+
+
+class FakeSink:
+    def __init__(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+
+def run_captioner(monkeypatch, pairs, captions, known_captions=()):
+    """Captions `pairs` with `captions`, a target -> list of results of its successive requests."""
+    lock = threading.Lock()
+
+    def process_single_image(full_path):
+        filename = f"swire/{full_path.rsplit('/', 1)[1]}"
+        with lock:
+            caption = captions[filename].pop(0)
+        if isinstance(caption, Exception):
+            raise caption
+        return None if caption is None else {"filename": filename, "caption": caption}
+
+    monkeypatch.setattr(generate_ui_captions, "process_single_image", process_single_image)
+    metadata_file = io.StringIO()
+    captioner = StreamingCaptioner(FakeSink(), metadata_file, dict(known_captions), max_workers=4)
+    for pair in pairs:
+        captioner.submit(*pair)
+    captioner.retry_uncaptioned()
+    captioner.close()
+    rows = [json.loads(line) for line in metadata_file.getvalue().splitlines()]
+    return captioner, {row["input_file_name"]: row["text"] for row in rows}
+
+
+def test_failed_request_keeps_the_pair_and_is_retried(data_root, monkeypatch):
+    pairs = [make_pair(data_root, "1_a_input.png", "1_output.png"), make_pair(data_root, "2_a_input.png", "2_output.png")]
+    captioner, rows = run_captioner(
+        monkeypatch, pairs, {"swire/1_output.png": [None, "a login screen"], "swire/2_output.png": [None, None]}
+    )
+
+    assert rows == {"swire/1_a_input.png": "a login screen"}
+    # Still failing after the retry: left on disk for the next run, not deleted
+    assert captioner.num_uncaptioned() == 1
+    assert (data_root / "swire" / "2_a_input.png").exists()
+    assert (data_root / "swire" / "2_output.png").exists()
+
+
+def test_invalid_caption_deletes_every_pair_of_the_target(data_root, monkeypatch):
+    pairs = [
+        make_pair(data_root, "1_a_input.png", "1_output.png"),
+        make_pair(data_root, "1_b_input.png", "1_output.png"),
+    ]
+    captioner, rows = run_captioner(monkeypatch, pairs, {"swire/1_output.png": [INVALID_UI]})
+
+    assert rows == {}
+    assert captioner.num_uncaptioned() == 0
+    assert not any((data_root / "swire").iterdir())
+
+
+def test_shared_target_is_captioned_once(data_root, monkeypatch):
+    pairs = [
+        make_pair(data_root, "1_a_input.png", "1_output.png"),
+        make_pair(data_root, "1_b_input.png", "1_output.png"),
+        make_pair(data_root, "3_a_input.png", "3_output.png"),
+    ]
+    captions = {"swire/1_output.png": ["a feed"], "swire/3_output.png": []}
+    _, rows = run_captioner(monkeypatch, pairs, captions, known_captions={"swire/3_output.png": "a map"})
+
+    assert rows == {"swire/1_a_input.png": "a feed", "swire/1_b_input.png": "a feed", "swire/3_a_input.png": "a map"}
+
+
+def test_caption_worker_errors_are_raised(data_root, monkeypatch):
+    pairs = [make_pair(data_root, "1_a_input.png", "1_output.png")]
+    with pytest.raises(RuntimeError, match="sink full"):
+        run_captioner(monkeypatch, pairs, {"swire/1_output.png": [RuntimeError("sink full")]})
@@ -1,5 +1,6 @@
 from PIL import Image
 import cv2
+import io
 import json
 import os
 
@@ -16,10 +17,30 @@ def image_from_filepath(image_path):
         return None
 
 
+def encode_image_payload(img, max_edge=None, image_format="JPEG", quality=85, crop_box=None):
+    """
+    Re-encodes a PIL image into a compact upload payload.
+    crop_box follows PIL's (left, upper, right, lower) convention and is applied before resizing.
+    The longest edge is downscaled to max_edge (never upscaled). Returns the encoded bytes.
+    """
+    if crop_box:
+        img = img.crop(crop_box)
+    if max_edge:
+        width, height = img.size
+        scale = max_edge / max(width, height)
+        if scale < 1:
+            img = img.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
 def crop_bars_opencv(img, status_height, nav_height):
     if img is None or img.size == 0:
         return None
-    height, width, _ = img.shape
+    # Grayscale sketches have no channel axis
+    height, width = img.shape[:2]
     if height > (status_height + nav_height):
         # Slicing syntax: image[y_start : y_end, x_start : x_end]
         # We crop from Top Bar -> Height minus Bottom Bar
@@ -64,7 +85,7 @@ def crop_vins_status_bar(img, platform, orig_proportion):
     if img is None:
         return None
     
-    height, width, _ = img.shape
+    height, width = img.shape[:2]
     
     crop_top = 0
     if platform == "Android":
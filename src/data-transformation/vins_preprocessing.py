@@ -26,8 +26,9 @@ VALIDATION_SAMPLES = (
     'IMG_0751',
 )
 
-BG_COLOR = (0, 0, 0)
-CONTRAST_COLOR = (255, 255, 255)
+# Sketches are single-channel: white strokes on a black background
+BG_COLOR = 0
+CONTRAST_COLOR = 255
 AVG_LINE_HEIGHT_PIXELS = 40
 MIN_SEMANTIC_ELEMENTS = 3
 MAX_SEMANTIC_ELEMENTS = 30 
@@ -282,7 +283,7 @@ def process_single_item(item):
         width = item['width']
         height = item['height']
         
-        output_canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        output_canvas = np.zeros((height, width), dtype=np.uint8)
         
         for obj in item['views']:
             visual_key = obj['class']
@@ -320,16 +321,15 @@ def process_single_item(item):
         # 5. Export
         export_base_path = OUTPUT_VALIDATION_DIR if sample_id in VALIDATION_SAMPLES else OUTPUT_TRAIN_DIR
         
-        # Save X (Input Sketch)
+        # Save X (Input Sketch) as a grayscale PNG
         output_path_x = os.path.join(export_base_path, f"{platform}_{sample_id}_input.png")
-        canvas_bgr = cv2.cvtColor(canvas_with_noise, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(output_path_x, canvas_bgr)
+        cv2.imwrite(output_path_x, canvas_with_noise)
 
         # Save Y (Target UI)
         output_path_y = os.path.join(export_base_path, f"{platform}_{sample_id}_output.png")
         cv2.imwrite(output_path_y, ui_final)
         
-        return True
+        return (output_path_x, output_path_y)
 
     except Exception as e:
         print(f"Error processing {sample_id}: {e}")
@@ -351,7 +351,7 @@ def main():
         delayed(process_single_item)(item) for item in tqdm(input_batch, desc="Processing Items")
     )
 
-    processed_count = sum(results)
+    processed_count = sum(1 for r in results if r)
     skipped_count = len(input_batch) - processed_count
 
     print("\n--- DATA BATCH PROCESSING CONCLUDED ---")
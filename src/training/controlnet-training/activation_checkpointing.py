@@ -0,0 +1,128 @@
+# coding=utf-8
+"""
+Selective activation checkpointing of the controlnet transformer blocks.
+
+`enable_gradient_checkpointing()` recomputes every block during the backward pass. A policy instead picks the
+blocks to recompute, either every Nth block or the fewest blocks that bring the activations kept for the
+backward pass under a memory budget. Checkpointed blocks get an instance-level `forward` that runs the original
+one under `torch.utils.checkpoint`, so parameter names, saved checkpoints and `torch.compile` are unaffected.
+
+Policies are written `all`, `every:N` or `budget:GIB`.
+"""
+
+import functools
+
+import torch
+import torch.utils.checkpoint
+
+
+POLICY_KINDS = ("all", "every", "budget")
+
+
+def parse_checkpointing_policy(policy):
+    """Returns `(kind, value)` for a policy string, raising a ValueError for malformed ones."""
+    kind, _, value = policy.partition(":")
+    if kind not in POLICY_KINDS or (kind == "all") != (value == ""):
+        raise ValueError(
+            f"Unknown gradient checkpointing policy {policy!r}, expected `all`, `every:N` or `budget:GIB`"
+        )
+    if kind == "every":
+        value = int(value)
+        if value < 1:
+            raise ValueError(f"`every:N` needs N >= 1, got {policy!r}")
+    elif kind == "budget":
+        value = float(value)
+        if value < 0:
+            raise ValueError(f"`budget:GIB` needs a non-negative budget, got {policy!r}")
+    else:
+        value = None
+    return kind, value
+
+
+def every_nth_block(num_blocks, n):
+    return [i for i in range(num_blocks) if i % n == 0]
+
+
+def _tensors_nbytes(values):
+    return sum(value.nbytes for value in values if isinstance(value, torch.Tensor))
+
+
+def measure_block_activations(model, forward_fn):
+    """
+    Runs `forward_fn()` (a forward pass of `model` with gradients enabled) and returns, for every block of
+    `model.transformer_blocks`, the bytes of the tensors it saves for the backward pass and the bytes of its
+    inputs, which are what a checkpointed block keeps instead.
+    """
+    blocks = list(model.transformer_blocks)
+    saved_bytes = [0] * len(blocks)
+    input_bytes = [0] * len(blocks)
+    parameters = {parameter.untyped_storage().data_ptr() for parameter in model.parameters()}
+    seen = set()
+    current = [None]
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if current[0] is not None and storage.data_ptr() not in parameters and storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            saved_bytes[current[0]] += storage.nbytes()
+        return tensor
+
+    def pre_hook(i, module, args, kwargs):
+        current[0] = i
+        input_bytes[i] = _tensors_nbytes(args) + _tensors_nbytes(kwargs.values())
+
+    def post_hook(module, args, output):
+        current[0] = None
+
+    handles = []
+    for i, block in enumerate(blocks):
+        handles.append(block.register_forward_pre_hook(functools.partial(pre_hook, i), with_kwargs=True))
+        handles.append(block.register_forward_hook(post_hook))
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            forward_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return saved_bytes, input_bytes
+
+
+def blocks_for_budget(saved_bytes, input_bytes, budget_bytes):
+    """
+    Greedily checkpoints the blocks that free the most memory until the kept activations fit `budget_bytes`.
+    Returns the sorted block ids and the estimated bytes kept, which exceed the budget if it is unreachable.
+    """
+    kept = sum(saved_bytes)
+    block_ids = []
+    savings = [saved - inputs for saved, inputs in zip(saved_bytes, input_bytes)]
+    for i in sorted(range(len(savings)), key=lambda i: -savings[i]):
+        if kept <= budget_bytes or savings[i] <= 0:
+            break
+        block_ids.append(i)
+        kept -= savings[i]
+    return sorted(block_ids), kept
+
+
+def _checkpointed(forward):
+    @functools.wraps(forward)
+    def checkpointed_forward(*args, **kwargs):
+        if torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+
+    return checkpointed_forward
+
+
+def apply_activation_checkpointing(model, block_ids):
+    """Checkpoints the given blocks of `model.transformer_blocks`, replacing any previous selection."""
+    remove_activation_checkpointing(model)
+    for i in block_ids:
+        block = model.transformer_blocks[i]
+        block.forward = _checkpointed(block.forward)
+
+
+def remove_activation_checkpointing(model):
+    model.disable_gradient_checkpointing()
+    for block in model.transformer_blocks:
+        # Drops the instance attribute set by `apply_activation_checkpointing`, back to the class method
+        block.__dict__.pop("forward", None)
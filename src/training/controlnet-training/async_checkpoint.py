@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Background checkpoint writer for the training loop.
+
+`snapshot` copies the training state into reusable (pinned when CUDA is available) CPU buffers, which is the
+only part that blocks the training step. `submit` then serializes the snapshot on a single background thread
+into a hidden temporary directory, renames it into place once complete and prunes old checkpoints. At most
+one write is in flight: the next `snapshot` waits for the previous write, since it reuses its buffers.
+"""
+
+import copy
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+def list_checkpoints(output_dir):
+    checkpoints = [d for d in os.listdir(output_dir) if d.startswith("checkpoint")]
+    return sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
+
+
+class AsyncCheckpointWriter:
+    def __init__(self, output_dir, checkpoints_total_limit=None):
+        self.output_dir = output_dir
+        self.checkpoints_total_limit = checkpoints_total_limit
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self.pending = None
+
+    def wait(self):
+        """Blocks until the write in flight is done, re-raising its error if it failed."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def snapshot(self, state):
+        """Copies every tensor of a nested dict/list state to CPU, reusing the buffers of the previous snapshot."""
+        self.wait()
+        state = self._snapshot(state, ())
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        return state
+
+    def _snapshot(self, value, path):
+        if isinstance(value, torch.Tensor):
+            buffer = self.buffers.get(path)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=self.pin_memory)
+                self.buffers[path] = buffer
+            buffer.copy_(value.detach(), non_blocking=self.pin_memory)
+            return buffer
+        if isinstance(value, dict):
+            return {key: self._snapshot(item, path + (key,)) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(item, path + (i,)) for i, item in enumerate(value))
+        return copy.deepcopy(value)
+
+    def submit(self, save_path, write_fn):
+        """Runs `write_fn(directory)` in the background and atomically publishes the directory as `save_path`."""
+        self.wait()
+        self.pending = self.executor.submit(self._write, save_path, write_fn)
+
+    def _write(self, save_path, write_fn):
+        # Not prefixed with "checkpoint" so `--resume_from_checkpoint=latest` never picks up a partial write
+        tmp_path = os.path.join(os.path.dirname(save_path), f".tmp-{os.path.basename(save_path)}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        write_fn(tmp_path)
+        shutil.rmtree(save_path, ignore_errors=True)
+        os.replace(tmp_path, save_path)
+        logger.info(f"Saved state to {save_path}")
+
+        if self.checkpoints_total_limit is not None:
+            checkpoints = list_checkpoints(self.output_dir)
+            removing_checkpoints = checkpoints[: max(0, len(checkpoints) - self.checkpoints_total_limit)]
+            if removing_checkpoints:
+                logger.info(f"removing checkpoints: {', '.join(removing_checkpoints)}")
+            for removing_checkpoint in removing_checkpoints:
+                shutil.rmtree(os.path.join(self.output_dir, removing_checkpoint))
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
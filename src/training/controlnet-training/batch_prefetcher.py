@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Device-side prefetching of training batches.
+
+`BatchPrefetcher` wraps a dataloader that yields CPU batches (dicts of tensors) and hands out batches that are
+already on the device and cast to their training dtypes. While the step of batch N runs, batch N+1 is copied and
+cast:
+
+- on CUDA, on a side stream. The copies are issued before batch N is handed out and the step only waits for them
+  on the device, through an event, so with pinned batches they overlap the compute of batch N instead of blocking
+  the host;
+- elsewhere, on a background thread that fetches, moves and casts the next batch.
+
+Either way the time left waiting for a batch shows up as the `dataloader_wait` phase of the `StepProfiler`.
+
+An accelerate dataloader tracks the end of its iteration for gradient accumulation, which reading ahead would
+report one batch early. The prefetcher takes over that tracking, it reports the end with the last batch it hands
+out, like the dataloader does without prefetching.
+"""
+
+import queue
+import threading
+
+import torch
+from accelerate.data_loader import DataLoaderStateMixin
+from accelerate.state import GradientState
+
+
+_END = object()
+
+
+class BatchPrefetcher(DataLoaderStateMixin):
+    def __init__(self, dataloader, device, dtypes=None):
+        """`dtypes` maps batch keys to the dtype they are cast to once on the device, other keys keep theirs."""
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.dtypes = dtypes or {}
+        self.gradient_state = GradientState()
+        self.tracks_gradient_state = isinstance(dataloader, DataLoaderStateMixin)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _stage(self, batch):
+        staged = {}
+        for key, value in batch.items():
+            if isinstance(value, torch.Tensor):
+                value = value.to(self.device, non_blocking=True).to(self.dtypes.get(key, value.dtype))
+            staged[key] = value
+        return staged
+
+    def _stage_on_stream(self, batch):
+        with torch.cuda.stream(self.stream):
+            batch = self._stage(batch)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+    def _hand_out(self, staged):
+        batch, ready = staged
+        if ready is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # Only this batch, the copies of the next one are already queued behind it on the side stream
+            current_stream.wait_event(ready)
+            for value in batch.values():
+                if isinstance(value, torch.Tensor):
+                    # Allocated on the side stream, the caching allocator must not reuse them before the step is done
+                    value.record_stream(current_stream)
+        return batch
+
+    def _batches(self):
+        if self.stream is not None:
+            for batch in self.dataloader:
+                yield self._stage_on_stream(batch)
+            return
+
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            # Gives up once the consumer is gone, instead of blocking on the full queue forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.dataloader:
+                    if not put((self._stage(batch), None)):
+                        return
+                put(_END)
+            except Exception as error:
+                put(error)
+
+        thread = threading.Thread(target=produce, name="batch-prefetcher", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def __iter__(self):
+        batches = self._batches()
+        try:
+            batch = next(batches, _END)
+            if batch is _END:
+                return
+            # Registered after the first batch, so it comes after the wrapped dataloader in the gradient state
+            if self.tracks_gradient_state:
+                self.begin()
+                self.remainder = self.dataloader.remainder
+            while True:
+                next_batch = next(batches, _END)
+                if next_batch is _END:
+                    self.end_of_dataloader = True
+                    yield self._hand_out(batch)
+                    return
+                yield self._hand_out(batch)
+                batch = next_batch
+        finally:
+            batches.close()
+            if self.tracks_gradient_state:
+                self.end()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Throughput of the training dataloader for several worker configurations.
+
+Builds the training dataset with `make_train_dataset` and iterates the dataloader of `train_controlnet_sd3.py`
+without the transformer, the controlnet or the text encoders, for every combination of `--num_workers`,
+`--prefetch_factors`, `--persistent_workers` and `--pin_memory`. Reports, per configuration, the samples per second
+once the first batch is in, the time to the first batch of every epoch (worker startup, paid again every epoch
+without persistent workers) and the resident memory of the workers.
+
+Prompt embeddings are zeros of the real shapes, written to a temporary cache next to the training one, so no text
+encoder is loaded. The image and latent caches are the ones of training and are built first if missing, the VAE is
+only loaded on CPU for a missing latent cache. Every argument not listed below is passed to
+`train_controlnet_sd3.py`'s argument parser, so the dataset is read exactly as training reads it.
+
+The best configuration is the one with the least worker memory among those within `--tolerance` of the highest
+throughput. Pass the `--output_file` to training with `--dataloader_config` to use it.
+
+Example:
+    python benchmark_dataloader.py \\
+        --num_workers=0,4,8,16 --prefetch_factors=2,4 --persistent_workers=false,true \\
+        --output_file=dataloader.json \\
+        --pretrained_model_name_or_path="stabilityai/stable-diffusion-3.5-large" \\
+        --train_data_dir=../../../datasets/train --resolution=1024 --train_batch_size=4
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+
+import psutil
+import torch
+from accelerate import Accelerator
+
+from diffusers import AutoencoderKL, SD3Transformer2DModel
+from prompt_embedding_cache import PromptEmbeddingCache
+from train_controlnet_sd3 import (
+    DATALOADER_CONFIG_KEYS,
+    make_train_dataloader,
+    make_train_dataset,
+    prompt_embedding_fingerprint,
+    t5_sequence_lengths,
+)
+from train_controlnet_sd3 import parse_args as parse_training_args
+from transformers import T5TokenizerFast
+
+
+# Tokens of the two CLIP encoders, ahead of the T5 ones in the prompt embeddings, see `encode_prompt`
+NUM_CLIP_TOKENS = 77
+
+
+def parse_bools(value):
+    bools = {"true": True, "false": False}
+    try:
+        return [bools[item.strip().lower()] for item in value.split(",")]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"Expected comma-separated `true`/`false` values, got {value!r}")
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",")]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep of the training dataloader settings. Other arguments go to `train_controlnet_sd3.py`."
+    )
+    parser.add_argument("--num_workers", type=parse_ints, default=[0, 2, 4, 8], help="Comma-separated values.")
+    parser.add_argument(
+        "--prefetch_factors",
+        type=parse_ints,
+        default=[2],
+        help="Comma-separated values, only combined with a positive number of workers.",
+    )
+    parser.add_argument(
+        "--persistent_workers",
+        type=parse_bools,
+        default=[False, True],
+        help="Comma-separated `true`/`false` values, only combined with a positive number of workers.",
+    )
+    parser.add_argument("--pin_memory", type=parse_bools, default=[False, True], help="Comma-separated values.")
+    parser.add_argument("--batches", type=int, default=20, help="Batches read per epoch, the first one included.")
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=2,
+        help="Epochs per configuration, the later ones show the worker startup saved by persistent workers.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="Relative throughput loss accepted for a configuration that takes less worker memory.",
+    )
+    parser.add_argument("--output_file", type=str, default=None, help="Where to write the results as JSON.")
+    args, training_argv = parser.parse_known_args()
+    if args.batches < 2:
+        raise ValueError("`--batches` must be at least 2, the first batch is not counted in the throughput.")
+    return args, parse_training_args(training_argv)
+
+
+class SyntheticPromptEncoder:
+    """Zero prompt embeddings with the shapes and dtype of `PromptEncoder`, trimmed the same way."""
+
+    def __init__(self, training_args, dtype):
+        config = SD3Transformer2DModel.load_config(
+            training_args.pretrained_model_name_or_path, subfolder="transformer", revision=training_args.revision
+        )
+        self.joint_attention_dim = config["joint_attention_dim"]
+        self.pooled_projection_dim = config["pooled_projection_dim"]
+        self.max_sequence_length = training_args.max_sequence_length
+        self.dtype = dtype
+        self.tokenizer = None
+        if training_args.trim_prompt_embeds:
+            self.tokenizer = T5TokenizerFast.from_pretrained(
+                training_args.pretrained_model_name_or_path,
+                subfolder="tokenizer_3",
+                revision=training_args.revision,
+            )
+
+    def __call__(self, prompts):
+        sequence_length = NUM_CLIP_TOKENS + self.max_sequence_length
+        prompt_embeds = torch.zeros(len(prompts), sequence_length, self.joint_attention_dim, dtype=self.dtype)
+        pooled_prompt_embeds = torch.zeros(len(prompts), self.pooled_projection_dim, dtype=self.dtype)
+        if self.tokenizer is None:
+            return prompt_embeds, pooled_prompt_embeds
+        t5_lengths = t5_sequence_lengths(self.tokenizer, prompts, self.max_sequence_length)
+        return prompt_embeds, pooled_prompt_embeds, [NUM_CLIP_TOKENS + length for length in t5_lengths]
+
+    def unload(self):
+        pass
+
+
+def worker_memory():
+    """Resident bytes of the child processes, i.e. the dataloader workers. Pages shared with the parent count once
+    per worker."""
+    rss = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def configurations(args):
+    for num_workers, pin_memory in itertools.product(args.num_workers, args.pin_memory):
+        if num_workers == 0:
+            yield num_workers, None, False, pin_memory
+            continue
+        for prefetch_factor, persistent_workers in itertools.product(args.prefetch_factors, args.persistent_workers):
+            yield num_workers, prefetch_factor, persistent_workers, pin_memory
+
+
+def run_configuration(dataloader, batch_sampler, args):
+    first_batch_s = []
+    samples = 0
+    steady_s = 0.0
+    worker_rss = 0
+    for epoch in range(args.epochs):
+        batch_sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        iterator = iter(dataloader)
+        for step, batch in enumerate(iterator):
+            now = time.perf_counter()
+            if step == 0:
+                first_batch_s.append(now - start)
+                steady_start = now
+            else:
+                samples += len(batch["prompt_embeds"])
+            if step + 1 == args.batches:
+                break
+        steady_s += time.perf_counter() - steady_start
+        # While `iterator` keeps the workers of the epoch alive
+        worker_rss = max(worker_rss, worker_memory())
+        del iterator
+    return {
+        "samples_per_s": samples / steady_s if steady_s > 0 else 0.0,
+        "first_batch_s": first_batch_s,
+        "worker_rss_gib": worker_rss / 2**30,
+    }
+
+
+def pick_best(results, tolerance):
+    fastest = max(result["samples_per_s"] for result in results)
+    candidates = [result for result in results if result["samples_per_s"] >= fastest * (1 - tolerance)]
+    return min(candidates, key=lambda result: (result["worker_rss_gib"], -result["samples_per_s"]))
+
+
+def main():
+    args, training_args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s", level=logging.INFO)
+    accelerator = Accelerator(mixed_precision=training_args.mixed_precision)
+    weight_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(accelerator.mixed_precision, torch.float32)
+
+    vae = None
+    if training_args.cache_latents:
+        # Only to build a missing latent cache and read its settings
+        vae = AutoencoderKL.from_pretrained(
+            training_args.pretrained_model_name_or_path,
+            subfolder="vae",
+            revision=training_args.revision,
+            variant=training_args.variant,
+        )
+        vae.requires_grad_(False)
+        vae.to(dtype=torch.float32 if training_args.upcast_vae else weight_dtype)
+
+    # On the file system of the training cache, so embeddings are read from the same kind of storage
+    cache_parent = os.path.dirname(os.path.abspath(training_args.prompt_embedding_cache_dir))
+    os.makedirs(cache_parent, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="benchmark_prompt_embeddings-", dir=cache_parent) as cache_dir:
+        prompt_embedding_cache = PromptEmbeddingCache(
+            cache_dir, prompt_embedding_fingerprint(training_args, weight_dtype)
+        )
+        train_dataset = make_train_dataset(
+            training_args,
+            None,
+            None,
+            None,
+            accelerator,
+            vae=vae,
+            prompt_embedding_cache=prompt_embedding_cache,
+            prompt_encoder=SyntheticPromptEncoder(training_args, weight_dtype),
+        )
+        del vae
+
+        results = []
+        seen = set()
+        for num_workers, prefetch_factor, persistent_workers, pin_memory in configurations(args):
+            config_args = copy.copy(training_args)
+            config_args.dataloader_num_workers = num_workers
+            config_args.dataloader_prefetch_factor = prefetch_factor
+            config_args.dataloader_persistent_workers = persistent_workers
+            config_args.dataloader_pin_memory = pin_memory
+            config = {key: getattr(config_args, key) for key in DATALOADER_CONFIG_KEYS}
+            dataloader, batch_sampler = make_train_dataloader(config_args, train_dataset, prompt_embedding_cache)
+            # e.g. `--streaming` always pins memory
+            effective = (num_workers, prefetch_factor, persistent_workers, dataloader.pin_memory)
+            if effective in seen:
+                continue
+            seen.add(effective)
+
+            result = {"config": config, **run_configuration(dataloader, batch_sampler, args)}
+            results.append(result)
+            first_batch = ", ".join(f"{seconds:.2f}" for seconds in result["first_batch_s"])
+            print(
+                f"✅ workers={num_workers:>2} prefetch={prefetch_factor or '-'!s:>2}"
+                f" persistent={'yes' if persistent_workers else 'no':>3} pin={'yes' if dataloader.pin_memory else 'no':>3}:"
+                f" {result['samples_per_s']:8.1f} samples/s, first batch {first_batch} s,"
+                f" workers {result['worker_rss_gib']:.2f} GiB"
+            )
+            # Stops persistent workers before the next configuration is measured
+            del dataloader, batch_sampler
+
+    best = pick_best(results, args.tolerance)
+    print(f"🏆 Best configuration: {json.dumps(best['config'])}")
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"args": vars(args), "results": results, "best": best["config"]}, f, indent=2)
+        print(f"Results saved to {args.output_file}, use it with `--dataloader_config={args.output_file}`")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Quality check of `--quantize_transformer`.
+
+Computes the flow matching loss of `train_controlnet_sd3.py` and the controlnet gradients on a fixed random batch,
+first with the transformer in the training precision, then again after quantizing its weights in place. Reports
+the relative loss difference, the cosine similarity of the controlnet gradients and the transformer weight memory
+of both runs. Runs on CPU when CUDA is not available.
+
+Example:
+    python check_weight_quantization.py \\
+        --pretrained_model_name_or_path="stabilityai/stable-diffusion-3.5-large" \\
+        --controlnet_model_name_or_path="stabilityai/stable-diffusion-3.5-large-controlnet-canny" \\
+        --quantization=int8 --resolution=1024 --mixed_precision=bf16
+"""
+
+import argparse
+import json
+
+import torch
+
+from diffusers import SD3ControlNetModel, SD3Transformer2DModel
+from train_controlnet_sd3 import TRANSFORMER_QUANTIZATION_EXCLUDE
+from weight_quantization import QUANTIZATION_DTYPES, quantize_weights, weight_memory
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Loss and gradient check of the transformer weight quantization.")
+    parser.add_argument("--pretrained_model_name_or_path", type=str, required=True)
+    parser.add_argument(
+        "--controlnet_model_name_or_path",
+        type=str,
+        default=None,
+        help="Controlnet to train. Defaults to one initialized from the transformer, as in training.",
+    )
+    parser.add_argument("--revision", type=str, default=None)
+    parser.add_argument("--variant", type=str, default=None)
+    parser.add_argument("--quantization", type=str, default="int8", choices=list(QUANTIZATION_DTYPES))
+    parser.add_argument("--resolution", type=int, default=1024)
+    parser.add_argument("--train_batch_size", type=int, default=1)
+    parser.add_argument("--max_sequence_length", type=int, default=77)
+    parser.add_argument("--mixed_precision", type=str, default="bf16", choices=["no", "fp16", "bf16"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output_file", type=str, default=None, help="Where to write the results as JSON.")
+    return parser.parse_args()
+
+
+def make_batch(controlnet, transformer, args, device):
+    generator = torch.Generator().manual_seed(args.seed)
+    latent_size = args.resolution // 8
+    shape = (args.train_batch_size, transformer.config.in_channels, latent_size, latent_size)
+    model_input = torch.randn(shape, generator=generator)
+    noise = torch.randn(shape, generator=generator)
+    # Spread over the whole schedule so every noise level weighs in
+    sigmas = torch.linspace(0.1, 0.9, args.train_batch_size).view(-1, 1, 1, 1)
+    noisy_model_input = (1.0 - sigmas) * model_input + sigmas * noise
+
+    # CLIP tokens followed by T5 tokens, see `encode_prompt`
+    prompt_embeds = torch.randn(
+        args.train_batch_size,
+        77 + args.max_sequence_length,
+        transformer.config.joint_attention_dim,
+        generator=generator,
+    )
+    pooled_prompt_embeds = torch.randn(
+        args.train_batch_size, transformer.config.pooled_projection_dim, generator=generator
+    )
+    controlnet_cond = torch.randn(
+        (args.train_batch_size, controlnet.pos_embed_input.proj.in_channels, latent_size, latent_size),
+        generator=generator,
+    )
+    return {
+        "noisy_model_input": noisy_model_input.to(device),
+        "target": (noise - model_input).to(device),
+        "timestep": (sigmas.flatten() * 1000).to(device),
+        "prompt_embeds": prompt_embeds.to(device),
+        "pooled_prompt_embeds": pooled_prompt_embeds.to(device),
+        "controlnet_cond": controlnet_cond.to(device),
+    }
+
+
+def loss_and_gradients(controlnet, transformer, batch, weight_dtype, autocast):
+    controlnet.zero_grad(set_to_none=True)
+    noisy_model_input = batch["noisy_model_input"].to(weight_dtype)
+    prompt_embeds = batch["prompt_embeds"].to(weight_dtype)
+    pooled_prompt_embeds = batch["pooled_prompt_embeds"].to(weight_dtype)
+    # Same handling as the training loop for controlnets sharing the transformer's patch embedding and text context
+    controlnet_input = noisy_model_input
+    if controlnet.pos_embed is None:
+        controlnet_input = transformer.pos_embed(noisy_model_input)
+    controlnet_prompt_embeds = None if controlnet.context_embedder is None else prompt_embeds
+    with autocast:
+        control_block_res_samples = controlnet(
+            hidden_states=controlnet_input,
+            timestep=batch["timestep"],
+            encoder_hidden_states=controlnet_prompt_embeds,
+            pooled_projections=pooled_prompt_embeds,
+            controlnet_cond=batch["controlnet_cond"].to(weight_dtype),
+            return_dict=False,
+        )[0]
+        model_pred = transformer(
+            hidden_states=noisy_model_input,
+            timestep=batch["timestep"],
+            encoder_hidden_states=prompt_embeds,
+            pooled_projections=pooled_prompt_embeds,
+            block_controlnet_hidden_states=[sample.to(weight_dtype) for sample in control_block_res_samples],
+            return_dict=False,
+        )[0]
+    loss = torch.nn.functional.mse_loss(model_pred.float(), batch["target"].float())
+    loss.backward()
+    gradients = torch.cat([p.grad.float().flatten().cpu() for p in controlnet.parameters() if p.grad is not None])
+    return loss.item(), gradients
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    weight_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.mixed_precision, torch.float32)
+    autocast = torch.autocast(device.type, dtype=weight_dtype, enabled=weight_dtype != torch.float32)
+
+    transformer = SD3Transformer2DModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="transformer", revision=args.revision, variant=args.variant
+    )
+    if args.controlnet_model_name_or_path:
+        controlnet = SD3ControlNetModel.from_pretrained(args.controlnet_model_name_or_path)
+    else:
+        controlnet = SD3ControlNetModel.from_transformer(transformer)
+    transformer.requires_grad_(False)
+    controlnet.train()
+    controlnet.to(device)
+    batch = make_batch(controlnet, transformer, args, device)
+
+    transformer.to(device, dtype=weight_dtype)
+    reference_memory = weight_memory(transformer)
+    reference_loss, reference_gradients = loss_and_gradients(controlnet, transformer, batch, weight_dtype, autocast)
+
+    # In place on the device, the transformer is never resident twice
+    quantize_weights(transformer, args.quantization, exclude=TRANSFORMER_QUANTIZATION_EXCLUDE)
+    quantized_memory = weight_memory(transformer)
+    quantized_loss, quantized_gradients = loss_and_gradients(controlnet, transformer, batch, weight_dtype, autocast)
+
+    results = {
+        "quantization": args.quantization,
+        "reference_loss": reference_loss,
+        "quantized_loss": quantized_loss,
+        "relative_loss_difference": abs(quantized_loss - reference_loss) / abs(reference_loss),
+        "gradient_cosine_similarity": torch.nn.functional.cosine_similarity(
+            reference_gradients, quantized_gradients, dim=0
+        ).item(),
+        "reference_weights_gib": reference_memory / 2**30,
+        "quantized_weights_gib": quantized_memory / 2**30,
+    }
+    print(
+        f"📉 Loss: {reference_loss:.6f} ({args.mixed_precision}) vs {quantized_loss:.6f} ({args.quantization}),"
+        f" relative difference {results['relative_loss_difference']:.2%}"
+    )
+    print(f"🧭 Controlnet gradient cosine similarity: {results['gradient_cosine_similarity']:.6f}")
+    print(
+        f"💾 Transformer weights: {results['reference_weights_gib']:.2f} GiB ->"
+        f" {results['quantized_weights_gib']:.2f} GiB"
+    )
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Results saved to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
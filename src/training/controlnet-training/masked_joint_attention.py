@@ -0,0 +1,79 @@
+# coding=utf-8
+"""
+Text padding mask for the SD3 joint attention.
+
+`JointAttnProcessor2_0` attends over the image tokens and every text token, padding included. With
+`--trim_prompt_embeds` the prompt embeddings of a batch are zero-padded to its longest caption only, and the mask
+of their real tokens reaches the attention processors as `joint_attention_kwargs={"encoder_attention_mask": mask}`
+so the padding is never attended to. Models whose forward does not pass `joint_attention_kwargs` down to their
+blocks (the SD3 controlnet) run unmasked.
+
+A boolean mask rules out the flash attention kernel, so the processor only applies it when one is given.
+"""
+
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import JointAttnProcessor2_0
+
+
+class MaskedJointAttnProcessor2_0(JointAttnProcessor2_0):
+    def __call__(
+        self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, encoder_attention_mask=None
+    ):
+        if encoder_attention_mask is None or encoder_hidden_states is None:
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask)
+
+        batch_size = hidden_states.shape[0]
+        num_image_tokens = hidden_states.shape[1]
+        head_dim = attn.to_k.out_features // attn.heads
+
+        def heads(tensor):
+            return tensor.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        query = heads(attn.to_q(hidden_states))
+        key = heads(attn.to_k(hidden_states))
+        value = heads(attn.to_v(hidden_states))
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        context_query = heads(attn.add_q_proj(encoder_hidden_states))
+        context_key = heads(attn.add_k_proj(encoder_hidden_states))
+        context_value = heads(attn.add_v_proj(encoder_hidden_states))
+        if attn.norm_added_q is not None:
+            context_query = attn.norm_added_q(context_query)
+        if attn.norm_added_k is not None:
+            context_key = attn.norm_added_k(context_key)
+
+        query = torch.cat([query, context_query], dim=2)
+        key = torch.cat([key, context_key], dim=2)
+        value = torch.cat([value, context_value], dim=2)
+
+        # Every query attends to all image tokens and to the real text tokens of its sample
+        key_mask = torch.cat(
+            [encoder_attention_mask.new_ones(batch_size, num_image_tokens), encoder_attention_mask.bool()], dim=1
+        )
+        hidden_states = F.scaled_dot_product_attention(query, key, value, attn_mask=key_mask[:, None, None, :])
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states, encoder_hidden_states = (
+            hidden_states[:, :num_image_tokens],
+            hidden_states[:, num_image_tokens:],
+        )
+        if not attn.context_pre_only:
+            encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+        hidden_states = attn.to_out[1](attn.to_out[0](hidden_states))
+        return hidden_states, encoder_hidden_states
+
+
+def enable_masked_joint_attention(model):
+    """Replaces the default joint attention processors of `model`, returns the number of replaced ones."""
+    processors = model.attn_processors
+    masked = {
+        name: MaskedJointAttnProcessor2_0() if type(processor) is JointAttnProcessor2_0 else processor
+        for name, processor in processors.items()
+    }
+    model.set_attn_processor(masked)
+    return sum(type(processor) is JointAttnProcessor2_0 for processor in processors.values())
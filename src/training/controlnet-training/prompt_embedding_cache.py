@@ -0,0 +1,153 @@
+# coding=utf-8
+"""
+Content-addressed cache of SD3 prompt embeddings.
+
+Every prompt is keyed by a hash of its text and of the settings that change its embedding (text encoders,
+revision, variant, `max_sequence_length`, dtype), never by the rest of the training arguments. Identical
+captions are encoded and stored once, and the cache can be shared between runs and output directories.
+
+The cache directory holds append-only segments. Each segment is a pair of `ShardedArrayStore`s (sequence and
+pooled embeddings) plus the keys of its rows, and is renamed into place only once complete, so an interrupted
+encoding pass keeps every finished segment.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+from tensor_store import ShardedArrayWriter, open_store
+
+
+SEGMENT_PREFIX = "segment-"
+DEFAULT_SEGMENT_SIZE = 10000
+
+# numpy has no bfloat16, 16-bit embeddings are stored as their raw bits
+_STORAGE_DTYPES = {
+    torch.float16: np.int16,
+    torch.bfloat16: np.int16,
+    torch.float32: np.float32,
+}
+
+
+def _to_numpy(tensor):
+    if tensor.dtype in (torch.float16, torch.bfloat16):
+        return tensor.contiguous().view(torch.int16).cpu().numpy()
+    return tensor.cpu().numpy()
+
+
+class PromptEmbeddingCache:
+    def __init__(self, cache_dir, fingerprint):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.segments = []
+        os.makedirs(cache_dir, exist_ok=True)
+        self.reload()
+
+    def key(self, prompt):
+        payload = json.dumps([self.fingerprint, prompt], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def reload(self):
+        """Picks up the segments written since the last call, e.g. by the main process."""
+        known = {segment["name"] for segment in self.segments}
+        for name in sorted(os.listdir(self.cache_dir)):
+            if not name.startswith(SEGMENT_PREFIX) or name.endswith(".tmp") or name in known:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            prompt_embeds = open_store(os.path.join(path, "prompt_embeds"))
+            pooled_prompt_embeds = open_store(os.path.join(path, "pooled_prompt_embeds"))
+            if prompt_embeds is None or pooled_prompt_embeds is None:
+                continue
+            segment_id = len(self.segments)
+            self.segments.append(
+                {
+                    "name": name,
+                    "prompt_embeds": prompt_embeds,
+                    "pooled_prompt_embeds": pooled_prompt_embeds,
+                    "torch_dtype": getattr(torch, prompt_embeds.meta["torch_dtype"]),
+                }
+            )
+            for row, key in enumerate(prompt_embeds.meta["keys"]):
+                self.entries[key] = (segment_id, row)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, prompt):
+        return self.key(prompt) in self.entries
+
+    def missing(self, prompts):
+        """Unique prompts, in first-seen order, that are not cached yet."""
+        seen = set()
+        missing = []
+        for prompt in prompts:
+            if prompt in seen:
+                continue
+            seen.add(prompt)
+            if prompt not in self:
+                missing.append(prompt)
+        return missing
+
+    def fill(self, prompts, encode_fn, batch_size, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        Encodes the prompts that are not cached yet with `encode_fn(list_of_prompts) -> (prompt_embeds,
+        pooled_prompt_embeds)` and appends them to the cache. `encode_fn` may also return the number of leading
+        tokens to keep of each row, to store trimmed sequences. Returns the number of newly encoded prompts.
+        """
+        missing = self.missing(prompts)
+        for start in tqdm(range(0, len(missing), segment_size), desc="Encoding prompts", disable=not missing):
+            self._write_segment(missing[start : start + segment_size], encode_fn, batch_size)
+        self.reload()
+        return len(missing)
+
+    def _write_segment(self, prompts, encode_fn, batch_size):
+        name = f"{SEGMENT_PREFIX}{uuid.uuid4().hex}"
+        tmp_path = os.path.join(self.cache_dir, f"{name}.tmp")
+        writers = None
+        torch_dtype = None
+        for start in range(0, len(prompts), batch_size):
+            batch = prompts[start : start + batch_size]
+            prompt_embeds, pooled_prompt_embeds, *sequence_lengths = encode_fn(batch)
+            sequence_lengths = sequence_lengths[0] if sequence_lengths else [None] * len(batch)
+            if writers is None:
+                torch_dtype = prompt_embeds.dtype
+                storage_dtype = _STORAGE_DTYPES[torch_dtype]
+                writers = {
+                    "prompt_embeds": ShardedArrayWriter(os.path.join(tmp_path, "prompt_embeds"), storage_dtype, 2),
+                    "pooled_prompt_embeds": ShardedArrayWriter(
+                        os.path.join(tmp_path, "pooled_prompt_embeds"), storage_dtype, 1
+                    ),
+                }
+            for embeds, pooled, length in zip(
+                _to_numpy(prompt_embeds), _to_numpy(pooled_prompt_embeds), sequence_lengths
+            ):
+                writers["prompt_embeds"].append(embeds[:length])
+                writers["pooled_prompt_embeds"].append(pooled)
+
+        meta = {
+            "keys": [self.key(prompt) for prompt in prompts],
+            "torch_dtype": str(torch_dtype).replace("torch.", ""),
+        }
+        for writer in writers.values():
+            writer.close(meta)
+        os.replace(tmp_path, os.path.join(self.cache_dir, name))
+
+    def sequence_length(self, prompt):
+        """Number of tokens of the cached `prompt_embeds` of a prompt, read from the index without loading them."""
+        segment_id, row = self.entries[self.key(prompt)]
+        return int(self.segments[segment_id]["prompt_embeds"].shapes[row][0])
+
+    def __getitem__(self, prompt):
+        """Returns the (prompt_embeds, pooled_prompt_embeds) tensors of a cached prompt, as zero-copy views."""
+        segment_id, row = self.entries[self.key(prompt)]
+        segment = self.segments[segment_id]
+        return (
+            torch.from_numpy(segment["prompt_embeds"][row]).view(segment["torch_dtype"]),
+            torch.from_numpy(segment["pooled_prompt_embeds"][row]).view(segment["torch_dtype"]),
+        )
@@ -13,6 +13,7 @@ accelerate launch --dynamo_backend="no" train_controlnet_sd3.py \
   --gradient_accumulation_steps=32 \
   --gradient_checkpointing \
   --dataloader_num_workers=8 \
+  ${DATALOADER_CONFIG:+--dataloader_config="$DATALOADER_CONFIG"} \
   --allow_tf32 \
   --learning_rate=1e-5 \
   --num_train_epochs=30 \
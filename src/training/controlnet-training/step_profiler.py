@@ -0,0 +1,144 @@
+# coding=utf-8
+"""
+Per-phase timing of the training step.
+
+The step loop marks the start and end of every micro step and wraps its phases (VAE encoding, controlnet and
+transformer forwards, backward, optimizer) in `phase(name)`. The time between two micro steps is the dataloader
+wait. Every optimizer step yields throughput metrics for the trackers, and `summary` aggregates them for the
+whole run, without the first `warmup_steps` optimizer steps.
+
+Phases only have a meaning if the device queue is drained at their boundaries, so an enabled profiler
+synchronizes the device around each of them and slows training down. A disabled profiler does nothing.
+"""
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+
+import torch
+
+
+DEFAULT_WARMUP_STEPS = 2
+METRIC_PREFIX = "profile/"
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+class StepProfiler:
+    def __init__(self, device, enabled=True, num_processes=1, warmup_steps=DEFAULT_WARMUP_STEPS):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.num_processes = num_processes
+        self.warmup_steps = warmup_steps
+        self.track_memory = self.device.type == "cuda"
+
+        self.num_updates = 0
+        self.totals = defaultdict(float)
+        self.total_samples = 0
+        self.peak_memory = 0
+        self._reset_update()
+        self.last_step_end = None
+        self.body_start = None
+
+    def _reset_update(self):
+        self.current = defaultdict(float)
+        self.samples = 0
+        if self.enabled and self.track_memory:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def start_micro_step(self, batch_size):
+        """Called once the batch is available, the time since the previous micro step is the dataloader wait."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.last_step_end is not None:
+            self.current["dataloader_wait"] += now - self.last_step_end
+        self.samples += batch_size * self.num_processes
+        self.body_start = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        synchronize(self.device)
+        start = time.perf_counter()
+        yield
+        synchronize(self.device)
+        self.current[name] += time.perf_counter() - start
+
+    def _close_body(self):
+        if self.body_start is not None:
+            synchronize(self.device)
+            self.current["step"] += time.perf_counter() - self.body_start
+            self.body_start = None
+
+    def end_update(self):
+        """
+        Closes an optimizer step and returns its metrics. Work done after this call and before `end_micro_step`
+        (checkpointing, validation) is left out of the throughput.
+        """
+        if not self.enabled:
+            return {}
+        self._close_body()
+        seconds = self.current.pop("step") + self.current["dataloader_wait"]
+        measured = sum(self.current.values())
+        self.current["other"] = max(0.0, seconds - measured)
+        peak_memory = torch.cuda.max_memory_allocated(self.device) if self.track_memory else 0
+
+        metrics = {f"{METRIC_PREFIX}{name}_s": value for name, value in self.current.items()}
+        metrics[f"{METRIC_PREFIX}step_s"] = seconds
+        metrics[f"{METRIC_PREFIX}samples_per_s"] = self.samples / seconds
+        metrics[f"{METRIC_PREFIX}optimizer_steps_per_hour"] = 3600 / seconds
+        if self.track_memory:
+            metrics[f"{METRIC_PREFIX}peak_memory_gib"] = peak_memory / 2**30
+
+        self.num_updates += 1
+        if self.num_updates > self.warmup_steps:
+            for name, value in self.current.items():
+                self.totals[name] += value
+            self.totals["step"] += seconds
+            self.total_samples += self.samples
+            self.peak_memory = max(self.peak_memory, peak_memory)
+        self._reset_update()
+        return metrics
+
+    def end_micro_step(self):
+        if not self.enabled:
+            return
+        self._close_body()
+        self.last_step_end = time.perf_counter()
+
+    def summary(self):
+        measured_updates = self.num_updates - self.warmup_steps
+        if not self.enabled or measured_updates <= 0:
+            return None
+        seconds = self.totals["step"]
+        phases = {name: value for name, value in self.totals.items() if name != "step"}
+        summary = {
+            "optimizer_steps": measured_updates,
+            "skipped_warmup_steps": self.warmup_steps,
+            "samples_per_s": self.total_samples / seconds,
+            "optimizer_steps_per_hour": 3600 * measured_updates / seconds,
+            "mean_step_s": seconds / measured_updates,
+            "phases": {
+                name: {"mean_s": value / measured_updates, "fraction": value / seconds}
+                for name, value in sorted(phases.items(), key=lambda item: -item[1])
+            },
+        }
+        if self.track_memory:
+            summary["peak_memory_gib"] = self.peak_memory / 2**30
+        return summary
+
+    def save_summary(self, path):
+        summary = self.summary()
+        if summary is not None:
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Peak memory against step time of the controlnet for several `--gradient_checkpointing_policy` values.
+
+Each policy runs a few forward and backward passes of the controlnet alone, on random inputs with the shapes of
+a training batch, in the precision `train_controlnet_sd3.py` uses. The frozen transformer, VAE and optimizer state
+take the same memory whatever the policy, so the differences between rows are what a policy trades. Peak memory
+is only reported on CUDA.
+
+Example:
+    python sweep_gradient_checkpointing.py \\
+        --pretrained_model_name_or_path="stabilityai/stable-diffusion-3.5-large" \\
+        --controlnet_model_name_or_path="stabilityai/stable-diffusion-3.5-large-controlnet-canny" \\
+        --resolution=1024 --train_batch_size=4 --mixed_precision=bf16 \\
+        --policies="none,every:4,every:2,budget:20,all"
+"""
+
+import argparse
+import json
+import time
+
+import torch
+
+from activation_checkpointing import (
+    apply_activation_checkpointing,
+    blocks_for_budget,
+    every_nth_block,
+    measure_block_activations,
+    parse_checkpointing_policy,
+    remove_activation_checkpointing,
+)
+from diffusers import SD3ControlNetModel, SD3Transformer2DModel
+from diffusers.training_utils import free_memory
+from step_profiler import synchronize
+from train_controlnet_sd3 import controlnet_example_inputs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sweep of the controlnet gradient checkpointing policies.")
+    parser.add_argument("--pretrained_model_name_or_path", type=str, required=True)
+    parser.add_argument(
+        "--controlnet_model_name_or_path",
+        type=str,
+        default=None,
+        help="Controlnet to measure. Defaults to one initialized from the transformer, as in training.",
+    )
+    parser.add_argument("--revision", type=str, default=None)
+    parser.add_argument("--variant", type=str, default=None)
+    parser.add_argument("--num_extra_conditioning_channels", type=int, default=0)
+    parser.add_argument("--resolution", type=int, default=1024)
+    parser.add_argument("--train_batch_size", type=int, default=2)
+    parser.add_argument("--max_sequence_length", type=int, default=77)
+    parser.add_argument("--mixed_precision", type=str, default="bf16", choices=["no", "fp16", "bf16"])
+    parser.add_argument(
+        "--policies",
+        type=str,
+        default="none,every:4,every:3,every:2,all",
+        help="Comma-separated `--gradient_checkpointing_policy` values, `none` disables gradient checkpointing.",
+    )
+    parser.add_argument("--steps", type=int, default=5, help="Timed steps per policy.")
+    parser.add_argument("--warmup_steps", type=int, default=1, help="Untimed steps per policy.")
+    parser.add_argument("--output_file", type=str, default=None, help="Where to write the results as JSON.")
+    args = parser.parse_args()
+
+    for policy in args.policies.split(","):
+        if policy != "none":
+            parse_checkpointing_policy(policy)
+    return args
+
+
+def load_models(args):
+    transformer = SD3Transformer2DModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="transformer", revision=args.revision, variant=args.variant
+    )
+    if args.controlnet_model_name_or_path:
+        controlnet = SD3ControlNetModel.from_pretrained(args.controlnet_model_name_or_path)
+    else:
+        controlnet = SD3ControlNetModel.from_transformer(
+            transformer, num_extra_conditioning_channels=args.num_extra_conditioning_channels
+        )
+    controlnet.train()
+    return controlnet, transformer
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(args.mixed_precision)
+    autocast = torch.autocast(device.type, dtype=dtype, enabled=dtype is not None)
+
+    controlnet, transformer = load_models(args)
+    controlnet.to(device)
+    inputs = controlnet_example_inputs(controlnet, transformer, args, args.train_batch_size, device)
+    single_inputs = controlnet_example_inputs(controlnet, transformer, args, 1, device)
+    # Only the patch embedding of the transformer is needed, for controlnets that share it
+    del transformer
+    free_memory()
+
+    num_blocks = len(controlnet.transformer_blocks)
+    with autocast:
+        saved_bytes, input_bytes = measure_block_activations(controlnet, lambda: controlnet(**single_inputs))
+    saved_bytes = [saved * args.train_batch_size for saved in saved_bytes]
+    input_bytes = [inputs * args.train_batch_size for inputs in input_bytes]
+    del single_inputs
+    print(f"📏 {num_blocks} blocks, {sum(saved_bytes) / 2**30:.2f} GiB of block activations without checkpointing")
+
+    def train_step():
+        with autocast:
+            outputs = controlnet(**inputs)[0]
+        loss = sum(output.float().pow(2).mean() for output in outputs)
+        loss.backward()
+        controlnet.zero_grad(set_to_none=True)
+
+    results = []
+    for policy in args.policies.split(","):
+        remove_activation_checkpointing(controlnet)
+        if policy == "none":
+            block_ids = []
+        elif policy == "all":
+            controlnet.enable_gradient_checkpointing()
+            block_ids = list(range(num_blocks))
+        else:
+            kind, value = parse_checkpointing_policy(policy)
+            if kind == "every":
+                block_ids = every_nth_block(num_blocks, value)
+            else:
+                block_ids, _ = blocks_for_budget(saved_bytes, input_bytes, value * 2**30)
+            apply_activation_checkpointing(controlnet, block_ids)
+
+        result = {"policy": policy, "checkpointed_blocks": len(block_ids), "num_blocks": num_blocks}
+        try:
+            for _ in range(args.warmup_steps):
+                train_step()
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            synchronize(device)
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                train_step()
+            synchronize(device)
+            result["step_s"] = (time.perf_counter() - start) / args.steps
+            if device.type == "cuda":
+                result["peak_memory_gib"] = torch.cuda.max_memory_allocated(device) / 2**30
+        except torch.cuda.OutOfMemoryError:
+            result["oom"] = True
+        controlnet.zero_grad(set_to_none=True)
+        free_memory()
+        results.append(result)
+
+        if result.get("oom"):
+            print(f"💥 {policy:>12}: out of memory with {len(block_ids)}/{num_blocks} checkpointed blocks")
+        else:
+            memory = f"{result['peak_memory_gib']:.2f} GiB" if "peak_memory_gib" in result else "n/a"
+            print(
+                f"✅ {policy:>12}: {len(block_ids):>3}/{num_blocks} checkpointed blocks,"
+                f" {result['step_s']:.3f} s/step, peak memory {memory}"
+            )
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Results saved to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
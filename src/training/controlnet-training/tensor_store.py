@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Memory-mapped, sharded array storage used by the training caches.
+
+Rows are raw arrays of a single dtype, possibly with different shapes, appended in order to fixed-size
+shard files. An index keeps the (shard, byte offset, shape) of every row, so reading a row is a zero-copy
+view into a memory-mapped shard. Stores are written to a temporary directory and renamed on close, so a
+crashed export never leaves a half-written store behind.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+DEFAULT_SHARD_BYTES = 1 << 30
+
+
+def _shard_name(shard_id):
+    return f"shard-{shard_id:05d}.bin"
+
+
+class ShardedArrayWriter:
+    def __init__(self, path, dtype, ndim, shard_bytes=DEFAULT_SHARD_BYTES):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.dtype = np.dtype(dtype)
+        self.ndim = ndim
+        self.shard_bytes = shard_bytes
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+        self.shard_ids = []
+        self.offsets = []
+        self.shapes = []
+        self.shard_id = -1
+        self.shard_file = None
+        self.shard_offset = 0
+
+    def _next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        self.shard_id += 1
+        self.shard_file = open(os.path.join(self.tmp_path, _shard_name(self.shard_id)), "wb")
+        self.shard_offset = 0
+
+    def append(self, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        if array.ndim != self.ndim:
+            raise ValueError(f"Expected a {self.ndim}-d array, got shape {array.shape}")
+        if self.shard_file is None or (self.shard_offset > 0 and self.shard_offset + array.nbytes > self.shard_bytes):
+            self._next_shard()
+        self.shard_file.write(array.tobytes())
+        self.shard_ids.append(self.shard_id)
+        self.offsets.append(self.shard_offset)
+        self.shapes.append(array.shape)
+        self.shard_offset += array.nbytes
+        return len(self.offsets) - 1
+
+    def close(self, meta=None):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        np.savez(
+            os.path.join(self.tmp_path, INDEX_FILE),
+            shard_ids=np.asarray(self.shard_ids, dtype=np.int32),
+            offsets=np.asarray(self.offsets, dtype=np.int64),
+            shapes=np.asarray(self.shapes, dtype=np.int64).reshape(len(self.shapes), self.ndim),
+        )
+        with open(os.path.join(self.tmp_path, META_FILE), "w") as f:
+            json.dump(
+                {"dtype": self.dtype.str, "ndim": self.ndim, "num_shards": self.shard_id + 1, "meta": meta or {}}, f
+            )
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+
+class ShardedArrayStore:
+    """
+    Read side of `ShardedArrayWriter`. Shards are memory-mapped lazily, so instances can be created in the
+    main process and used inside dataloader workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            info = json.load(f)
+        self.dtype = np.dtype(info["dtype"])
+        self.meta = info["meta"]
+        self.num_shards = info["num_shards"]
+        index = np.load(os.path.join(path, INDEX_FILE))
+        self.shard_ids = index["shard_ids"]
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self._shards = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def _shard(self, shard_id):
+        if self._shards is None:
+            self._shards = [None] * self.num_shards
+        if self._shards[shard_id] is None:
+            # copy-on-write keeps the file untouched while handing out writable (torch-friendly) views
+            self._shards[shard_id] = np.memmap(
+                os.path.join(self.path, _shard_name(shard_id)), dtype=np.uint8, mode="c"
+            )
+        return self._shards[shard_id]
+
+    def __getitem__(self, idx):
+        shape = tuple(self.shapes[idx])
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        offset = int(self.offsets[idx])
+        buffer = self._shard(int(self.shard_ids[idx]))[offset : offset + nbytes]
+        return buffer.view(self.dtype).reshape(shape)
+
+
+def open_store(path, expected_meta=None):
+    """Returns the store at `path`, or None if it is missing or was built with different settings."""
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    store = ShardedArrayStore(path)
+    if expected_meta is not None and store.meta != expected_meta:
+        return None
+    return store
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+import torch
+from accelerate import Accelerator
+from accelerate.state import AcceleratorState, GradientState
+
+from batch_prefetcher import BatchPrefetcher
+
+
+class Batches:
+    """A dataloader of `num_batches` batches that raises `error` at the end, if given."""
+
+    def __init__(self, num_batches, error=None):
+        self.num_batches = num_batches
+        self.error = error
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for i in range(self.num_batches):
+            yield {"x": torch.full((2,), float(i)), "ids": torch.tensor([i]), "name": f"batch-{i}"}
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def accelerator():
+    yield Accelerator(cpu=True, gradient_accumulation_steps=2)
+    AcceleratorState._reset_state(True)
+    GradientState._reset_state()
+
+
+def prefetcher_threads():
+    return [thread for thread in threading.enumerate() if thread.name == "batch-prefetcher"]
+
+
+def test_stages_batches_with_their_dtypes():
+    batches = list(BatchPrefetcher(Batches(3), "cpu", {"x": torch.bfloat16}))
+    assert [batch["name"] for batch in batches] == ["batch-0", "batch-1", "batch-2"]
+    assert all(batch["x"].dtype == torch.bfloat16 for batch in batches)
+    # Keys without a dtype keep theirs
+    assert all(batch["ids"].dtype == torch.int64 for batch in batches)
+    assert [batch["ids"].item() for batch in batches] == [0, 1, 2]
+
+
+def test_gradient_sync_matches_the_dataloader_without_prefetching(accelerator):
+    model = torch.nn.Linear(2, 2)
+    dataset = [{"x": torch.randn(2)} for _ in range(10)]
+
+    def sync_pattern(prefetch):
+        dataloader = torch.utils.data.DataLoader(dataset, batch_size=2)
+        prepared_model, dataloader = accelerator.prepare(model, dataloader, device_placement=[True, not prefetch])
+        batches = BatchPrefetcher(dataloader, accelerator.device) if prefetch else dataloader
+        pattern = []
+        for _ in range(2):
+            for _ in batches:
+                with accelerator.accumulate(prepared_model):
+                    pattern.append(accelerator.sync_gradients)
+        return pattern
+
+    expected = sync_pattern(prefetch=False)
+    # The last batch of every epoch syncs, even halfway through an accumulation
+    assert expected == [False, True, False, True, True] * 2
+    assert sync_pattern(prefetch=True) == expected
+    assert not accelerator.gradient_state.in_dataloader
+
+
+def test_early_break_stops_the_producer():
+    for batch in BatchPrefetcher(Batches(10), "cpu"):
+        break
+    assert batch["name"] == "batch-0"
+    # Blocked on the full queue when the loop left, it must notice and exit
+    for thread in prefetcher_threads():
+        thread.join(timeout=5)
+    assert not prefetcher_threads()
+
+
+def test_dataloader_errors_reach_the_training_loop():
+    names = []
+    with pytest.raises(RuntimeError, match="corrupt shard"):
+        for batch in BatchPrefetcher(Batches(3, error=RuntimeError("corrupt shard")), "cpu"):
+            names.append(batch["name"])
+    # The batch read ahead when the error came in is not handed out
+    assert names == ["batch-0", "batch-1"]
@@ -0,0 +1,92 @@
+import pytest
+from accelerate.data_loader import BatchSamplerShard
+
+from train_controlnet_sd3 import BucketBatchSampler
+
+
+# Three buckets of uneven sizes, none a multiple of the batch size
+BUCKET_IDS = [0] * 9 + [1] * 7 + [2] * 5
+BATCH_SIZE = 2
+
+
+def make_sampler(**kwargs):
+    return BucketBatchSampler(BUCKET_IDS, BATCH_SIZE, **kwargs)
+
+
+def test_epoch_covers_every_row_once_in_single_bucket_batches():
+    sampler = make_sampler(seed=0)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(index for batch in batches for index in batch) == list(range(len(BUCKET_IDS)))
+    assert all(len({BUCKET_IDS[index] for index in batch}) == 1 for batch in batches)
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+
+@pytest.mark.parametrize("consumed_batches", range(12))
+def test_resume_yields_the_rest_of_the_epoch(consumed_batches):
+    sampler = make_sampler(seed=0)
+    sampler.set_epoch(3)
+    uninterrupted = list(sampler)
+
+    # Built with another seed, as a relaunch without `--seed` would be
+    resumed = make_sampler(seed=1)
+    resumed.load_state_dict(sampler.state_dict(consumed_batches))
+    assert list(resumed) == uninterrupted[consumed_batches:]
+    # Only the first epoch after the resume starts late
+    assert list(resumed) == uninterrupted
+
+
+def test_resume_after_the_last_batch_starts_the_next_epoch():
+    sampler = make_sampler(seed=0)
+    sampler.set_epoch(3)
+    sampler.set_epoch(4)
+    next_epoch = list(sampler)
+
+    sampler.set_epoch(3)
+    resumed = make_sampler(seed=1)
+    resumed.load_state_dict(sampler.state_dict(len(sampler)))
+    assert resumed.epoch == 4
+    assert list(resumed) == next_epoch
+
+
+def shards(sampler_factory, num_processes, state=None):
+    """The batches of every process, each one sharding its own sampler as `accelerator.prepare` does."""
+    per_process = []
+    for process_index in range(num_processes):
+        sampler = sampler_factory()
+        if state is not None:
+            sampler.load_state_dict(state)
+        per_process.append(list(BatchSamplerShard(sampler, num_processes, process_index)))
+    return per_process
+
+
+@pytest.mark.parametrize("num_processes", [2, 3])
+def test_sharded_batches_are_full_and_even(num_processes):
+    per_process = shards(lambda: make_sampler(seed=0, num_processes=num_processes), num_processes)
+    assert len({len(batches) for batches in per_process}) == 1
+    batches = [batch for process_batches in per_process for batch in process_batches]
+    assert all(len(batch) == BATCH_SIZE for batch in batches)
+    assert all(len({BUCKET_IDS[index] for index in batch}) == 1 for batch in batches)
+    indices = [index for batch in batches for index in batch]
+    assert len(indices) == len(set(indices))
+
+
+@pytest.mark.parametrize("num_processes", [2, 3])
+def test_sharded_resume_yields_the_rest_of_every_process_epoch(num_processes):
+    def sampler_factory(seed=0, epoch=3):
+        sampler = make_sampler(seed=seed, num_processes=num_processes)
+        sampler.set_epoch(epoch)
+        return sampler
+
+    uninterrupted = shards(sampler_factory, num_processes)
+    steps = len(uninterrupted[0])
+    for step in range(steps):
+        # As in the training loop: every process consumed `step` batches
+        state = sampler_factory().state_dict(step * num_processes)
+        resumed = shards(lambda: sampler_factory(seed=1), num_processes, state)
+        assert resumed == [batches[step:] for batches in uninterrupted]
+
+    state = sampler_factory().state_dict(steps * num_processes)
+    resumed = shards(lambda: sampler_factory(seed=1), num_processes, state)
+    assert resumed == shards(lambda: sampler_factory(epoch=4), num_processes)
@@ -0,0 +1,110 @@
+import copy
+import shutil
+
+import pytest
+import torch
+
+from diffusers import SD3ControlNetModel, SD3Transformer2DModel
+from train_controlnet_sd3 import compile_repeated_blocks, enable_compile_cache
+
+
+pytestmark = pytest.mark.skipif(shutil.which("cc") is None, reason="inductor needs a C compiler on CPU")
+
+MODEL_CONFIG = {
+    "sample_size": 8,
+    "patch_size": 2,
+    "in_channels": 4,
+    "attention_head_dim": 8,
+    "num_attention_heads": 2,
+    "joint_attention_dim": 32,
+    "caption_projection_dim": 16,
+    "pooled_projection_dim": 32,
+    "out_channels": 4,
+    "pos_embed_max_size": 16,
+}
+
+
+def tiny_models():
+    torch.manual_seed(0)
+    transformer = SD3Transformer2DModel(num_layers=2, **MODEL_CONFIG)
+    controlnet = SD3ControlNetModel(num_layers=2, **MODEL_CONFIG)
+    return controlnet, transformer
+
+
+def training_step(controlnet, transformer, inputs):
+    """Forward and backward through both models, as in the training loop."""
+    control_block_samples = controlnet(**inputs)[0]
+    model_pred = transformer(
+        hidden_states=inputs["hidden_states"],
+        timestep=inputs["timestep"],
+        encoder_hidden_states=inputs["encoder_hidden_states"],
+        pooled_projections=inputs["pooled_projections"],
+        block_controlnet_hidden_states=control_block_samples,
+        return_dict=False,
+    )[0]
+    model_pred.float().pow(2).mean().backward()
+    return model_pred.detach(), {name: p.grad for name, p in controlnet.named_parameters() if p.grad is not None}
+
+
+@pytest.fixture
+def compile_cache(tmp_path, monkeypatch):
+    import torch._functorch.config as functorch_config
+    import torch._inductor.config as inductor_config
+
+    # Restored after the test, `enable_compile_cache` sets them for the whole process
+    monkeypatch.setenv("TORCHINDUCTOR_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(inductor_config, "fx_graph_cache", inductor_config.fx_graph_cache)
+    monkeypatch.setattr(functorch_config, "enable_autograd_cache", functorch_config.enable_autograd_cache)
+    torch._dynamo.reset()
+    yield tmp_path / "torch_compile"
+    torch._dynamo.reset()
+
+
+@pytest.mark.parametrize("gradient_checkpointing", [False, True])
+def test_compiled_blocks_match_eager_training_step(compile_cache, gradient_checkpointing):
+    controlnet, transformer = tiny_models()
+    transformer.requires_grad_(False)
+    if gradient_checkpointing:
+        controlnet.enable_gradient_checkpointing()
+        transformer.enable_gradient_checkpointing()
+    torch.manual_seed(1)
+    inputs = {
+        "hidden_states": torch.randn(2, 4, 8, 8),
+        "timestep": torch.full((2,), 500.0),
+        "encoder_hidden_states": torch.randn(2, 12, 32),
+        "pooled_projections": torch.randn(2, 32),
+        "controlnet_cond": torch.randn(2, 4, 8, 8),
+        "return_dict": False,
+    }
+    expected_pred, expected_grads = training_step(controlnet, transformer, inputs)
+    controlnet.zero_grad(set_to_none=True)
+
+    parameter_names = list(controlnet.state_dict())
+    enable_compile_cache(str(compile_cache))
+    assert compile_repeated_blocks(controlnet) + compile_repeated_blocks(transformer) == 4
+    # Checkpoints of compiled and eager runs stay interchangeable
+    assert list(controlnet.state_dict()) == parameter_names
+
+    pred, grads = training_step(controlnet, transformer, inputs)
+    torch.testing.assert_close(pred, expected_pred, rtol=1e-4, atol=1e-4)
+    for name, grad in grads.items():
+        # Compiled blocks give zeros where eager leaves the gradient of an unused output at None
+        expected = expected_grads.get(name, torch.zeros_like(grad))
+        torch.testing.assert_close(grad, expected, rtol=1e-3, atol=1e-5, msg=name)
+    assert expected_grads.keys() <= grads.keys()
+    assert any(compile_cache.iterdir())
+
+
+def test_compile_repeated_blocks_covers_single_blocks():
+    # SD3.5 controlnets without a context embedder are built of single blocks
+    controlnet = SD3ControlNetModel(
+        num_layers=2,
+        pos_embed_type=None,
+        use_pos_embed=False,
+        force_zeros_for_pooled_projection=False,
+        **{**MODEL_CONFIG, "joint_attention_dim": None},
+    )
+    compiled = copy.deepcopy(controlnet)
+    assert compile_repeated_blocks(compiled) == 2
+    assert all(block.__class__.__name__ == "SD3SingleTransformerBlock" for block in compiled.transformer_blocks)
+    assert all(block._compiled_call_impl is not None for block in compiled.transformer_blocks)
@@ -0,0 +1,87 @@
+import pytest
+import torch
+
+from diffusers import SD3Transformer2DModel
+from diffusers.models.attention import JointTransformerBlock
+from diffusers.models.attention_processor import JointAttnProcessor2_0
+from masked_joint_attention import MaskedJointAttnProcessor2_0, enable_masked_joint_attention
+
+
+DIM = 16
+NUM_IMAGE_TOKENS = 6
+# Real text tokens of the two samples, padded to the longest
+TEXT_LENGTHS = [5, 3]
+
+
+def tiny_block(context_pre_only):
+    torch.manual_seed(0)
+    return JointTransformerBlock(dim=DIM, num_attention_heads=2, attention_head_dim=8, context_pre_only=context_pre_only)
+
+
+def block_inputs():
+    torch.manual_seed(1)
+    hidden_states = torch.randn(len(TEXT_LENGTHS), NUM_IMAGE_TOKENS, DIM)
+    encoder_hidden_states = torch.randn(len(TEXT_LENGTHS), max(TEXT_LENGTHS), DIM)
+    mask = torch.arange(max(TEXT_LENGTHS))[None, :] < torch.tensor(TEXT_LENGTHS)[:, None]
+    # Zero padding, as the collate function pads trimmed embeddings
+    encoder_hidden_states = encoder_hidden_states * mask[..., None]
+    return hidden_states, encoder_hidden_states, torch.randn(len(TEXT_LENGTHS), DIM), mask
+
+
+@pytest.mark.parametrize("context_pre_only", [False, True])
+def test_matches_the_stock_processor_without_padding(context_pre_only):
+    block = tiny_block(context_pre_only)
+    hidden_states, encoder_hidden_states, temb, mask = block_inputs()
+    with torch.no_grad():
+        expected_context, expected = block(hidden_states, encoder_hidden_states, temb)
+        block.attn.set_processor(MaskedJointAttnProcessor2_0())
+        unmasked_context, unmasked = block(hidden_states, encoder_hidden_states, temb)
+        full_mask = torch.ones_like(mask)
+        context, output = block(
+            hidden_states, encoder_hidden_states, temb, joint_attention_kwargs={"encoder_attention_mask": full_mask}
+        )
+
+    torch.testing.assert_close(unmasked, expected)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+    if context_pre_only:
+        assert expected_context is None and context is None
+    else:
+        torch.testing.assert_close(context, expected_context, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("context_pre_only", [False, True])
+def test_masking_the_padding_equals_trimming_it(context_pre_only):
+    block = tiny_block(context_pre_only)
+    hidden_states, encoder_hidden_states, temb, mask = block_inputs()
+    block.attn.set_processor(MaskedJointAttnProcessor2_0())
+    with torch.no_grad():
+        context, output = block(
+            hidden_states, encoder_hidden_states, temb, joint_attention_kwargs={"encoder_attention_mask": mask}
+        )
+        block.attn.set_processor(JointAttnProcessor2_0())
+        for i, length in enumerate(TEXT_LENGTHS):
+            # Each sample alone, without any padding
+            trimmed_context, trimmed = block(
+                hidden_states[i : i + 1], encoder_hidden_states[i : i + 1, :length], temb[i : i + 1]
+            )
+            torch.testing.assert_close(output[i : i + 1], trimmed, rtol=1e-5, atol=1e-5)
+            if not context_pre_only:
+                torch.testing.assert_close(context[i : i + 1, :length], trimmed_context, rtol=1e-5, atol=1e-5)
+
+
+def test_enable_replaces_every_joint_processor():
+    transformer = SD3Transformer2DModel(
+        sample_size=8,
+        patch_size=2,
+        in_channels=4,
+        num_layers=2,
+        attention_head_dim=8,
+        num_attention_heads=2,
+        joint_attention_dim=32,
+        caption_projection_dim=16,
+        pooled_projection_dim=32,
+        out_channels=4,
+        pos_embed_max_size=16,
+    )
+    assert enable_masked_joint_attention(transformer) == 2
+    assert all(type(processor) is MaskedJointAttnProcessor2_0 for processor in transformer.attn_processors.values())
@@ -0,0 +1,119 @@
+import pytest
+import torch
+from torch import nn
+
+from diffusers import SD3Transformer2DModel
+from train_controlnet_sd3 import TRANSFORMER_QUANTIZATION_EXCLUDE
+from weight_quantization import QuantizedConv2d, QuantizedLinear, quantize_weights, weight_memory
+
+
+# Relative error of the outputs of a quantized layer
+TOLERANCES = {"int8": 0.02, "fp8": 0.1}
+
+
+def relative_error(actual, expected):
+    return ((actual - expected).norm() / expected.norm()).item()
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    return nn.Sequential(
+        nn.Conv2d(4, 32, 3, padding=1),
+        nn.SiLU(),
+        nn.Conv2d(32, 32, 3, stride=2, padding=1),
+        nn.Flatten(start_dim=2),
+        nn.Linear(16, 64),
+        nn.GELU(),
+        nn.Linear(64, 16, bias=False),
+    )
+
+
+@pytest.mark.parametrize("quantization", ["int8", "fp8"])
+def test_quantized_model_matches_outputs_and_input_gradients(quantization):
+    model = tiny_model().requires_grad_(False)
+    x = torch.randn(2, 4, 8, 8, requires_grad=True)
+    expected = model(x)
+    expected.pow(2).sum().backward()
+    expected_grad, x.grad = x.grad, None
+    expected_memory = weight_memory(model)
+
+    assert quantize_weights(model, quantization) == 4
+    assert [type(layer) for layer in model if isinstance(layer, (QuantizedLinear, QuantizedConv2d))] == [
+        QuantizedConv2d,
+        QuantizedConv2d,
+        QuantizedLinear,
+        QuantizedLinear,
+    ]
+    output = model(x)
+    output.pow(2).sum().backward()
+
+    assert relative_error(output, expected) < TOLERANCES[quantization]
+    # Frozen layers still pass gradients on to their inputs
+    assert relative_error(x.grad, expected_grad) < 2 * TOLERANCES[quantization]
+    # One byte per weight plus a scale per output channel, instead of four
+    assert weight_memory(model) < 0.3 * expected_memory
+
+
+@pytest.mark.parametrize("quantization", ["int8", "fp8"])
+def test_quantized_weights_survive_dtype_casts(quantization):
+    model = tiny_model()
+    quantize_weights(model, quantization)
+    model.to(dtype=torch.bfloat16)
+    assert model[0].weight_quantized.dtype in (torch.int8, torch.uint8)
+    assert model[0].weight_scale.dtype == torch.bfloat16
+
+    x = torch.randn(2, 4, 8, 8)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        assert model(x).dtype == torch.bfloat16
+
+
+def test_exclude_keeps_submodules_unquantized():
+    model = tiny_model()
+    assert quantize_weights(model, "int8", exclude=("0", "4")) == 2
+    assert type(model[0]) is nn.Conv2d
+    assert type(model[2]) is QuantizedConv2d
+    assert type(model[4]) is nn.Linear
+    assert type(model[6]) is QuantizedLinear
+
+
+def test_unknown_quantization():
+    with pytest.raises(ValueError, match="Unknown quantization"):
+        quantize_weights(tiny_model(), "int4")
+
+
+def test_quantized_transformer_passes_gradients_to_controlnet_residuals():
+    torch.manual_seed(0)
+    transformer = SD3Transformer2DModel(
+        sample_size=8,
+        patch_size=2,
+        in_channels=4,
+        num_layers=2,
+        attention_head_dim=8,
+        num_attention_heads=2,
+        joint_attention_dim=32,
+        caption_projection_dim=16,
+        pooled_projection_dim=32,
+        out_channels=4,
+        pos_embed_max_size=16,
+    ).requires_grad_(False)
+    inputs = {
+        "hidden_states": torch.randn(2, 4, 8, 8),
+        "encoder_hidden_states": torch.randn(2, 12, 32),
+        "pooled_projections": torch.randn(2, 32),
+        "timestep": torch.full((2,), 500.0),
+    }
+    # Added to the first block, the last one only updates the image tokens and takes no residual
+    residuals = [torch.randn(2, 16, 16, requires_grad=True)]
+
+    def loss_and_grads():
+        model_pred = transformer(**inputs, block_controlnet_hidden_states=residuals, return_dict=False)[0]
+        grads = torch.autograd.grad(model_pred.pow(2).mean(), residuals)
+        return model_pred.detach(), grads
+
+    expected_pred, expected_grads = loss_and_grads()
+    assert quantize_weights(transformer, "int8", exclude=TRANSFORMER_QUANTIZATION_EXCLUDE) > 0
+    pred, grads = loss_and_grads()
+
+    assert relative_error(pred, expected_pred) < 0.05
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.nn.functional.cosine_similarity(grad.flatten(), expected_grad.flatten(), dim=0) > 0.99
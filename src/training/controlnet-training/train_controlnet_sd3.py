@@ -17,27 +17,46 @@
 import argparse
 import contextlib
 import copy
-import functools
-import gc
+import io
+import itertools
+import json
 import logging
 import math
 import os
 import random
 import shutil
+import subprocess
+import sys
 
 # Add repo root to path to import from tests
 from pathlib import Path
 
 import accelerate
 import numpy as np
+import safetensors.torch
 import torch
 import torch.utils.checkpoint
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
+from accelerate.utils import (
+    OPTIMIZER_NAME,
+    RNG_STATE_NAME,
+    SCALER_NAME,
+    SCHEDULER_NAME,
+    DistributedDataParallelKwargs,
+    ProjectConfiguration,
+    broadcast_object_list,
+    gather_object,
+    send_to_device,
+    set_seed,
+)
+from datasets import Image as ImageFeature
 from datasets import load_dataset
+from datasets.distributed import split_dataset_by_node
+from datasets.fingerprint import Hasher
 from huggingface_hub import create_repo, upload_folder
+from huggingface_hub.constants import HF_HOME
 from packaging import version
 from PIL import Image
 from torchvision import transforms
@@ -54,10 +73,30 @@ from diffusers import (
     StableDiffusion3ControlNetPipeline,
 )
 from diffusers.optimization import get_scheduler
-from diffusers.training_utils import compute_density_for_timestep_sampling, compute_loss_weighting_for_sd3, free_memory
-from diffusers.utils import check_min_version, is_wandb_available, make_image_grid
+from diffusers.training_utils import (
+    compute_density_for_timestep_sampling,
+    compute_loss_weighting_for_sd3,
+    find_nearest_bucket,
+    free_memory,
+    parse_buckets_string,
+)
+from diffusers.utils import SAFETENSORS_WEIGHTS_NAME, check_min_version, is_wandb_available, make_image_grid
 from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
-from diffusers.utils.torch_utils import backend_empty_cache, is_compiled_module
+from diffusers.utils.torch_utils import is_compiled_module
+from activation_checkpointing import (
+    apply_activation_checkpointing,
+    blocks_for_budget,
+    every_nth_block,
+    measure_block_activations,
+    parse_checkpointing_policy,
+)
+from async_checkpoint import AsyncCheckpointWriter
+from batch_prefetcher import BatchPrefetcher
+from masked_joint_attention import enable_masked_joint_attention
+from prompt_embedding_cache import PromptEmbeddingCache
+from step_profiler import StepProfiler
+from weight_quantization import quantize_weights, weight_memory
+from tensor_store import ShardedArrayWriter, open_store
 
 
 if is_wandb_available():
@@ -69,31 +108,84 @@ check_min_version("0.37.0.dev0")
 logger = get_logger(__name__)
 
 
-def log_validation(controlnet, args, accelerator, weight_dtype, step, is_final_validation=False):
+def log_validation(pipeline, embeddings, args, accelerator, step, is_final_validation=False):
     logger.info("Running validation... ")
 
-    if not is_final_validation:
-        controlnet = accelerator.unwrap_model(controlnet)
-    else:
-        controlnet = SD3ControlNetModel.from_pretrained(args.output_dir, torch_dtype=weight_dtype)
-
-    pipeline = StableDiffusion3ControlNetPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        controlnet=None,
-        safety_checker=None,
-        transformer=None,
-        revision=args.revision,
-        variant=args.variant,
-        torch_dtype=weight_dtype,
-    )
-    pipeline = pipeline.to(torch.device(accelerator.device))
-    pipeline.set_progress_bar_config(disable=True)
-
     if args.seed is None:
         generator = None
     else:
         generator = torch.manual_seed(args.seed)
 
+    validation_images, validation_prompts = get_validation_pairs(args)
+    embeddings = tuple(None if embedding is None else embedding.to(accelerator.device) for embedding in embeddings)
+
+    # The live controlnet is kept in float32, an upcast VAE decodes half-precision latents
+    if is_final_validation and pipeline.vae.dtype == pipeline.transformer.dtype:
+        inference_ctx = contextlib.nullcontext()
+    else:
+        inference_ctx = torch.autocast(accelerator.device.type)
+    image_logs = generate_validation_images(
+        pipeline,
+        args,
+        validation_images,
+        validation_prompts,
+        embeddings,
+        generator,
+        inference_ctx,
+    )
+
+    tracker_key = "test" if is_final_validation else "validation"
+    log_validation_images(accelerator.trackers, image_logs, step, tracker_key)
+
+    return image_logs
+
+
+def build_validation_pipeline(controlnet, transformer, vae, noise_scheduler):
+    """
+    Wraps the models the training already holds, on their current devices, into a validation pipeline. The text
+    encoders are left out, validation prompts are read from the prompt embedding cache by `get_validation_embeddings`.
+    """
+    pipeline = StableDiffusion3ControlNetPipeline(
+        transformer=transformer,
+        scheduler=FlowMatchEulerDiscreteScheduler.from_config(noise_scheduler.config),
+        vae=vae,
+        text_encoder=None,
+        tokenizer=None,
+        text_encoder_2=None,
+        tokenizer_2=None,
+        text_encoder_3=None,
+        tokenizer_3=None,
+        controlnet=controlnet,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def get_validation_embeddings(args, prompt_embedding_cache):
+    """
+    Stacks the cached embeddings of the validation prompts and of the empty negative prompt, kept on CPU. Trimmed
+    embeddings are padded to a common length, with the masks of their real tokens, which are None otherwise.
+    """
+    _, validation_prompts = get_validation_pairs(args)
+    num_prompts = len(validation_prompts)
+    prompt_embeds, pooled_prompt_embeds = zip(*(prompt_embedding_cache[prompt] for prompt in validation_prompts))
+    negative_prompt_embeds, negative_pooled_prompt_embeds = prompt_embedding_cache[""]
+    prompt_embeds, attention_mask = pad_prompt_embeds(list(prompt_embeds) + [negative_prompt_embeds])
+    negative_attention_mask = None
+    if attention_mask is not None:
+        attention_mask, negative_attention_mask = attention_mask[:num_prompts], attention_mask[num_prompts:]
+        negative_attention_mask = negative_attention_mask.expand(num_prompts, -1)
+    return (
+        prompt_embeds[:num_prompts],
+        prompt_embeds[num_prompts:].expand(num_prompts, -1, -1),
+        torch.stack(pooled_prompt_embeds),
+        torch.stack([negative_pooled_prompt_embeds] * num_prompts),
+        attention_mask,
+        negative_attention_mask,
+    )
+
+
+def get_validation_pairs(args):
     if len(args.validation_image) == len(args.validation_prompt):
         validation_images = args.validation_image
         validation_prompts = args.validation_prompt
@@ -107,44 +199,33 @@ def log_validation(controlnet, args, accelerator, weight_dtype, step, is_final_v
         raise ValueError(
             "number of `args.validation_image` and `args.validation_prompt` should be checked in `parse_args`"
         )
+    return validation_images, validation_prompts
 
-    with torch.no_grad():
-        (
-            prompt_embeds,
-            negative_prompt_embeds,
-            pooled_prompt_embeds,
-            negative_pooled_prompt_embeds,
-        ) = pipeline.encode_prompt(
-            validation_prompts,
-            prompt_2=None,
-            prompt_3=None,
-        )
-
-    del pipeline
-    gc.collect()
-    backend_empty_cache(accelerator.device.type)
-
-    pipeline = StableDiffusion3ControlNetPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        controlnet=controlnet,
-        safety_checker=None,
-        text_encoder=None,
-        text_encoder_2=None,
-        text_encoder_3=None,
-        revision=args.revision,
-        variant=args.variant,
-        torch_dtype=weight_dtype,
-    )
-    pipeline.enable_model_cpu_offload(device=accelerator.device.type)
-    pipeline.set_progress_bar_config(disable=True)
 
+def generate_validation_images(
+    pipeline, args, validation_images, validation_prompts, embeddings, generator, inference_ctx
+):
+    (
+        prompt_embeds,
+        negative_prompt_embeds,
+        pooled_prompt_embeds,
+        negative_pooled_prompt_embeds,
+        attention_mask,
+        negative_attention_mask,
+    ) = embeddings
     image_logs = []
-    inference_ctx = contextlib.nullcontext() if is_final_validation else torch.autocast(accelerator.device.type)
 
     for i, validation_image in enumerate(validation_images):
         validation_image = Image.open(validation_image).convert("RGB")
         validation_prompt = validation_prompts[i]
 
+        joint_attention_kwargs = None
+        if attention_mask is not None:
+            # The pipeline puts the negative prompt first in the classifier-free guidance batch
+            joint_attention_kwargs = {
+                "encoder_attention_mask": torch.stack([negative_attention_mask[i], attention_mask[i]])
+            }
+
         images = []
 
         for _ in range(args.num_validation_images):
@@ -157,6 +238,7 @@ def log_validation(controlnet, args, accelerator, weight_dtype, step, is_final_v
                     control_image=validation_image,
                     num_inference_steps=20,
                     generator=generator,
+                    joint_attention_kwargs=joint_attention_kwargs,
                 ).images[0]
 
             images.append(image)
@@ -165,8 +247,11 @@ def log_validation(controlnet, args, accelerator, weight_dtype, step, is_final_v
             {"validation_image": validation_image, "images": images, "validation_prompt": validation_prompt}
         )
 
-    tracker_key = "test" if is_final_validation else "validation"
-    for tracker in accelerator.trackers:
+    return image_logs
+
+
+def log_validation_images(trackers, image_logs, step, tracker_key):
+    for tracker in trackers:
         if tracker.name == "tensorboard":
             for log in image_logs:
                 images = log["images"]
@@ -198,18 +283,10 @@ def log_validation(controlnet, args, accelerator, weight_dtype, step, is_final_v
                     image = wandb.Image(image, caption=validation_prompt)
                     formatted_images.append(image)
 
-            tracker.log({tracker_key: formatted_images})
+            tracker.log({tracker_key: formatted_images}, step=step)
         else:
             logger.warning(f"image logging not implemented for {tracker.name}")
 
-    del pipeline
-    free_memory()
-
-    if not is_final_validation:
-        controlnet.to(accelerator.device)
-
-    return image_logs
-
 
 # Copied from dreambooth sd3 example
 def load_text_encoders(class_one, class_two, class_three):
@@ -375,6 +452,15 @@ def parse_args(input_args=None):
         default=None,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Copy the training state to CPU memory at each checkpoint and write it to disk, then prune old"
+            " checkpoints, on a background thread while training continues. At most one write is in flight and"
+            " checkpoints only appear under their final name once complete."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -395,6 +481,54 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
     )
+    parser.add_argument(
+        "--gradient_checkpointing_policy",
+        type=str,
+        default="all",
+        help=(
+            "Which controlnet blocks `--gradient_checkpointing` recomputes: `all`, `every:N` (every Nth block) or"
+            " `budget:GIB`, the fewest blocks that keep the controlnet activations saved for the backward pass under"
+            " GIB GiB per micro-batch, as measured on one sample at startup. `sweep_gradient_checkpointing.py`"
+            " measures peak memory and step time of each policy."
+        ),
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help=(
+            "Compile the transformer blocks of the controlnet and of the frozen transformer with `torch.compile`,"
+            " block by block (regional compilation) so compile time does not grow with depth. Compatible with"
+            " `--gradient_checkpointing`. Keep `accelerate launch --dynamo_backend=no`, which compiles whole models."
+        ),
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Persistent cache of the `--compile` artifacts, reused by later launches with the same models and"
+            " settings. Defaults to `<cache_dir or HF_HOME>/torch_compile`."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_transformer",
+        type=str,
+        default=None,
+        choices=["int8", "fp8"],
+        help=(
+            "Keep the weights of the frozen transformer in int8 or fp8 (per output channel scales), dequantized"
+            " on the fly. Activations and the gradients flowing back to the controlnet keep the training precision."
+            " `check_weight_quantization.py` compares the loss and controlnet gradients against the unquantized"
+            " transformer."
+        ),
+    )
+    parser.add_argument(
+        "--quantize_vae",
+        type=str,
+        default=None,
+        choices=["int8", "fp8"],
+        help="Keep the weights of the frozen VAE in int8 or fp8, dequantized on the fly.",
+    )
     parser.add_argument(
         "--upcast_vae",
         action="store_true",
@@ -442,6 +576,43 @@ def parse_args(input_args=None):
             "Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
         ),
     )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=None,
+        help="Batches loaded in advance by each worker. Defaults to the PyTorch default, only used with workers.",
+    )
+    parser.add_argument(
+        "--dataloader_persistent_workers",
+        action="store_true",
+        help="Keep the data loading workers alive between epochs instead of starting new ones every epoch.",
+    )
+    parser.add_argument(
+        "--dataloader_pin_memory",
+        action="store_true",
+        help=(
+            "Load batches into pinned memory, for faster host to device copies. Always on with `--streaming` and"
+            " `--prefetch_to_device`."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch_to_device",
+        action="store_true",
+        help=(
+            "Copy the next batch to the device and cast it to the training dtypes while the current step runs, on a"
+            " side CUDA stream, or on a background thread on other devices."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_config",
+        type=str,
+        default=None,
+        help=(
+            "JSON file written by `benchmark_dataloader.py --output_file`. Its best configuration overrides"
+            " `--dataloader_num_workers`, `--dataloader_prefetch_factor`, `--dataloader_persistent_workers` and"
+            " `--dataloader_pin_memory`."
+        ),
+    )
     parser.add_argument(
         "--weighting_scheme",
         type=str,
@@ -489,6 +660,23 @@ def parse_args(input_args=None):
             " *output_dir/runs/**CURRENT_DATETIME_HOSTNAME***."
         ),
     )
+    parser.add_argument(
+        "--logging_steps",
+        type=int,
+        default=1,
+        help=(
+            "Log the training loss every X optimizer steps, averaged over their micro-batches. The loss is"
+            " accumulated on the device and only read back by the host at these steps."
+        ),
+    )
+    parser.add_argument(
+        "--detect_sync_points",
+        action="store_true",
+        help=(
+            "Debugging: warn about every operation that synchronizes the host with the CUDA device inside the"
+            " training step (e.g. `.item()`, `.nonzero()`, device to host copies), with the line that caused it."
+        ),
+    )
     parser.add_argument(
         "--allow_tf32",
         action="store_true",
@@ -506,6 +694,16 @@ def parse_args(input_args=None):
             ' (default), `"wandb"` and `"comet_ml"`. Use `"all"` to report to all integrations.'
         ),
     )
+    parser.add_argument(
+        "--profile_training",
+        action="store_true",
+        help=(
+            "Time every phase of the training step (dataloader wait, VAE encoding, controlnet and transformer"
+            " forwards, backward, optimizer) and log it with samples/s, optimizer steps/hour and peak memory to the"
+            " trackers under `profile/`, plus a summary in `<output_dir>/training_profile.json`. The device is"
+            " synchronized at every phase boundary, so this slows training down."
+        ),
+    )
     parser.add_argument(
         "--mixed_precision",
         type=str,
@@ -552,6 +750,23 @@ def parse_args(input_args=None):
             " must exist to provide the captions for the images. Ignored if `dataset_name` is specified."
         ),
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Stream the dataset from its shards (WebDataset tar, Parquet or Arrow files in `--train_data_dir`, or a"
+            " hub dataset) instead of loading it with random access. Shards are split across processes and"
+            " dataloader workers and read in place, nothing is copied to local disk. Rows are shuffled in a bounded"
+            " buffer and the shard order changes every epoch. Requires `--max_train_steps`; a resumed run starts with"
+            " the shard order of the next epoch."
+        ),
+    )
+    parser.add_argument(
+        "--streaming_shuffle_buffer",
+        type=int,
+        default=1000,
+        help="Number of decoded rows each dataloader worker shuffles among with `--streaming`.",
+    )
     parser.add_argument(
         "--image_column", type=str, default="image", help="The column of the dataset containing the target image."
     )
@@ -561,6 +776,15 @@ def parse_args(input_args=None):
         default="conditioning_image",
         help="The column of the dataset containing the controlnet conditioning image.",
     )
+    parser.add_argument(
+        "--single_channel_conditioning",
+        action="store_true",
+        help=(
+            "Decode the conditioning images (the sketches) as single-channel grayscale and keep them as one channel"
+            " through caching, collation and the copy to the device, where they are expanded to the three VAE"
+            " channels as a view."
+        ),
+    )
     parser.add_argument(
         "--caption_column",
         type=str,
@@ -588,9 +812,84 @@ def parse_args(input_args=None):
         default=77,
         help="Maximum sequence length to use with with the T5 text encoder",
     )
+    parser.add_argument(
+        "--trim_prompt_embeds",
+        action="store_true",
+        help=(
+            "Drop the T5 padding from the cached prompt embeddings and pad every batch only to its longest caption,"
+            " masking the padding in the transformer's joint attention. Joint attention cost follows the number of"
+            " text tokens, so short captions make cheaper steps, and a larger `--max_sequence_length` (e.g. 256)"
+            " stops truncating long captions without slowing down the short ones."
+        ),
+    )
+    parser.add_argument(
+        "--prompt_length_bucket_size",
+        type=int,
+        default=32,
+        help=(
+            "With `--trim_prompt_embeds`, batches are drawn from captions whose embedding lengths fall in the same"
+            " range of this many tokens, so little padding is added back."
+        ),
+    )
     parser.add_argument(
         "--dataset_preprocess_batch_size", type=int, default=1000, help="Batch size for preprocessing dataset."
     )
+    parser.add_argument(
+        "--prompt_embedding_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of the persistent prompt embedding cache. Entries are keyed by the caption and the text encoder"
+            " settings only, so it can be shared between runs. Defaults to `<cache_dir>/sd3_prompt_embeddings`, or"
+            " `$HF_HOME/sd3_prompt_embeddings` when `--cache_dir` is not set."
+        ),
+    )
+    parser.add_argument(
+        "--aspect_ratio_buckets",
+        type=str,
+        default=None,
+        help=(
+            "Train on whole images resized to the nearest of a few aspect ratio buckets instead of square random"
+            " crops. Either `portrait`, for buckets from square to 16:9 with about `--resolution`**2 pixels each, or"
+            " explicit `height,width` pairs separated by semicolons, e.g. `1024,1024;1152,896;1280,832;1344,768`."
+            " Each batch is drawn from a single bucket."
+        ),
+    )
+    parser.add_argument(
+        "--cache_images",
+        action="store_true",
+        help=(
+            "Decode and resize the target and conditioning images (shortest edge to `--resolution`) once, store them"
+            " as uint8 memory-mapped shards and only crop and normalize them during training."
+        ),
+    )
+    parser.add_argument(
+        "--image_cache_dir",
+        type=str,
+        default=None,
+        help="Directory for the `--cache_images` shards. Defaults to `<output_dir>/image_cache`.",
+    )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        help=(
+            "Encode the target and conditioning images with the VAE once, store the latent distribution parameters"
+            " as fp16 memory-mapped shards and train from them with the VAE unloaded. Images are encoded at full size"
+            " (shortest edge resized to `--resolution`) and the random crop is taken in latent space."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help="Directory for the `--cache_latents` shards. Defaults to `<output_dir>/latent_cache`.",
+    )
+    parser.add_argument(
+        "--vae_encode_batch_size",
+        type=int,
+        default=8,
+        help="Batch size used by the VAE when building the `--cache_latents` shards.",
+    )
     parser.add_argument(
         "--validation_prompt",
         type=str,
@@ -630,6 +929,24 @@ def parse_args(input_args=None):
             " and logging the images."
         ),
     )
+    parser.add_argument(
+        "--validation_worker",
+        action="store_true",
+        help=(
+            "Run validation in a separate process (`validation_worker.py`) started by the main process instead of"
+            " inline. The worker keeps its own pipeline resident, validates every new checkpoint and logs to the same"
+            " trackers under the checkpoint's step, so `--validation_steps` is replaced by `--checkpointing_steps`."
+        ),
+    )
+    parser.add_argument(
+        "--validation_device",
+        type=str,
+        default=None,
+        help=(
+            "Device of the `--validation_worker` process, e.g. `cuda:1`. Required with `--validation_worker` and must"
+            " not be one of the training GPUs, the worker keeps a whole pipeline resident next to training."
+        ),
+    )
     parser.add_argument(
         "--tracker_project_name",
         type=str,
@@ -672,15 +989,598 @@ def parse_args(input_args=None):
             " or the same number of `--validation_prompt`s and `--validation_image`s"
         )
 
+    if args.validation_worker and args.validation_prompt is not None and args.validation_device is None:
+        raise ValueError("`--validation_worker` needs `--validation_device`, a device that training does not use.")
+
     if args.resolution % 8 != 0:
         raise ValueError(
             "`--resolution` must be divisible by 8 for consistently sized encoded images between the VAE and the controlnet encoder."
         )
 
+    if args.max_sequence_length > 512:
+        raise ValueError(f"`--max_sequence_length` cannot be greater than 512, got {args.max_sequence_length}.")
+
+    if args.prompt_length_bucket_size < 1:
+        raise ValueError("`--prompt_length_bucket_size` must be at least 1.")
+
+    if args.prompt_embedding_cache_dir is None:
+        args.prompt_embedding_cache_dir = os.path.join(args.cache_dir or HF_HOME, "sd3_prompt_embeddings")
+    parse_checkpointing_policy(args.gradient_checkpointing_policy)
+    if args.compile_cache_dir is None:
+        args.compile_cache_dir = os.path.join(args.cache_dir or HF_HOME, "torch_compile")
+
+    if args.aspect_ratio_buckets is not None and args.aspect_ratio_buckets != "portrait":
+        # Fail early on a malformed bucket string
+        parse_buckets_string(args.aspect_ratio_buckets)
+
+    if args.streaming:
+        if args.max_train_steps is None:
+            raise ValueError("`--streaming` needs `--max_train_steps`, the length of a stream is unknown.")
+        # These need random access to the rows
+        for name in ("aspect_ratio_buckets", "cache_images", "cache_latents", "max_train_samples"):
+            if getattr(args, name):
+                raise ValueError(f"`--{name}` cannot be used with `--streaming`.")
+
+    if args.cache_images and args.cache_latents:
+        raise ValueError("`--cache_images` and `--cache_latents` cannot be used together.")
+
+    if args.cache_images and args.image_cache_dir is None:
+        args.image_cache_dir = os.path.join(args.output_dir, "image_cache")
+
+    if args.cache_latents and args.latent_cache_dir is None:
+        args.latent_cache_dir = os.path.join(args.output_dir, "latent_cache")
+
+    if args.dataloader_config is not None:
+        with open(args.dataloader_config) as f:
+            config = json.load(f)
+        # The output of `benchmark_dataloader.py`, or just its best configuration
+        config = config.get("best", config)
+        unknown = set(config) - set(DATALOADER_CONFIG_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in `--dataloader_config` {args.dataloader_config}.")
+        for key, value in config.items():
+            setattr(args, key, value)
+
+    if args.dataloader_num_workers == 0 and (
+        args.dataloader_prefetch_factor is not None or args.dataloader_persistent_workers
+    ):
+        raise ValueError(
+            "`--dataloader_prefetch_factor` and `--dataloader_persistent_workers` need `--dataloader_num_workers` > 0."
+        )
+
     return args
 
 
-def make_train_dataset(args, tokenizer_one, tokenizer_two, tokenizer_three, accelerator):
+def portrait_buckets(resolution, multiple=64):
+    """Portrait (height, width) buckets of about `resolution`**2 pixels, from square to 16:9."""
+    buckets = []
+    for aspect_ratio in (1.0, 4 / 3, 3 / 2, 16 / 9):
+        height = max(multiple, round(resolution * math.sqrt(aspect_ratio) / multiple) * multiple)
+        width = max(multiple, round(resolution / math.sqrt(aspect_ratio) / multiple) * multiple)
+        if (height, width) not in buckets:
+            buckets.append((height, width))
+    return buckets
+
+
+def get_buckets(args):
+    if args.aspect_ratio_buckets is None:
+        return None
+    if args.aspect_ratio_buckets == "portrait":
+        return portrait_buckets(args.resolution)
+    return parse_buckets_string(args.aspect_ratio_buckets)
+
+
+def target_size(args, buckets, bucket):
+    # (height, width) of a training sample: its whole bucket, or the square `--resolution` crop
+    if buckets is None:
+        return args.resolution, args.resolution
+    return tuple(buckets[bucket])
+
+
+def resize_to_target(image, args, buckets, bucket, interpolation):
+    # Without buckets the shortest edge goes to `--resolution` and the sample is cropped afterwards
+    if buckets is None:
+        return TF.resize(image, args.resolution, interpolation=interpolation)
+    return TF.resize(image, list(buckets[bucket]), interpolation=interpolation)
+
+
+# Blocks repeated along the depth of `SD3Transformer2DModel` and `SD3ControlNetModel` (SD3.5 controlnets
+# without a context embedder use the single variant)
+REPEATED_BLOCK_CLASSES = ("JointTransformerBlock", "SD3SingleTransformerBlock")
+
+
+def enable_compile_cache(cache_dir):
+    """Points inductor (and triton) at a persistent directory and caches the compiled forward and backward graphs."""
+    import torch._functorch.config as functorch_config
+    import torch._inductor.config as inductor_config
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    inductor_config.fx_graph_cache = True
+    functorch_config.enable_autograd_cache = True
+
+
+def compile_repeated_blocks(model, **compile_kwargs):
+    """
+    Compiles every transformer block of `model` in place. Blocks of the same class share their compiled graph, and
+    parameter names are unchanged, so checkpoints and `accelerator.prepare` are unaffected.
+    """
+    num_blocks = 0
+    for module in model.modules():
+        if module.__class__.__name__ in REPEATED_BLOCK_CLASSES:
+            module.compile(**compile_kwargs)
+            num_blocks += 1
+    return num_blocks
+
+
+def controlnet_example_inputs(controlnet, transformer, args, batch_size, device):
+    """Random controlnet inputs with the shapes of a training batch at `--resolution`."""
+    latent_size = args.resolution // 8
+    latents = torch.randn(batch_size, controlnet.config.in_channels, latent_size, latent_size)
+    if controlnet.pos_embed is None:
+        with torch.no_grad():
+            latents = transformer.pos_embed.to(latents.device)(latents)
+    encoder_hidden_states = None
+    if controlnet.context_embedder is not None:
+        # CLIP tokens followed by T5 tokens, see `encode_prompt`
+        encoder_hidden_states = torch.randn(
+            batch_size, 77 + args.max_sequence_length, controlnet.config.joint_attention_dim
+        ).to(device)
+    return {
+        "hidden_states": latents.to(device),
+        "timestep": torch.full((batch_size,), 500.0, device=device),
+        "encoder_hidden_states": encoder_hidden_states,
+        "pooled_projections": torch.randn(batch_size, controlnet.config.pooled_projection_dim, device=device),
+        "controlnet_cond": torch.randn(
+            batch_size, controlnet.pos_embed_input.proj.in_channels, latent_size, latent_size, device=device
+        ),
+        "return_dict": False,
+    }
+
+
+def select_blocks_for_budget(controlnet, transformer, args, accelerator, budget_gib):
+    # Measured on a single sample, activations grow linearly with the batch size
+    controlnet.to(accelerator.device)
+    inputs = controlnet_example_inputs(controlnet, transformer, args, 1, accelerator.device)
+    with accelerator.autocast():
+        saved_bytes, input_bytes = measure_block_activations(controlnet, lambda: controlnet(**inputs))
+    del inputs
+    free_memory()
+
+    block_ids, kept_bytes = blocks_for_budget(
+        [saved * args.train_batch_size for saved in saved_bytes],
+        [inputs * args.train_batch_size for inputs in input_bytes],
+        budget_gib * 2**30,
+    )
+    logger.info(
+        f"Controlnet activations: {sum(saved_bytes) * args.train_batch_size / 2**30:.2f} GiB without checkpointing,"
+        f" {kept_bytes / 2**30:.2f} GiB with {len(block_ids)} checkpointed blocks"
+    )
+    if kept_bytes > budget_gib * 2**30:
+        logger.warning(f"The {budget_gib} GiB activation budget cannot be met, even with every block checkpointed")
+    return block_ids
+
+
+# Controlnets without their own patch embedding load the transformer's, it stays unquantized
+TRANSFORMER_QUANTIZATION_EXCLUDE = ("pos_embed",)
+
+TRAINING_POSITION_FILE = "training_position.json"
+
+# Not inherited by the validation worker, which is a single-process program
+DISTRIBUTED_ENV_VARS = ("RANK", "LOCAL_RANK", "WORLD_SIZE", "LOCAL_WORLD_SIZE", "MASTER_ADDR", "MASTER_PORT")
+
+# Arguments tuned by `benchmark_dataloader.py` and read back by `--dataloader_config`
+DATALOADER_CONFIG_KEYS = (
+    "dataloader_num_workers",
+    "dataloader_prefetch_factor",
+    "dataloader_persistent_workers",
+    "dataloader_pin_memory",
+)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of indices that all belong to the same bucket. Rows are shuffled within their bucket and
+    the batches are shuffled across buckets, deterministically for a given seed and epoch. Without buckets
+    every row is in bucket 0 and this is a plain shuffled batch sampler.
+
+    The order of an epoch is a pure function of (seed, epoch), so a run can resume in the middle of an epoch
+    by slicing off the batches it already consumed, without loading them.
+
+    With several processes, accelerate's `BatchSamplerShard` hands the batches out round-robin and expects every
+    one of them to be full: a short bucket tail would unbalance the ranks, and its padding would mix buckets. So
+    the short tail of every bucket is dropped, as are the last batches that do not make a full round, which
+    differ from epoch to epoch.
+    """
+
+    def __init__(self, bucket_ids, batch_size, seed=None, num_processes=1):
+        self.batch_size = batch_size
+        self.num_processes = num_processes
+        # Read by `BatchSamplerShard`
+        self.drop_last = num_processes > 1
+        self.seed = seed if seed is not None else random.randrange(2**31)
+        self.epoch = 0
+        self.start_batch = 0
+        self.bucket_indices = {}
+        for index, bucket in enumerate(bucket_ids):
+            self.bucket_indices.setdefault(bucket, []).append(index)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self, consumed_batches):
+        # `consumed_batches` counts batches of this sampler, across all processes, since the start of `self.epoch`
+        if consumed_batches >= len(self):
+            return {"seed": self.seed, "epoch": self.epoch + 1, "consumed_batches": 0}
+        return {"seed": self.seed, "epoch": self.epoch, "consumed_batches": consumed_batches}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        # Only the next iteration starts late
+        self.start_batch = state["consumed_batches"]
+
+    def batches(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in sorted(self.bucket_indices):
+            indices = self.bucket_indices[bucket]
+            order = torch.randperm(len(indices), generator=generator).tolist()
+            shuffled = [indices[i] for i in order]
+            batches.extend(shuffled[i : i + self.batch_size] for i in range(0, len(shuffled), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches[: len(self)]
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        yield from self.batches()[start_batch:]
+
+    def __len__(self):
+        if not self.drop_last:
+            return sum(math.ceil(len(indices) / self.batch_size) for indices in self.bucket_indices.values())
+        num_batches = sum(len(indices) // self.batch_size for indices in self.bucket_indices.values())
+        return num_batches - num_batches % self.num_processes
+
+
+class StreamingEpochs:
+    """
+    Counterpart of `BucketBatchSampler` for `--streaming`, where the order is set by the dataset itself: `set_epoch`
+    reshuffles its shards. The position inside a stream cannot be restored, so a checkpoint resumes at the start of
+    the next epoch.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.dataset.set_epoch(epoch)
+
+    def state_dict(self, consumed_batches):
+        return {"epoch": self.epoch + 1, "consumed_batches": 0}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+
+
+def dataloader_kwargs(args):
+    kwargs = {
+        "num_workers": args.dataloader_num_workers,
+        # `--streaming` and `--prefetch_to_device` batches are copied to the device with `non_blocking=True`
+        "pin_memory": args.dataloader_pin_memory or args.streaming or args.prefetch_to_device,
+    }
+    if args.dataloader_num_workers > 0:
+        kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+        kwargs["persistent_workers"] = args.dataloader_persistent_workers
+    return kwargs
+
+
+def make_train_dataloader(args, train_dataset, prompt_embedding_cache, num_processes=1, sampler_seed=None):
+    """
+    Returns the training dataloader and its batch sampler, or `StreamingEpochs` with `--streaming`. The sampler is
+    seeded with `sampler_seed`, or `--seed` when not given.
+    """
+    if args.streaming:
+        # Each worker reads its own shards of this process, in the order set by `batch_sampler.set_epoch`
+        batch_sampler = StreamingEpochs(train_dataset)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.train_batch_size,
+            collate_fn=collate_fn,
+            **dataloader_kwargs(args),
+        )
+        return train_dataloader, batch_sampler
+
+    if args.aspect_ratio_buckets is not None:
+        # Every batch comes from a single bucket so the samples can be stacked without cropping
+        bucket_ids = train_dataset.with_format(None)["bucket"]
+    else:
+        bucket_ids = [0] * len(train_dataset)
+    if args.trim_prompt_embeds:
+        # Captions of similar lengths share batches, so padding them to the longest one adds few tokens
+        bucket_ids = [
+            (bucket, prompt_embedding_cache.sequence_length(prompt) // args.prompt_length_bucket_size)
+            for bucket, prompt in zip(bucket_ids, train_dataset.with_format(None)["prompts"])
+        ]
+    # A seeded sampler instead of `shuffle=True` so the position inside an epoch can be checkpointed
+    batch_sampler = BucketBatchSampler(
+        bucket_ids,
+        args.train_batch_size,
+        seed=args.seed if sampler_seed is None else sampler_seed,
+        num_processes=num_processes,
+    )
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        **dataloader_kwargs(args),
+    )
+    return train_dataloader, batch_sampler
+
+
+def streaming_scan_marker(args, prompt_embedding_cache):
+    """
+    Marker file of a finished caption scan of the `--train_data_dir` shards, keyed by their names, sizes and
+    modification times, so a relaunch on unchanged shards starts without reading them. None for hub datasets.
+    """
+    if args.dataset_name is not None:
+        return None
+    files = []
+    for root, _, names in os.walk(args.train_data_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files.append([os.path.relpath(path, args.train_data_dir), stat.st_size, stat.st_mtime_ns])
+    digest = Hasher.hash(
+        [sorted(files), args.caption_column, args.proportion_empty_prompts, prompt_embedding_cache.fingerprint]
+    )
+    return os.path.join(prompt_embedding_cache.cache_dir, f"scanned-{digest}")
+
+
+def fill_streaming_prompt_cache(args, dataset, caption_column, prompt_embedding_cache, prompt_encoder):
+    """
+    Encodes every caption of a streaming dataset that is missing from the cache. Rows draw their caption when they are
+    read, so all the captions of a row are encoded, and the empty prompt with `--proportion_empty_prompts`.
+    """
+    marker = streaming_scan_marker(args, prompt_embedding_cache)
+    if marker is not None and os.path.exists(marker):
+        logger.info("Captions of the streaming shards already scanned, skipping the scan")
+        return
+    # Only the caption column is decoded
+    captions = dict.fromkeys([""] if args.proportion_empty_prompts > 0 else [])
+    for batch in tqdm(
+        dataset.select_columns([caption_column]).iter(batch_size=args.dataset_preprocess_batch_size),
+        desc="Scanning captions",
+    ):
+        for caption in batch[caption_column]:
+            captions.update(dict.fromkeys([caption] if isinstance(caption, str) else list(caption)))
+    num_encoded = prompt_embedding_cache.fill(list(captions), prompt_encoder, args.dataset_preprocess_batch_size)
+    logger.info(f"Encoded {num_encoded} new prompts, {len(prompt_embedding_cache)} cached")
+    if marker is not None:
+        open(marker, "w").close()
+
+
+def conditioning_image_mode(args):
+    return "L" if args.single_channel_conditioning else "RGB"
+
+
+def expand_conditioning_channels(pixel_values):
+    # Single-channel conditioning images become the three VAE channels as a view, without a copy
+    return pixel_values.expand(-1, 3, -1, -1) if pixel_values.shape[1] == 1 else pixel_values
+
+
+def image_cache_meta(args, dataset, image_column, conditioning_image_column):
+    meta = {
+        "dataset_fingerprint": dataset._fingerprint,
+        "image_column": image_column,
+        "conditioning_image_column": conditioning_image_column,
+        "resolution": args.resolution,
+        "aspect_ratio_buckets": [list(bucket) for bucket in get_buckets(args) or []],
+        "num_rows": len(dataset),
+    }
+    if args.single_channel_conditioning:
+        # Only added when set, existing 3-channel caches stay valid
+        meta["conditioning_mode"] = conditioning_image_mode(args)
+    return meta
+
+
+def build_image_cache(args, dataset, image_column, conditioning_image_column, accelerator):
+    """
+    Decodes and resizes every target/conditioning image pair once and stores them as uint8 HWC arrays (a single
+    channel for `--single_channel_conditioning` sketches), one row per dataset row. Decoding runs in `--dataloader_num_workers` worker processes.
+    """
+    meta = image_cache_meta(args, dataset, image_column, conditioning_image_column)
+    paths = {
+        "pixel_values": os.path.join(args.image_cache_dir, "target"),
+        "conditioning_pixel_values": os.path.join(args.image_cache_dir, "conditioning"),
+    }
+    if all(open_store(path, meta) is not None for path in paths.values()):
+        logger.info(f"Using cached images from {args.image_cache_dir}")
+        return paths
+
+    logger.info(f"Resizing {len(dataset)} image pairs into {args.image_cache_dir}")
+    buckets = get_buckets(args)
+    conditioning_mode = conditioning_image_mode(args)
+
+    def resize_pairs(examples):
+        # Same resizing as `preprocess_train`, NEAREST keeps the wireframe lines sharp
+        row_buckets = examples["bucket"] if buckets else [None] * len(examples[image_column])
+        return {
+            "pixel_values": [
+                np.asarray(
+                    resize_to_target(
+                        image.convert("RGB"), args, buckets, bucket, transforms.InterpolationMode.BILINEAR
+                    )
+                )
+                for image, bucket in zip(examples[image_column], row_buckets)
+            ],
+            "conditioning_pixel_values": [
+                np.atleast_3d(
+                    resize_to_target(
+                        image.convert(conditioning_mode), args, buckets, bucket, transforms.InterpolationMode.NEAREST
+                    )
+                )
+                for image, bucket in zip(examples[conditioning_image_column], row_buckets)
+            ],
+        }
+
+    columns = [image_column, conditioning_image_column] + (["bucket"] if buckets else [])
+    loader = torch.utils.data.DataLoader(
+        dataset.with_transform(resize_pairs, columns=columns),
+        batch_size=None,
+        num_workers=args.dataloader_num_workers,
+    )
+    writers = {key: ShardedArrayWriter(path, np.uint8, ndim=3) for key, path in paths.items()}
+    for pair in tqdm(loader, desc="Caching images", disable=not accelerator.is_local_main_process):
+        for key, writer in writers.items():
+            writer.append(pair[key].numpy())
+
+    for writer in writers.values():
+        writer.close(meta)
+    return paths
+
+
+def resize_for_latents(image, args, buckets, bucket, interpolation, multiple):
+    # Resize as for training, then trim the far edges so both sides are multiples of the VAE downsampling
+    image = resize_to_target(image, args, buckets, bucket, interpolation)
+    width, height = image.size
+    return TF.crop(image, 0, 0, height - height % multiple, width - width % multiple)
+
+
+def latent_cache_meta(args, vae, dataset, image_column, conditioning_image_column):
+    return {
+        "dataset_fingerprint": dataset._fingerprint,
+        "image_column": image_column,
+        "conditioning_image_column": conditioning_image_column,
+        "pretrained_model_name_or_path": args.pretrained_model_name_or_path,
+        "revision": args.revision,
+        "variant": args.variant,
+        "resolution": args.resolution,
+        "aspect_ratio_buckets": [list(bucket) for bucket in get_buckets(args) or []],
+        "num_rows": len(dataset),
+        "vae_dtype": str(vae.dtype),
+        "vae_scale_factor": 2 ** (len(vae.config.block_out_channels) - 1),
+    }
+
+
+def build_latent_cache(args, dataset, image_column, conditioning_image_column, vae, accelerator):
+    """
+    Encodes every target/conditioning image pair once and stores the latent distribution parameters
+    (mean and logvar stacked on the channel axis) as fp16 shards, one row per dataset row.
+    """
+    meta = latent_cache_meta(args, vae, dataset, image_column, conditioning_image_column)
+    paths = {
+        "latent_params": os.path.join(args.latent_cache_dir, "target"),
+        "conditioning_latent_params": os.path.join(args.latent_cache_dir, "conditioning"),
+    }
+    if all(open_store(path, meta) is not None for path in paths.values()):
+        logger.info(f"Using cached latents from {args.latent_cache_dir}")
+        return paths
+
+    logger.info(f"Encoding {len(dataset)} image pairs into {args.latent_cache_dir}")
+    multiple = meta["vae_scale_factor"]
+    buckets = get_buckets(args)
+    writers = {key: ShardedArrayWriter(path, np.float16, ndim=3) for key, path in paths.items()}
+
+    def encode_and_write(pending):
+        for key, normalize in (("latent_params", True), ("conditioning_latent_params", False)):
+            pixel_values = torch.stack([pair[key] for pair in pending])
+            if normalize:
+                pixel_values = TF.normalize(pixel_values, [0.5], [0.5])
+            pixel_values = expand_conditioning_channels(pixel_values)
+            with torch.no_grad():
+                params = vae.encode(pixel_values.to(vae.device, dtype=vae.dtype)).latent_dist.parameters
+            for row in params.to(torch.float16).cpu().numpy():
+                writers[key].append(row)
+
+    # Consecutive rows with the same size are encoded together
+    pending = []
+    for example in tqdm(dataset, desc="Caching latents", disable=not accelerator.is_local_main_process):
+        bucket = example["bucket"] if buckets else None
+        image = resize_for_latents(
+            example[image_column].convert("RGB"),
+            args,
+            buckets,
+            bucket,
+            transforms.InterpolationMode.BILINEAR,
+            multiple,
+        )
+        conditioning_image = resize_for_latents(
+            example[conditioning_image_column].convert(conditioning_image_mode(args)),
+            args,
+            buckets,
+            bucket,
+            transforms.InterpolationMode.NEAREST,
+            multiple,
+        )
+        pair = {"latent_params": TF.to_tensor(image), "conditioning_latent_params": TF.to_tensor(conditioning_image)}
+        if pending and (
+            len(pending) == args.vae_encode_batch_size
+            or pending[0]["latent_params"].shape != pair["latent_params"].shape
+        ):
+            encode_and_write(pending)
+            pending = []
+        pending.append(pair)
+    if pending:
+        encode_and_write(pending)
+
+    for writer in writers.values():
+        writer.close(meta)
+    return paths
+
+
+def sample_latent_dist(params):
+    # Same sampling as `DiagonalGaussianDistribution.sample` on the cached parameters
+    mean, logvar = torch.chunk(params, 2, dim=1)
+    std = torch.exp(0.5 * torch.clamp(logvar, -30.0, 20.0))
+    return mean + std * torch.randn_like(mean)
+
+
+def prompt_embedding_fingerprint(args, dtype):
+    # Everything that changes the output of `encode_prompt` for a given caption, and nothing else
+    fingerprint = {
+        "pretrained_model_name_or_path": args.pretrained_model_name_or_path,
+        "revision": args.revision,
+        "variant": args.variant,
+        "max_sequence_length": args.max_sequence_length,
+        "dtype": str(dtype),
+    }
+    if args.trim_prompt_embeds:
+        # Only added when set, untrimmed entries keep their keys
+        fingerprint["trim_prompt_embeds"] = True
+    return fingerprint
+
+
+def pad_prompt_embeds(prompt_embeds):
+    """
+    Zero-pads trimmed prompt embeddings to the longest of them. Returns the stacked embeddings and the mask of their
+    real tokens, or None when no row needed padding.
+    """
+    lengths = [embeds.shape[0] for embeds in prompt_embeds]
+    if min(lengths) == max(lengths):
+        return torch.stack(prompt_embeds), None
+    padded = prompt_embeds[0].new_zeros(len(prompt_embeds), max(lengths), prompt_embeds[0].shape[-1])
+    mask = torch.zeros(len(prompt_embeds), max(lengths), dtype=torch.bool)
+    for i, (embeds, length) in enumerate(zip(prompt_embeds, lengths)):
+        padded[i, :length] = embeds
+        mask[i, :length] = True
+    return padded, mask
+
+
+def make_train_dataset(
+    args,
+    tokenizer_one,
+    tokenizer_two,
+    tokenizer_three,
+    accelerator,
+    vae=None,
+    prompt_embedding_cache=None,
+    prompt_encoder=None,
+):
     # Get the datasets: you can either provide your own training and evaluation files (see below)
     # or specify a Dataset from the hub (the dataset will be downloaded automatically from the datasets Hub).
 
@@ -692,12 +1592,14 @@ def make_train_dataset(args, tokenizer_one, tokenizer_two, tokenizer_three, acce
             args.dataset_name,
             args.dataset_config_name,
             cache_dir=args.cache_dir,
+            streaming=args.streaming,
         )
     else:
         if args.train_data_dir is not None:
             dataset = load_dataset(
                 args.train_data_dir,
                 cache_dir=args.cache_dir,
+                streaming=args.streaming,
             )
         # See more about loading custom images at
         # https://huggingface.co/docs/datasets/v2.0.0/en/dataset_script
@@ -783,24 +1685,37 @@ def make_train_dataset(args, tokenizer_one, tokenizer_two, tokenizer_three, acce
 
     #     return examples
 
+    def add_prompt_embeddings(examples):
+        # Zero-copy views into the memory-mapped embedding cache, in the dtype they were encoded with
+        embeddings = [prompt_embedding_cache[prompt] for prompt in examples["prompts"]]
+        examples["prompt_embeds"] = [prompt_embeds for prompt_embeds, _ in embeddings]
+        examples["pooled_prompt_embeds"] = [pooled_prompt_embeds for _, pooled_prompt_embeds in embeddings]
+
+    def row_buckets(examples):
+        return examples["bucket"] if buckets else [None] * len(examples["prompts"])
+
     def preprocess_train(examples):
         # 1. Convert paths/images to RGB PIL Images
         images = [image.convert("RGB") for image in examples[image_column]]
-        conditioning_images = [image.convert("RGB") for image in examples[conditioning_image_column]]
-        
+        # Sketches are decoded as one channel with `--single_channel_conditioning`
+        conditioning_images = [
+            image.convert(conditioning_image_mode(args)) for image in examples[conditioning_image_column]
+        ]
+
         processed_images = []
         processed_conds = []
 
-        for img, cond in zip(images, conditioning_images):
+        for img, cond, bucket in zip(images, conditioning_images, row_buckets(examples)):
             # A. Resize the Shortest Edge to args.resolution (e.g., 720 -> 1024)
             # This maintains aspect ratio but ensures the image is big enough to crop.
-            img = TF.resize(img, args.resolution, interpolation=transforms.InterpolationMode.BILINEAR)
-            cond = TF.resize(cond, args.resolution, interpolation=transforms.InterpolationMode.NEAREST) 
+            # With aspect ratio buckets the whole image is resized to its bucket instead.
+            img = resize_to_target(img, args, buckets, bucket, transforms.InterpolationMode.BILINEAR)
+            cond = resize_to_target(cond, args, buckets, bucket, transforms.InterpolationMode.NEAREST)
             # Note: We use NEAREST for cond to keep wireframe lines sharp!
 
             # B. Generate Random Crop Parameters
-            # This gives us a random (top, left, height, width) box
-            y, x, h, w = transforms.RandomCrop.get_params(img, output_size=(args.resolution, args.resolution))
+            # This gives us a random (top, left, height, width) box, the full image for buckets
+            y, x, h, w = transforms.RandomCrop.get_params(img, output_size=target_size(args, buckets, bucket))
 
             # C. Apply the SAME crop to both
             img_crop = TF.crop(img, y, x, h, w)
@@ -819,35 +1734,203 @@ def make_train_dataset(args, tokenizer_one, tokenizer_two, tokenizer_three, acce
 
         examples["pixel_values"] = processed_images
         examples["conditioning_pixel_values"] = processed_conds
-        examples["prompts"] = process_captions(examples)
+        add_prompt_embeddings(examples)
+
+        return examples
+
+    def preprocess_train_cached_images(examples):
+        # The images are already resized, only the shared random crop and the float conversion are left
+        images = []
+        conditioning_images = []
+        for row_index, bucket in zip(examples["row_index"], row_buckets(examples)):
+            image = image_stores["pixel_values"][row_index]
+            conditioning_image = image_stores["conditioning_pixel_values"][row_index]
+            crop_height, crop_width = target_size(args, buckets, bucket)
+            height, width, _ = image.shape
+            top = random.randint(0, height - crop_height)
+            left = random.randint(0, width - crop_width)
+            image = torch.from_numpy(image[top : top + crop_height, left : left + crop_width]).permute(2, 0, 1)
+            conditioning_image = torch.from_numpy(
+                conditioning_image[top : top + crop_height, left : left + crop_width]
+            )
+            images.append(TF.normalize(image.float() / 255.0, [0.5], [0.5]))
+            conditioning_images.append(conditioning_image.permute(2, 0, 1).float() / 255.0)
+
+        examples["pixel_values"] = images
+        examples["conditioning_pixel_values"] = conditioning_images
+        add_prompt_embeddings(examples)
+
+        return examples
+
+    def preprocess_train_latents(examples):
+        # Random crop in latent space (square, or the whole bucket), shared by the target and the conditioning latents
+        scale_factor = latent_stores["latent_params"].meta["vae_scale_factor"]
+        latents = []
+        conditioning_latents = []
+        for row_index, bucket in zip(examples["row_index"], row_buckets(examples)):
+            params = latent_stores["latent_params"][row_index]
+            conditioning_params = latent_stores["conditioning_latent_params"][row_index]
+            crop_height, crop_width = (size // scale_factor for size in target_size(args, buckets, bucket))
+            _, height, width = params.shape
+            top = random.randint(0, height - crop_height)
+            left = random.randint(0, width - crop_width)
+            latents.append(torch.from_numpy(params[:, top : top + crop_height, left : left + crop_width]))
+            conditioning_latents.append(
+                torch.from_numpy(conditioning_params[:, top : top + crop_height, left : left + crop_width])
+            )
+
+        examples["latent_params"] = latents
+        examples["conditioning_latent_params"] = conditioning_latents
+        add_prompt_embeddings(examples)
 
         return examples
 
+    buckets = get_buckets(args)
+
+    def assign_buckets(images):
+        # Only the image headers are read to get the sizes
+        bucket_ids = []
+        for image in images:
+            with Image.open(image["path"] if image["bytes"] is None else io.BytesIO(image["bytes"])) as img:
+                width, height = img.size
+            bucket_ids.append(find_nearest_bucket(height, width, buckets))
+        return {"bucket": bucket_ids}
+
+    if args.streaming:
+        with accelerator.main_process_first():
+            prompt_embedding_cache.reload()
+            fill_streaming_prompt_cache(args, dataset["train"], caption_column, prompt_embedding_cache, prompt_encoder)
+            prompt_embedding_cache.reload()
+        prompt_encoder.unload()
+
+        def preprocess_train_streaming(examples):
+            # The caption is drawn every time a row is read, among the ones encoded by the scan
+            examples["prompts"] = process_captions(examples)
+            return preprocess_train(examples)
+
+        if dataset["train"].n_shards % accelerator.num_processes != 0:
+            logger.warning(
+                f"{dataset['train'].n_shards} shards cannot be split evenly across {accelerator.num_processes}"
+                " processes, every process reads all of them and keeps one row in "
+                f"{accelerator.num_processes}. Use a multiple of the number of processes."
+            )
+        # The same seed on every process, the shard order of an epoch is split between them
+        train_dataset = dataset["train"].shuffle(
+            seed=args.seed if args.seed is not None else 0, buffer_size=args.streaming_shuffle_buffer
+        )
+        train_dataset = split_dataset_by_node(
+            train_dataset, rank=accelerator.process_index, world_size=accelerator.num_processes
+        )
+        return train_dataset.map(
+            preprocess_train_streaming,
+            batched=True,
+            batch_size=args.train_batch_size,
+            remove_columns=column_names,
+        )
+
     with accelerator.main_process_first():
         if args.max_train_samples is not None:
             dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset["train"].with_transform(preprocess_train)
+
+        if buckets:
+            logger.info(f"Aspect ratio buckets (height, width): {buckets}")
+            dataset["train"] = (
+                dataset["train"]
+                .cast_column(image_column, ImageFeature(decode=False))
+                .map(
+                    assign_buckets,
+                    input_columns=image_column,
+                    batched=True,
+                    new_fingerprint=Hasher.hash([dataset["train"]._fingerprint, image_column, buckets]),
+                )
+                .cast_column(image_column, ImageFeature())
+            )
+
+        if args.cache_images:
+            if accelerator.is_main_process:
+                build_image_cache(args, dataset["train"], image_column, conditioning_image_column, accelerator)
+            meta = image_cache_meta(args, dataset["train"], image_column, conditioning_image_column)
+            image_stores = {
+                "pixel_values": open_store(os.path.join(args.image_cache_dir, "target"), meta),
+                "conditioning_pixel_values": open_store(os.path.join(args.image_cache_dir, "conditioning"), meta),
+            }
+
+        # The latents do not depend on the prompts picked below, so their cache is keyed on the rows before
+        image_dataset = dataset["train"]
+
+        # Pick the prompt of every row once (empty prompts, one of several captions), reading only the captions
+        dataset["train"] = dataset["train"].map(
+            lambda captions: {"prompts": process_captions({caption_column: captions})},
+            input_columns=caption_column,
+            batched=True,
+            new_fingerprint=Hasher.hash(
+                [dataset["train"]._fingerprint, caption_column, args.proportion_empty_prompts, args.seed]
+            ),
+        )
+
+        # Only captions that were never encoded with these text encoder settings go through the text encoders
+        prompt_embedding_cache.reload()
+        num_encoded = prompt_embedding_cache.fill(
+            dataset["train"].unique("prompts"), prompt_encoder, args.dataset_preprocess_batch_size
+        )
+        prompt_encoder.unload()
+        logger.info(f"Encoded {num_encoded} new prompts, {len(prompt_embedding_cache)} cached")
+
+        if args.cache_latents:
+            latent_stores = {}
+            if accelerator.is_main_process:
+                vae.to(accelerator.device)
+                build_latent_cache(args, image_dataset, image_column, conditioning_image_column, vae, accelerator)
+            meta = latent_cache_meta(args, vae, image_dataset, image_column, conditioning_image_column)
+            for key, name in (("latent_params", "target"), ("conditioning_latent_params", "conditioning")):
+                latent_stores[key] = open_store(os.path.join(args.latent_cache_dir, name), meta)
+            # Only the captions and the row index are read from the dataset, images are never decoded
+            dataset["train"] = dataset["train"].add_column("row_index", list(range(len(dataset["train"]))))
+            train_dataset = dataset["train"].with_transform(
+                preprocess_train_latents, columns=["row_index", "prompts"] + (["bucket"] if buckets else [])
+            )
+        elif args.cache_images:
+            # Only the prompts and the row index are read from the dataset, images are never decoded
+            dataset["train"] = dataset["train"].add_column("row_index", list(range(len(dataset["train"]))))
+            train_dataset = dataset["train"].with_transform(
+                preprocess_train_cached_images, columns=["row_index", "prompts"] + (["bucket"] if buckets else [])
+            )
+        else:
+            # Set the training transforms
+            train_dataset = dataset["train"].with_transform(preprocess_train)
 
     return train_dataset
 
 
 def collate_fn(examples):
+    prompt_embeds, prompt_attention_mask = pad_prompt_embeds([example["prompt_embeds"] for example in examples])
+    pooled_prompt_embeds = torch.stack([example["pooled_prompt_embeds"] for example in examples])
+
+    batch = {
+        "prompt_embeds": prompt_embeds,
+        "pooled_prompt_embeds": pooled_prompt_embeds,
+    }
+    if prompt_attention_mask is not None:
+        # `--trim_prompt_embeds` batches with captions of different lengths
+        batch["prompt_attention_mask"] = prompt_attention_mask
+
+    if "latent_params" in examples[0]:
+        # `--cache_latents`: fp16 latent distribution parameters instead of pixels
+        batch["latent_params"] = torch.stack([example["latent_params"] for example in examples])
+        batch["conditioning_latent_params"] = torch.stack(
+            [example["conditioning_latent_params"] for example in examples]
+        )
+        return batch
+
     pixel_values = torch.stack([example["pixel_values"] for example in examples])
     pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
 
     conditioning_pixel_values = torch.stack([example["conditioning_pixel_values"] for example in examples])
     conditioning_pixel_values = conditioning_pixel_values.to(memory_format=torch.contiguous_format).float()
 
-    prompt_embeds = torch.stack([torch.tensor(example["prompt_embeds"]) for example in examples])
-    pooled_prompt_embeds = torch.stack([torch.tensor(example["pooled_prompt_embeds"]) for example in examples])
-
-    return {
-        "pixel_values": pixel_values,
-        "conditioning_pixel_values": conditioning_pixel_values,
-        "prompt_embeds": prompt_embeds,
-        "pooled_prompt_embeds": pooled_prompt_embeds,
-    }
+    batch["pixel_values"] = pixel_values
+    batch["conditioning_pixel_values"] = conditioning_pixel_values
+    return batch
 
 
 # Copied from dreambooth sd3 example
@@ -966,6 +2049,54 @@ def encode_prompt(
     return prompt_embeds, pooled_prompt_embeds
 
 
+def t5_sequence_lengths(tokenizer, prompts, max_sequence_length):
+    """Number of real T5 tokens of every prompt, end of sequence token included."""
+    attention_mask = tokenizer(
+        prompts, max_length=max_sequence_length, truncation=True, add_special_tokens=True
+    ).attention_mask
+    return [sum(mask) for mask in attention_mask]
+
+
+class PromptEncoder:
+    """
+    Encodes prompts with the three text encoders, which are loaded to the device on the first call only: with a
+    complete prompt embedding cache they are never loaded. `unload` frees them before the other models are loaded.
+    """
+
+    def __init__(self, text_encoder_classes, tokenizers, max_sequence_length, device, dtype, trim=False):
+        self.text_encoder_classes = text_encoder_classes
+        self.tokenizers = tokenizers
+        self.max_sequence_length = max_sequence_length
+        self.device = device
+        self.dtype = dtype
+        self.trim = trim
+        self.text_encoders = None
+
+    def __call__(self, prompts):
+        if self.text_encoders is None:
+            logger.info("Loading the text encoders to encode the missing prompts")
+            self.text_encoders = [
+                text_encoder.requires_grad_(False).to(self.device, dtype=self.dtype)
+                for text_encoder in load_text_encoders(*self.text_encoder_classes)
+            ]
+        with torch.no_grad():
+            prompt_embeds, pooled_prompt_embeds = encode_prompt(
+                self.text_encoders, self.tokenizers, prompts, self.max_sequence_length
+            )
+        if not self.trim:
+            return prompt_embeds, pooled_prompt_embeds
+        # T5 still runs on the padded sequence, as at inference, only the outputs past the last real token are
+        # dropped. The CLIP tokens come first and are kept whole.
+        num_clip_tokens = prompt_embeds.shape[1] - self.max_sequence_length
+        t5_lengths = t5_sequence_lengths(self.tokenizers[2], prompts, self.max_sequence_length)
+        return prompt_embeds, pooled_prompt_embeds, [num_clip_tokens + length for length in t5_lengths]
+
+    def unload(self):
+        if self.text_encoders is not None:
+            self.text_encoders = None
+            free_memory()
+
+
 def main(args):
     if args.report_to == "wandb" and args.hub_token is not None:
         raise ValueError(
@@ -1060,15 +2191,79 @@ def main(args):
         args.pretrained_model_name_or_path, subfolder="scheduler"
     )
     noise_scheduler_copy = copy.deepcopy(noise_scheduler)
-    text_encoder_one, text_encoder_two, text_encoder_three = load_text_encoders(
-        text_encoder_cls_one, text_encoder_cls_two, text_encoder_cls_three
-    )
+
+    # For mixed precision training we cast the text_encoder and vae weights to half-precision
+    # as these models are only used for inference, keeping weights in full precision is not required.
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    # The models are loaded in stages so the text encoders never share the device with the VAE or the transformer.
+    # Stage 1: prompt embeddings. Embeddings are cached per caption and text encoder settings, so relaunching with
+    # different training hyperparameters reuses them, and the text encoders are only loaded for missing prompts.
+    prompt_embedding_cache = PromptEmbeddingCache(
+        args.prompt_embedding_cache_dir, prompt_embedding_fingerprint(args, weight_dtype)
+    )
+    prompt_encoder = PromptEncoder(
+        (text_encoder_cls_one, text_encoder_cls_two, text_encoder_cls_three),
+        (tokenizer_one, tokenizer_two, tokenizer_three),
+        args.max_sequence_length,
+        accelerator.device,
+        weight_dtype,
+        trim=args.trim_prompt_embeds,
+    )
+    if args.validation_prompt is not None:
+        with accelerator.main_process_first():
+            prompt_embedding_cache.reload()
+            prompt_embedding_cache.fill(
+                get_validation_pairs(args)[1] + [""], prompt_encoder, args.dataset_preprocess_batch_size
+            )
+
+    # Stage 2: the VAE, which only moves to the device once the text encoders are unloaded
     vae = AutoencoderKL.from_pretrained(
         args.pretrained_model_name_or_path,
         subfolder="vae",
         revision=args.revision,
         variant=args.variant,
     )
+    vae.requires_grad_(False)
+    if args.quantize_vae is not None:
+        num_layers = quantize_weights(vae, args.quantize_vae)
+        logger.info(f"Quantized {num_layers} VAE layers to {args.quantize_vae}")
+    vae.to(dtype=torch.float32 if args.upcast_vae else weight_dtype)
+
+    train_dataset = make_train_dataset(
+        args,
+        tokenizer_one,
+        tokenizer_two,
+        tokenizer_three,
+        accelerator,
+        vae=vae,
+        prompt_embedding_cache=prompt_embedding_cache,
+        prompt_encoder=prompt_encoder,
+    )
+    # Also covers the processes that found every prompt cached after the main process filled it
+    prompt_encoder.unload()
+
+    validation_embeddings = None
+    if args.validation_prompt is not None and accelerator.is_main_process:
+        validation_embeddings = get_validation_embeddings(args, prompt_embedding_cache)
+
+    del prompt_encoder
+    del tokenizer_one, tokenizer_two, tokenizer_three
+
+    vae_shift_factor = vae.config.shift_factor
+    vae_scaling_factor = vae.config.scaling_factor
+    if args.cache_latents and args.validation_prompt is None:
+        # Training reads the cached latent distributions, the VAE is only needed to decode validation images
+        del vae
+    else:
+        vae.to(accelerator.device)
+    free_memory()
+
+    # Stage 3: the transformer and the controlnet
     transformer = SD3Transformer2DModel.from_pretrained(
         args.pretrained_model_name_or_path, subfolder="transformer", revision=args.revision, variant=args.variant
     )
@@ -1083,12 +2278,12 @@ def main(args):
         )
 
     transformer.requires_grad_(False)
-    vae.requires_grad_(False)
-    text_encoder_one.requires_grad_(False)
-    text_encoder_two.requires_grad_(False)
-    text_encoder_three.requires_grad_(False)
     controlnet.train()
 
+    if args.trim_prompt_embeds:
+        num_processors = enable_masked_joint_attention(transformer)
+        logger.info(f"Masking the text padding in {num_processors} transformer attention layers")
+
     # Taken from [Sayak Paul's Diffusers PR #6511](https://github.com/huggingface/diffusers/pull/6511/files)
     def unwrap_model(model):
         model = accelerator.unwrap_model(model)
@@ -1127,7 +2322,22 @@ def main(args):
         accelerator.register_load_state_pre_hook(load_model_hook)
 
     if args.gradient_checkpointing:
-        controlnet.enable_gradient_checkpointing()
+        policy, value = parse_checkpointing_policy(args.gradient_checkpointing_policy)
+        if policy == "all":
+            controlnet.enable_gradient_checkpointing()
+        else:
+            num_blocks = len(controlnet.transformer_blocks)
+            if policy == "every":
+                block_ids = every_nth_block(num_blocks, value)
+            else:
+                block_ids = select_blocks_for_budget(controlnet, transformer, args, accelerator, value)
+            apply_activation_checkpointing(controlnet, block_ids)
+            logger.info(f"Gradient checkpointing {len(block_ids)} of {num_blocks} controlnet blocks: {block_ids}")
+
+    if args.compile:
+        enable_compile_cache(args.compile_cache_dir)
+        num_blocks = compile_repeated_blocks(controlnet) + compile_repeated_blocks(transformer)
+        logger.info(f"Compiling {num_blocks} transformer blocks, cached in {args.compile_cache_dir}")
 
     # Check that all trainable models are in full precision
     low_precision_error_string = (
@@ -1173,75 +2383,33 @@ def main(args):
         eps=args.adam_epsilon,
     )
 
-    # For mixed precision training we cast the text_encoder and vae weights to half-precision
-    # as these models are only used for inference, keeping weights in full precision is not required.
-    weight_dtype = torch.float32
-    if accelerator.mixed_precision == "fp16":
-        weight_dtype = torch.float16
-    elif accelerator.mixed_precision == "bf16":
-        weight_dtype = torch.bfloat16
+    # Quantized on CPU, so the unquantized weights never reach the device
+    if args.quantize_transformer is not None:
+        num_layers = quantize_weights(transformer, args.quantize_transformer, exclude=TRANSFORMER_QUANTIZATION_EXCLUDE)
+        logger.info(f"Quantized {num_layers} transformer layers to {args.quantize_transformer}")
 
-    # Move vae, transformer and text_encoder to device and cast to weight_dtype
-    if args.upcast_vae:
-        vae.to(accelerator.device, dtype=torch.float32)
-    else:
-        vae.to(accelerator.device, dtype=weight_dtype)
     transformer.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_one.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_two.to(accelerator.device, dtype=weight_dtype)
-    text_encoder_three.to(accelerator.device, dtype=weight_dtype)
-
-    train_dataset = make_train_dataset(args, tokenizer_one, tokenizer_two, tokenizer_three, accelerator)
-
-    tokenizers = [tokenizer_one, tokenizer_two, tokenizer_three]
-    text_encoders = [text_encoder_one, text_encoder_two, text_encoder_three]
-
-    def compute_text_embeddings(batch, text_encoders, tokenizers):
-        with torch.no_grad():
-            prompt = batch["prompts"]
-            prompt_embeds, pooled_prompt_embeds = encode_prompt(
-                text_encoders, tokenizers, prompt, args.max_sequence_length
-            )
-            prompt_embeds = prompt_embeds.to(accelerator.device)
-            pooled_prompt_embeds = pooled_prompt_embeds.to(accelerator.device)
-        return {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
-
-    compute_embeddings_fn = functools.partial(
-        compute_text_embeddings,
-        text_encoders=text_encoders,
-        tokenizers=tokenizers,
-    )
-    with accelerator.main_process_first():
-        from datasets.fingerprint import Hasher
-
-        # fingerprint used by the cache for the other processes to load the result
-        # details: https://github.com/huggingface/diffusers/pull/4038#discussion_r1266078401
-        new_fingerprint = Hasher.hash(args)
-        train_dataset = train_dataset.map(
-            compute_embeddings_fn,
-            batched=True,
-            batch_size=args.dataset_preprocess_batch_size,
-            new_fingerprint=new_fingerprint,
-        )
-
-    del text_encoder_one, text_encoder_two, text_encoder_three
-    del tokenizer_one, tokenizer_two, tokenizer_three
-    free_memory()
-
-    train_dataloader = torch.utils.data.DataLoader(
+    logger.info(f"Transformer weights: {weight_memory(transformer) / 2**30:.2f} GiB")
+
+    # Every process must shuffle the same way, `BatchSamplerShard` slices one shared order
+    sampler_seed = [args.seed if args.seed is not None else random.randrange(2**31)]
+    if args.seed is None and accelerator.num_processes > 1:
+        broadcast_object_list(sampler_seed)
+    train_dataloader, batch_sampler = make_train_dataloader(
+        args,
         train_dataset,
-        shuffle=True,
-        collate_fn=collate_fn,
-        batch_size=args.train_batch_size,
-        num_workers=args.dataloader_num_workers,
+        prompt_embedding_cache,
+        num_processes=accelerator.num_processes,
+        sampler_seed=sampler_seed[0],
     )
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-    if args.max_train_steps is None:
-        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
-        overrode_max_train_steps = True
+    if not args.streaming:
+        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+        if args.max_train_steps is None:
+            args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+            overrode_max_train_steps = True
 
     lr_scheduler = get_scheduler(
         args.lr_scheduler,
@@ -1253,16 +2421,26 @@ def main(args):
     )
 
     # Prepare everything with our `accelerator`.
-    controlnet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        controlnet, optimizer, train_dataloader, lr_scheduler
-    )
+    if args.streaming:
+        # The stream is already split between processes, a prepared dataloader would read all of it on every
+        # process (or on the main one only, dispatching the batches) and keep one batch in N
+        controlnet, optimizer, lr_scheduler = accelerator.prepare(controlnet, optimizer, lr_scheduler)
+    else:
+        # With `--prefetch_to_device` the batches stay on the CPU until `BatchPrefetcher` moves them
+        controlnet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            controlnet,
+            optimizer,
+            train_dataloader,
+            lr_scheduler,
+            device_placement=[True, True, not args.prefetch_to_device, True],
+        )
 
-    # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
-    if overrode_max_train_steps:
-        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
-    # Afterwards we recalculate our number of training epochs
-    args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+        # We need to recalculate our total training steps as the size of the training dataloader may have changed.
+        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+        if overrode_max_train_steps:
+            args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+        # Afterwards we recalculate our number of training epochs
+        args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
 
     # We need to initialize the trackers we use, and also store our configuration.
     # The trackers initializes automatically on the main process.
@@ -1279,9 +2457,12 @@ def main(args):
     total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
     logger.info("***** Running training *****")
-    logger.info(f"  Num examples = {len(train_dataset)}")
-    logger.info(f"  Num batches each epoch = {len(train_dataloader)}")
-    logger.info(f"  Num Epochs = {args.num_train_epochs}")
+    if args.streaming:
+        logger.info(f"  Streaming {train_dataset.n_shards} shards in this process")
+    else:
+        logger.info(f"  Num examples = {len(train_dataset)}")
+        logger.info(f"  Num batches each epoch = {len(train_dataloader)}")
+        logger.info(f"  Num Epochs = {args.num_train_epochs}")
     logger.info(f"  Instantaneous batch size per device = {args.train_batch_size}")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
@@ -1312,7 +2493,17 @@ def main(args):
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
-            first_epoch = global_step // num_update_steps_per_epoch
+            position_file = os.path.join(args.output_dir, path, TRAINING_POSITION_FILE)
+            if os.path.exists(position_file):
+                # Continue with the same shuffle order, right after the last batch before the checkpoint
+                with open(position_file) as f:
+                    batch_sampler.load_state_dict(json.load(f))
+                first_epoch = batch_sampler.epoch
+                accelerator.print(
+                    f"Resuming at epoch {first_epoch}, skipping {batch_sampler.start_batch} already seen batches"
+                )
+            elif not args.streaming:
+                first_epoch = global_step // num_update_steps_per_epoch
     else:
         initial_global_step = 0
 
@@ -1324,26 +2515,147 @@ def main(args):
         disable=not accelerator.is_local_main_process,
     )
 
-    def get_sigmas(timesteps, n_dim=4, dtype=torch.float32):
-        sigmas = noise_scheduler_copy.sigmas.to(device=accelerator.device, dtype=dtype)
-        schedule_timesteps = noise_scheduler_copy.timesteps.to(accelerator.device)
-        timesteps = timesteps.to(accelerator.device)
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+    # Kept on the device so that sampling timesteps and looking up their sigmas never waits for the host
+    schedule_timesteps = noise_scheduler_copy.timesteps.to(accelerator.device)
+    schedule_sigmas = noise_scheduler_copy.sigmas.to(accelerator.device)
 
-        sigma = sigmas[step_indices].flatten()
+    def get_sigmas(step_indices, n_dim=4, dtype=torch.float32):
+        sigma = schedule_sigmas[step_indices].to(dtype=dtype).flatten()
         while len(sigma.shape) < n_dim:
             sigma = sigma.unsqueeze(-1)
         return sigma
 
+    validation_worker = None
+    if args.validation_worker and args.validation_prompt is not None:
+        # The worker inherits `CUDA_VISIBLE_DEVICES`, so device names mean the same GPUs in both processes
+        validation_device = torch.device(args.validation_device)
+        if validation_device.type != "cpu" and validation_device.index is None:
+            validation_device = torch.device(validation_device.type, 0)
+        training_devices = gather_object([str(accelerator.device)])
+        if validation_device.type != "cpu" and str(validation_device) in training_devices:
+            raise ValueError(
+                f"`--validation_device` {args.validation_device} is used for training, pick a device outside"
+                f" of {sorted(set(training_devices))}."
+            )
+
+    if args.validation_worker and args.validation_prompt is not None and accelerator.is_main_process:
+        # Validation only reads the checkpoints, the training loop never waits for it
+        validation_worker = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "validation_worker.py"),
+                "--training_pid",
+                str(os.getpid()),
+                "--start_step",
+                str(initial_global_step),
+                *sys.argv[1:],
+            ],
+            env={key: value for key, value in os.environ.items() if key not in DISTRIBUTED_ENV_VARS},
+        )
+        logger.info(f"Started validation worker (pid {validation_worker.pid})")
+
+    profiler = StepProfiler(
+        accelerator.device, enabled=args.profile_training, num_processes=accelerator.num_processes
+    )
+
+    # Summed over micro-batches on the device, read back every `--logging_steps` optimizer steps
+    train_loss = torch.zeros((), device=accelerator.device)
+    train_loss_micro_steps = 0
+
+    detect_sync_points = args.detect_sync_points and accelerator.device.type == "cuda"
+    if args.detect_sync_points and not detect_sync_points:
+        logger.warning("`--detect_sync_points` only applies to CUDA devices, ignoring it.")
+
+    batches = train_dataloader
+    if args.prefetch_to_device:
+        # The dtypes the step casts every input to, so its own casts do nothing
+        prefetch_dtypes = {
+            "prompt_embeds": weight_dtype,
+            "pooled_prompt_embeds": weight_dtype,
+            "latent_params": torch.float32,
+            "conditioning_latent_params": torch.float32,
+            "conditioning_pixel_values": weight_dtype,
+        }
+        if not args.cache_latents:
+            prefetch_dtypes["pixel_values"] = vae.dtype
+        batches = BatchPrefetcher(train_dataloader, accelerator.device, prefetch_dtypes)
+
+    # Built on the first inline validation around the live models, then reused
+    validation_pipeline = None
+
+    checkpoint_writer = None
+    if args.async_checkpointing and accelerator.is_main_process:
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, args.checkpoints_total_limit)
+
+    def gather_random_states():
+        # Every process resumes from its own generators, as with `accelerator.save_state`. Called on all processes.
+        random_states = {
+            "step": accelerator.step,
+            "random_state": random.getstate(),
+            "numpy_random_seed": np.random.get_state(),
+            "torch_manual_seed": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            random_states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+        if accelerator.num_processes == 1:
+            return [random_states]
+        return gather_object([random_states])
+
+    def save_checkpoint_async(save_path, training_position, all_random_states):
+        # Only the copy to CPU blocks the step, serialization and pruning run on the writer thread
+        state = checkpoint_writer.snapshot(
+            {
+                "controlnet": unwrap_model(controlnet).state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": lr_scheduler.state_dict(),
+                "scaler": accelerator.scaler.state_dict() if accelerator.scaler is not None else None,
+            }
+        )
+
+        def write(directory):
+            # Same layout as `accelerator.save_state` with the hooks above, so `--resume_from_checkpoint` loads it
+            controlnet_dir = os.path.join(directory, "controlnet")
+            unwrap_model(controlnet).save_config(controlnet_dir)
+            safetensors.torch.save_file(
+                state["controlnet"], os.path.join(controlnet_dir, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"}
+            )
+            torch.save(state["optimizer"], os.path.join(directory, f"{OPTIMIZER_NAME}.bin"))
+            torch.save(state["scheduler"], os.path.join(directory, f"{SCHEDULER_NAME}.bin"))
+            if state["scaler"] is not None:
+                torch.save(state["scaler"], os.path.join(directory, SCALER_NAME))
+            for process_index, random_states in enumerate(all_random_states):
+                torch.save(random_states, os.path.join(directory, f"{RNG_STATE_NAME}_{process_index}.pkl"))
+            with open(os.path.join(directory, TRAINING_POSITION_FILE), "w") as f:
+                json.dump(training_position, f)
+
+        checkpoint_writer.submit(save_path, write)
+
     image_logs = None
-    for epoch in range(first_epoch, args.num_train_epochs):
-        for step, batch in enumerate(train_dataloader):
+    # A stream has no known length, its epochs go on until `--max_train_steps`
+    epochs = itertools.count(first_epoch) if args.streaming else range(first_epoch, args.num_train_epochs)
+    for epoch in epochs:
+        # The accelerate wrapper re-applies its own epoch counter when iterating, which starts at 0 after a resume.
+        # The sampler is also set directly because the multi-process wrapper does not forward `set_epoch`.
+        if not args.streaming:
+            train_dataloader.set_epoch(epoch)
+        batch_sampler.set_epoch(epoch)
+        epoch_start_batch = batch_sampler.start_batch
+        for step, batch in enumerate(batches):
+            if args.streaming and not args.prefetch_to_device:
+                batch = send_to_device(batch, accelerator.device, non_blocking=True)
+            profiler.start_micro_step(len(batch["prompt_embeds"]))
+            if detect_sync_points:
+                torch.cuda.set_sync_debug_mode("warn")
             with accelerator.accumulate(controlnet):
                 # Convert images to latent space
-                pixel_values = batch["pixel_values"].to(dtype=vae.dtype)
-                model_input = vae.encode(pixel_values).latent_dist.sample()
-                model_input = (model_input - vae.config.shift_factor) * vae.config.scaling_factor
-                model_input = model_input.to(dtype=weight_dtype)
+                with profiler.phase("vae_encode"):
+                    if args.cache_latents:
+                        model_input = sample_latent_dist(batch["latent_params"].float())
+                    else:
+                        pixel_values = batch["pixel_values"].to(dtype=vae.dtype)
+                        model_input = vae.encode(pixel_values).latent_dist.sample()
+                    model_input = (model_input - vae_shift_factor) * vae_scaling_factor
+                    model_input = model_input.to(dtype=weight_dtype)
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(model_input)
@@ -1355,22 +2667,33 @@ def main(args):
                     logit_mean=args.logit_mean,
                     logit_std=args.logit_std,
                     mode_scale=args.mode_scale,
+                    device=model_input.device,
                 )
                 indices = (u * noise_scheduler_copy.config.num_train_timesteps).long()
-                timesteps = noise_scheduler_copy.timesteps[indices].to(device=model_input.device)
+                timesteps = schedule_timesteps[indices]
 
                 # Add noise according to flow matching.
-                sigmas = get_sigmas(timesteps, n_dim=model_input.ndim, dtype=model_input.dtype)
+                sigmas = get_sigmas(indices, n_dim=model_input.ndim, dtype=model_input.dtype)
                 noisy_model_input = (1.0 - sigmas) * model_input + sigmas * noise
 
                 # Get the text embedding for conditioning
                 prompt_embeds = batch["prompt_embeds"].to(dtype=weight_dtype)
                 pooled_prompt_embeds = batch["pooled_prompt_embeds"].to(dtype=weight_dtype)
+                joint_attention_kwargs = None
+                if "prompt_attention_mask" in batch:
+                    joint_attention_kwargs = {"encoder_attention_mask": batch["prompt_attention_mask"]}
 
                 # controlnet(s) inference
-                controlnet_image = batch["conditioning_pixel_values"].to(dtype=weight_dtype)
-                controlnet_image = vae.encode(controlnet_image).latent_dist.sample()
-                controlnet_image = (controlnet_image - vae.config.shift_factor) * vae.config.scaling_factor
+                with profiler.phase("vae_encode"):
+                    if args.cache_latents:
+                        controlnet_image = sample_latent_dist(batch["conditioning_latent_params"].float())
+                    else:
+                        controlnet_image = expand_conditioning_channels(
+                            batch["conditioning_pixel_values"].to(dtype=weight_dtype)
+                        )
+                        controlnet_image = vae.encode(controlnet_image).latent_dist.sample()
+                    controlnet_image = (controlnet_image - vae_shift_factor) * vae_scaling_factor
+                    controlnet_image = controlnet_image.to(dtype=weight_dtype)
 
                 # ==============================================================================
                 # 🔥 FIX FOR SD3.5 LARGE: Handle 4D -> 3D Input AND Text Embeddings
@@ -1393,25 +2716,30 @@ def main(args):
                      controlnet_prompt_embeds = prompt_embeds
                 # ==============================================================================
 
-                control_block_res_samples = controlnet(
-                    hidden_states=controlnet_noisy_input,         # <--- Uses processed 3D input
-                    timestep=timesteps,
-                    encoder_hidden_states=controlnet_prompt_embeds, # <--- Uses None if needed
-                    pooled_projections=pooled_prompt_embeds,
-                    controlnet_cond=controlnet_image,
-                    return_dict=False,
-                )[0]
-                control_block_res_samples = [sample.to(dtype=weight_dtype) for sample in control_block_res_samples]
+                with profiler.phase("controlnet_forward"):
+                    control_block_res_samples = controlnet(
+                        hidden_states=controlnet_noisy_input,         # <--- Uses processed 3D input
+                        timestep=timesteps,
+                        encoder_hidden_states=controlnet_prompt_embeds, # <--- Uses None if needed
+                        pooled_projections=pooled_prompt_embeds,
+                        controlnet_cond=controlnet_image,
+                        return_dict=False,
+                    )[0]
+                    control_block_res_samples = [
+                        sample.to(dtype=weight_dtype) for sample in control_block_res_samples
+                    ]
 
                 # Predict the noise residual
-                model_pred = transformer(
-                    hidden_states=noisy_model_input,
-                    timestep=timesteps,
-                    encoder_hidden_states=prompt_embeds,
-                    pooled_projections=pooled_prompt_embeds,
-                    block_controlnet_hidden_states=control_block_res_samples,
-                    return_dict=False,
-                )[0]
+                with profiler.phase("transformer_forward"):
+                    model_pred = transformer(
+                        hidden_states=noisy_model_input,
+                        timestep=timesteps,
+                        encoder_hidden_states=prompt_embeds,
+                        pooled_projections=pooled_prompt_embeds,
+                        block_controlnet_hidden_states=control_block_res_samples,
+                        joint_attention_kwargs=joint_attention_kwargs,
+                        return_dict=False,
+                    )[0]
 
                 # Follow: Section 5 of https://huggingface.co/papers/2206.00364.
                 # Preconditioning of the model outputs.
@@ -1434,22 +2762,48 @@ def main(args):
                     1,
                 )
                 loss = loss.mean()
-
-                accelerator.backward(loss)
-                if accelerator.sync_gradients:
-                    params_to_clip = controlnet.parameters()
-                    accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad(set_to_none=args.set_grads_to_none)
+                train_loss += loss.detach()
+                train_loss_micro_steps += 1
+
+                with profiler.phase("backward"):
+                    accelerator.backward(loss)
+                with profiler.phase("optimizer"):
+                    if accelerator.sync_gradients:
+                        params_to_clip = controlnet.parameters()
+                        accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad(set_to_none=args.set_grads_to_none)
+            if detect_sync_points:
+                torch.cuda.set_sync_debug_mode("default")
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
+                if args.profile_training:
+                    accelerator.log(profiler.end_update(), step=global_step)
+
+                if global_step % args.logging_steps == 0:
+                    # The only point where the host waits for the device to catch up
+                    logs = {
+                        "loss": (train_loss / train_loss_micro_steps).item(),
+                        "lr": lr_scheduler.get_last_lr()[0],
+                    }
+                    progress_bar.set_postfix(**logs)
+                    accelerator.log(logs, step=global_step)
+                    train_loss.zero_()
+                    train_loss_micro_steps = 0
+
+                if args.async_checkpointing and global_step % args.checkpointing_steps == 0:
+                    all_random_states = gather_random_states()
+                    if accelerator.is_main_process:
+                        save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                        consumed_batches = epoch_start_batch + (step + 1) * accelerator.num_processes
+                        save_checkpoint_async(save_path, batch_sampler.state_dict(consumed_batches), all_random_states)
 
                 if accelerator.is_main_process:
-                    if global_step % args.checkpointing_steps == 0:
+                    if global_step % args.checkpointing_steps == 0 and not args.async_checkpointing:
                         # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
                         if args.checkpoints_total_limit is not None:
                             checkpoints = os.listdir(args.output_dir)
@@ -1472,24 +2826,46 @@ def main(args):
 
                         save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
                         accelerator.save_state(save_path)
+                        # Every process consumes one batch of the sampler per step
+                        consumed_batches = epoch_start_batch + (step + 1) * accelerator.num_processes
+                        with open(os.path.join(save_path, TRAINING_POSITION_FILE), "w") as f:
+                            json.dump(batch_sampler.state_dict(consumed_batches), f)
                         logger.info(f"Saved state to {save_path}")
 
-                    if args.validation_prompt is not None and global_step % args.validation_steps == 0:
+                    if (
+                        args.validation_prompt is not None
+                        and not args.validation_worker
+                        and global_step % args.validation_steps == 0
+                    ):
+                        if validation_pipeline is None:
+                            validation_pipeline = build_validation_pipeline(
+                                unwrap_model(controlnet), transformer, vae, noise_scheduler
+                            )
                         image_logs = log_validation(
-                            controlnet,
+                            validation_pipeline,
+                            validation_embeddings,
                             args,
                             accelerator,
-                            weight_dtype,
                             global_step,
                         )
 
-            logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
-            progress_bar.set_postfix(**logs)
-            accelerator.log(logs, step=global_step)
+            profiler.end_micro_step()
 
             if global_step >= args.max_train_steps:
                 break
 
+        if global_step >= args.max_train_steps:
+            break
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
+    if args.profile_training and accelerator.is_main_process:
+        profile_path = os.path.join(args.output_dir, "training_profile.json")
+        profile_summary = profiler.save_summary(profile_path)
+        if profile_summary is not None:
+            logger.info(f"{profile_summary['samples_per_s']:.2f} samples/s, profile saved to {profile_path}")
+
     # Create the pipeline using using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
@@ -1499,11 +2875,14 @@ def main(args):
         # Run a final round of validation.
         image_logs = None
         if args.validation_prompt is not None:
+            # Validates the saved weights, with the resident transformer and VAE
+            final_controlnet = SD3ControlNetModel.from_pretrained(args.output_dir, torch_dtype=weight_dtype)
+            final_controlnet.to(accelerator.device)
             image_logs = log_validation(
-                controlnet=None,
+                pipeline=build_validation_pipeline(final_controlnet, transformer, vae, noise_scheduler),
+                embeddings=validation_embeddings,
                 args=args,
                 accelerator=accelerator,
-                weight_dtype=weight_dtype,
                 step=global_step,
                 is_final_validation=True,
             )
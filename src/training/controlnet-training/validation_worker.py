@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Out-of-band validation for `train_controlnet_sd3.py`.
+
+Started by the training script with `--validation_worker` (or by hand with the same arguments), this process
+watches `--output_dir` for new checkpoints and validates each one with a pipeline it keeps resident: the
+validation prompts are encoded once and the text encoders are dropped, then only the controlnet weights are
+swapped per checkpoint. Images go to the same trackers as training, under the checkpoint's step.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import torch
+from accelerate.tracking import LOGGER_TYPE_TO_CLASS
+
+from async_checkpoint import list_checkpoints
+from diffusers import SD3ControlNetModel, StableDiffusion3ControlNetPipeline
+from diffusers.training_utils import free_memory
+from diffusers.utils import is_wandb_available
+from train_controlnet_sd3 import (
+    TRAINING_POSITION_FILE,
+    generate_validation_images,
+    get_validation_pairs,
+    log_validation_images,
+    parse_args,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_worker_args():
+    parser = argparse.ArgumentParser(description="Validation worker for train_controlnet_sd3.py.")
+    parser.add_argument(
+        "--training_pid",
+        type=int,
+        default=None,
+        help="Exit once this process is gone and its last checkpoint has been validated.",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between two scans of `--output_dir` for new checkpoints.",
+    )
+    parser.add_argument(
+        "--start_step",
+        type=int,
+        default=None,
+        help="Only validate checkpoints after this step. Defaults to the latest checkpoint when the worker starts.",
+    )
+    worker_args, training_args = parser.parse_known_args()
+    return worker_args, parse_args(training_args)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_weight_dtype(args):
+    if args.mixed_precision == "fp16":
+        return torch.float16
+    if args.mixed_precision == "bf16":
+        return torch.bfloat16
+    return torch.float32
+
+
+def init_trackers(args):
+    # Same run directory (tensorboard) or project (wandb) as the training process
+    logging_dir = os.path.join(args.output_dir, args.logging_dir)
+    if args.report_to == "all":
+        report_to = ["tensorboard"] + (["wandb"] if is_wandb_available() else [])
+    else:
+        report_to = [args.report_to]
+    trackers = []
+    for name in report_to:
+        if name == "tensorboard":
+            trackers.append(LOGGER_TYPE_TO_CLASS[name](args.tracker_project_name, logging_dir))
+        elif name == "wandb":
+            trackers.append(LOGGER_TYPE_TO_CLASS[name](args.tracker_project_name, job_type="validation"))
+        else:
+            logger.warning(f"image logging not implemented for {name}")
+    for tracker in trackers:
+        tracker.start()
+    return trackers
+
+
+def load_pipeline(args, device, weight_dtype, validation_prompts):
+    controlnet_path = args.controlnet_model_name_or_path
+    controlnet = (
+        SD3ControlNetModel.from_pretrained(controlnet_path, torch_dtype=weight_dtype)
+        if controlnet_path is not None
+        else None
+    )
+    pipeline = StableDiffusion3ControlNetPipeline.from_pretrained(
+        args.pretrained_model_name_or_path,
+        controlnet=controlnet,
+        safety_checker=None,
+        revision=args.revision,
+        variant=args.variant,
+        torch_dtype=weight_dtype,
+    )
+    pipeline.to(device)
+    pipeline.set_progress_bar_config(disable=True)
+
+    # The validation prompts never change, encode them once and drop the text encoders
+    with torch.no_grad():
+        embeddings = pipeline.encode_prompt(
+            validation_prompts,
+            prompt_2=None,
+            prompt_3=None,
+            device=device,
+            max_sequence_length=args.max_sequence_length,
+        )
+    pipeline.text_encoder = pipeline.text_encoder_2 = pipeline.text_encoder_3 = None
+    free_memory()
+    # Full-length embeddings, without the attention masks of trimmed ones
+    return pipeline, (*embeddings, None, None)
+
+
+def load_checkpoint_controlnet(pipeline, checkpoint_dir, weight_dtype):
+    controlnet = SD3ControlNetModel.from_pretrained(checkpoint_dir, subfolder="controlnet", torch_dtype=weight_dtype)
+    if pipeline.controlnet is None:
+        pipeline.controlnet = controlnet.to(pipeline.device)
+    else:
+        # Not strict: controlnets without their own `pos_embed` borrow the transformer's inside the pipeline
+        pipeline.controlnet.load_state_dict(controlnet.state_dict(), strict=False)
+        del controlnet
+
+
+def main():
+    worker_args, args = parse_worker_args()
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.validation_prompt is None:
+        raise ValueError("The validation worker needs `--validation_prompt` and `--validation_image`.")
+
+    if args.validation_device is None:
+        raise ValueError("The validation worker needs `--validation_device`, a device that training does not use.")
+    device = torch.device(args.validation_device)
+    weight_dtype = get_weight_dtype(args)
+    validation_images, validation_prompts = get_validation_pairs(args)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    start_step = worker_args.start_step
+    if start_step is None:
+        existing = list_checkpoints(args.output_dir)
+        start_step = int(existing[-1].split("-")[1]) if existing else 0
+    validated = {c for c in list_checkpoints(args.output_dir) if int(c.split("-")[1]) <= start_step}
+
+    pipeline, embeddings = load_pipeline(args, device, weight_dtype, validation_prompts)
+    trackers = init_trackers(args)
+    logger.info(f"Validation worker watching {args.output_dir} on {device}")
+
+    while True:
+        training_done = worker_args.training_pid is not None and not is_running(worker_args.training_pid)
+        # The training position is written last, both by `save_state` and by the async writer
+        pending = [
+            checkpoint
+            for checkpoint in list_checkpoints(args.output_dir)
+            if checkpoint not in validated
+            and os.path.exists(os.path.join(args.output_dir, checkpoint, TRAINING_POSITION_FILE))
+        ]
+        if not pending:
+            if training_done:
+                break
+            time.sleep(worker_args.poll_interval)
+            continue
+
+        # Checkpoints can outpace validation, the newest one is the most useful
+        checkpoint = pending[-1]
+        validated.update(pending)
+        step = int(checkpoint.split("-")[1])
+        try:
+            load_checkpoint_controlnet(pipeline, os.path.join(args.output_dir, checkpoint), weight_dtype)
+        except OSError as e:
+            # Pruned by `--checkpoints_total_limit` before we got to it
+            logger.warning(f"Skipping {checkpoint}: {e}")
+            continue
+
+        start = time.perf_counter()
+        generator = None if args.seed is None else torch.Generator(device="cpu").manual_seed(args.seed)
+        image_logs = generate_validation_images(
+            pipeline,
+            args,
+            validation_images,
+            validation_prompts,
+            embeddings,
+            generator,
+            torch.autocast(device.type),
+        )
+        log_validation_images(trackers, image_logs, step, "validation")
+        for tracker in trackers:
+            tracker.log({"validation_seconds": time.perf_counter() - start}, step=step)
+        logger.info(f"Validated {checkpoint} in {time.perf_counter() - start:.1f}s")
+
+    for tracker in trackers:
+        tracker.finish()
+
+
+if __name__ == "__main__":
+    main()
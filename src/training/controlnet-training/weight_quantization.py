@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+Weight-only quantization of the frozen models.
+
+`quantize_weights` replaces the `nn.Linear` and `nn.Conv2d` layers of a model by layers that keep their weight in
+int8 or fp8 with one scale per output channel, and dequantize it to the activation dtype on every call. Only the
+weights are quantized, activations and their gradients keep the training precision, so gradients still flow
+through the frozen model to its inputs (the controlnet residuals).
+
+The autograd functions save the quantized weight for the backward pass and dequantize it again there, instead of
+keeping a dequantized copy of every layer alive until the backward pass. fp8 weights are stored as their raw
+uint8 bits so `model.to(dtype=...)` leaves them untouched. Everything runs on CPU as well.
+"""
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+QUANTIZATION_DTYPES = {
+    "int8": torch.int8,
+    "fp8": torch.float8_e4m3fn,
+}
+
+
+def _quantize(weight, quantization):
+    weight = weight.detach().float()
+    amax = weight.abs().amax(dim=tuple(range(1, weight.ndim)), keepdim=True).clamp(min=1e-12)
+    if quantization == "int8":
+        scale = amax / 127
+        quantized = (weight / scale).round().clamp(-127, 127).to(torch.int8)
+    else:
+        scale = amax / torch.finfo(torch.float8_e4m3fn).max
+        quantized = (weight / scale).to(torch.float8_e4m3fn).view(torch.uint8)
+    return quantized, scale
+
+
+def _dequantize(quantized, scale, quantization, dtype):
+    if quantization == "fp8":
+        quantized = quantized.view(torch.float8_e4m3fn)
+    return quantized.to(dtype) * scale.to(dtype)
+
+
+def _compute_dtype(x):
+    if torch.is_autocast_enabled(x.device.type):
+        return torch.get_autocast_dtype(x.device.type)
+    return x.dtype
+
+
+class _QuantizedLinearFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, quantized, scale, bias, quantization):
+        ctx.save_for_backward(quantized, scale)
+        ctx.quantization = quantization
+        return F.linear(x, _dequantize(quantized, scale, quantization, x.dtype), bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        quantized, scale = ctx.saved_tensors
+        weight = _dequantize(quantized, scale, ctx.quantization, grad_output.dtype)
+        return grad_output @ weight, None, None, None, None
+
+
+class _QuantizedConv2dFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, quantized, scale, bias, quantization, stride, padding, dilation, groups):
+        ctx.save_for_backward(quantized, scale)
+        ctx.quantization = quantization
+        ctx.conv_args = (stride, padding, dilation, groups)
+        ctx.input_shape = x.shape
+        weight = _dequantize(quantized, scale, quantization, x.dtype)
+        return F.conv2d(x, weight, bias, stride, padding, dilation, groups)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        quantized, scale = ctx.saved_tensors
+        weight = _dequantize(quantized, scale, ctx.quantization, grad_output.dtype)
+        grad_input = torch.nn.grad.conv2d_input(ctx.input_shape, weight, grad_output, *ctx.conv_args)
+        return grad_input, None, None, None, None, None, None, None, None
+
+
+class _QuantizedMixin:
+    def _init_quantized(self, layer, quantization):
+        quantized, scale = _quantize(layer.weight, quantization)
+        self.quantization = quantization
+        self.register_buffer("weight_quantized", quantized)
+        self.register_buffer("weight_scale", scale.to(layer.weight.dtype))
+        if layer.bias is not None:
+            self.register_buffer("bias", layer.bias.detach().clone())
+        else:
+            self.bias = None
+
+    def _bias(self, dtype):
+        return None if self.bias is None else self.bias.to(dtype)
+
+
+class QuantizedLinear(_QuantizedMixin, nn.Module):
+    def __init__(self, linear, quantization):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self._init_quantized(linear, quantization)
+
+    def forward(self, x):
+        x = x.to(_compute_dtype(x))
+        return _QuantizedLinearFunction.apply(
+            x, self.weight_quantized, self.weight_scale, self._bias(x.dtype), self.quantization
+        )
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, quantization={self.quantization}"
+
+
+class QuantizedConv2d(_QuantizedMixin, nn.Module):
+    def __init__(self, conv, quantization):
+        super().__init__()
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        self._init_quantized(conv, quantization)
+
+    def forward(self, x):
+        x = x.to(_compute_dtype(x))
+        return _QuantizedConv2dFunction.apply(
+            x,
+            self.weight_quantized,
+            self.weight_scale,
+            self._bias(x.dtype),
+            self.quantization,
+            self.stride,
+            self.padding,
+            self.dilation,
+            self.groups,
+        )
+
+    def extra_repr(self):
+        return (
+            f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, stride={self.stride},"
+            f" quantization={self.quantization}"
+        )
+
+
+def quantize_weights(model, quantization, exclude=()):
+    """
+    Replaces, in place, the linear and 2D convolution layers of a frozen `model` by weight-only quantized ones,
+    except inside the submodules named in `exclude`. Returns the number of replaced layers.
+    """
+    if quantization not in QUANTIZATION_DTYPES:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {list(QUANTIZATION_DTYPES)}")
+    num_layers = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            child_name_full = f"{name}.{child_name}" if name else child_name
+            if any(child_name_full == excluded or child_name_full.startswith(f"{excluded}.") for excluded in exclude):
+                continue
+            if type(child) is nn.Linear:
+                setattr(module, child_name, QuantizedLinear(child, quantization))
+            elif type(child) is nn.Conv2d and child.padding_mode == "zeros":
+                setattr(module, child_name, QuantizedConv2d(child, quantization))
+            else:
+                continue
+            num_layers += 1
+    return num_layers
+
+
+def weight_memory(model):
+    """Bytes taken by the parameters and buffers of `model`."""
+    return sum(tensor.nbytes for tensor in list(model.parameters()) + list(model.buffers()))